@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import threading
+
 import pytest
 
 from pydicom.uid import ImplicitVRLittleEndian
@@ -7,16 +9,22 @@ from pynetdicom2.asceprovider import PContextDef
 from pynetdicom2 import uids
 from pynetdicom2 import statuses
 from pynetdicom2 import pdu
+from pynetdicom2 import dsutils
 
 from tiny_pacs import ae
+from tiny_pacs import db
 from tiny_pacs import devices
 from tiny_pacs import event_bus
+from tiny_pacs import pacs
+from tiny_pacs import storage
 
 
 @pytest.fixture
 def ae_title():
     bus = event_bus.EventBus()
-    return ae.AE(bus, {})
+    _ae = ae.AE(bus, {})
+    yield _ae
+    _ae.server_close()
 
 
 def test_assoc(ae_title: ae.AE):
@@ -30,9 +38,10 @@ def test_assoc(ae_title: ae.AE):
 
 
 def test_find(ae_title: ae.AE):
-    def callback(context, ds):
+    def callback(context, ds, calling_ae):
         assert ctx == context
         assert ds == _ds
+        assert calling_ae is None
         return [(statuses.C_FIND_PENDING, dataset.Dataset()),
                 (statuses.C_FIND_PENDING, dataset.Dataset())]
 
@@ -46,9 +55,10 @@ def test_find(ae_title: ae.AE):
 
 
 def test_store_success(ae_title: ae.AE):
-    def callback(context, ds):
+    def callback(context, ingest_ctx):
         assert ctx == context
-        assert ds == _ds
+        assert ingest_ctx.context == ctx
+        assert ingest_ctx.fp is _ds
         return statuses.SUCCESS
 
     ctx = PContextDef(1, uids.BASIC_TEXT_SR_STORAGE, ImplicitVRLittleEndian)
@@ -59,9 +69,9 @@ def test_store_success(ae_title: ae.AE):
 
 
 def test_store_failure(ae_title: ae.AE):
-    def callback(context, ds):
+    def callback(context, ingest_ctx):
         assert ctx == context
-        assert ds == _ds
+        assert ingest_ctx.fp is _ds
         return statuses.C_MOVE_UNABLE_TO_PROCESS
 
     ctx = PContextDef(1, uids.BASIC_TEXT_SR_STORAGE, ImplicitVRLittleEndian)
@@ -93,3 +103,50 @@ def test_move(ae_title: ae.AE):
     ae_title.bus.subscribe(ae.AEChannels.MOVE, callback)
     results = ae_title.on_receive_move(ctx, _ds, 'REMOTE_PACS')
     assert len(list(results)) == 2
+
+
+def _store_request(uid):
+    command_set = dataset.Dataset()
+    command_set.AffectedSOPClassUID = uids.CT_IMAGE_STORAGE
+    command_set.AffectedSOPInstanceUID = uid
+    ds = dataset.Dataset()
+    ds.PatientID = 'test1'
+    ds.StudyInstanceUID = '1.2.3'
+    ds.SeriesInstanceUID = '1.2.3.4'
+    ds.SOPInstanceUID = uid
+    ds.SOPClassUID = uids.CT_IMAGE_STORAGE
+    ds.Modality = 'CT'
+    return command_set, ds
+
+
+def test_store_returns_connections(tmp_path):
+    bus = event_bus.EventBus()
+    _db = db.Database(bus, {
+        'db_name': str(tmp_path / 'pacs.db'),
+        'pool': {'max_connections': 3, 'timeout': 1}
+    })
+    pacs.PACS(bus, {})
+    storage.InMemoryStorage(bus, {})
+    _ae = ae.AE(bus, {})
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    ctx = PContextDef(1, uids.CT_IMAGE_STORAGE, ImplicitVRLittleEndian)
+    results = []
+
+    def store(uid):
+        # Every association is served by its own thread
+        command_set, ds = _store_request(uid)
+        fp, start = _ae.get_file(ctx, command_set)
+        fp.write(dsutils.encode(ds, True, True))
+        fp.seek(start)
+        results.append(_ae.on_receive_store(ctx, fp))
+
+    try:
+        for i in range(6):
+            thread = threading.Thread(target=store, args=(f'1.2.3.4.{i}',))
+            thread.start()
+            thread.join()
+        assert [status.is_success for status in results] == [True] * 6
+        assert _db.pool_stats()['in_use'] == 0
+    finally:
+        _ae.server_close()
+        bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
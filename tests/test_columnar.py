@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from pydicom import Dataset
+from pydicom.uid import ImplicitVRLittleEndian
+from pynetdicom2.asceprovider import PContextDef
+from pynetdicom2 import statuses
+from pynetdicom2 import uids
+
+from tiny_pacs import columnar
+from tiny_pacs import db
+from tiny_pacs import event_bus
+from tiny_pacs import pacs
+
+
+PATIENTS = [
+    ('P1', 'Smith^John', '19660101', 'M'),
+    ('P2', 'Smithson^Anna', '19800512', 'F'),
+    ('P3', 'Doe^Jane', None, 'F')
+]
+
+STUDIES = [
+    ('P1', '1.1', '20200101', '101010', 'ACC1', 'Chest'),
+    ('P1', '1.2', '20200215', '083000', 'ACC2', 'Head'),
+    ('P2', '1.3', '20190620', '120000', 'ACC3', 'chest pa'),
+    ('P3', '1.4', None, None, 'ACC4', None)
+]
+
+SERIES = [
+    ('1.1', '1.1.1', 'CT'),
+    ('1.1', '1.1.2', 'SR'),
+    ('1.2', '1.2.1', 'MR'),
+    ('1.3', '1.3.1', 'CT'),
+    ('1.4', '1.4.1', 'DX')
+]
+
+
+def _dataset(patient, study, series, index):
+    patient_id, name, birth_date, sex = patient
+    _, study_uid, study_date, study_time, accession, description = study
+    _, series_uid, modality = series
+    ds = Dataset()
+    ds.PatientID = patient_id
+    ds.PatientName = name
+    ds.PatientSex = sex
+    if birth_date:
+        ds.PatientBirthDate = birth_date
+    ds.StudyInstanceUID = study_uid
+    if study_date:
+        ds.StudyDate = study_date
+        ds.StudyTime = study_time
+    ds.AccessionNumber = accession
+    if description:
+        ds.StudyDescription = description
+    ds.SeriesInstanceUID = series_uid
+    ds.Modality = modality
+    ds.SOPInstanceUID = f'{series_uid}.{index}'
+    ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+    return ds
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def backend(request, monkeypatch):
+    """Runs test with NumPy arrays and with pure Python fallback"""
+    if request.param == 'numpy':
+        monkeypatch.setattr(columnar, 'numpy', pytest.importorskip('numpy'))
+    else:
+        monkeypatch.setattr(columnar, 'numpy', None)
+    return request.param
+
+
+@pytest.fixture
+def pacs_srv(backend):
+    bus = event_bus.EventBus()
+    db.Database(bus, {})
+    _pacs_srv = pacs.PACS(bus, {'find_engine': {
+        'PATIENT': 'columnar',
+        'STUDY': 'columnar',
+        'SERIES': 'columnar'
+    }})
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    patients = {p[0]: p for p in PATIENTS}
+    studies = {s[1]: s for s in STUDIES}
+    datasets = []
+    for series in SERIES:
+        study = studies[series[0]]
+        for i in range(2):
+            datasets.append(
+                _dataset(patients[study[0]], study, series, i)
+            )
+    _pacs_srv.c_store_many(datasets[:4])
+    for ds in datasets[4:]:
+        _pacs_srv.c_store(ds)
+    return _pacs_srv
+
+
+def _request(level, **attrs):
+    ds = Dataset()
+    ds.QueryRetrieveLevel = level
+    for name, value in attrs.items():
+        setattr(ds, name, value)
+    return ds
+
+
+REQUESTS = [
+    _request('PATIENT', PatientID='', PatientName=''),
+    _request('PATIENT', PatientName='SMITH*', PatientID=''),
+    _request('PATIENT', PatientName='smith^john', PatientID=''),
+    _request('PATIENT', PatientName='*oe*', NumberOfPatientRelatedStudies=''),
+    _request('PATIENT', PatientID=['P1', 'P3'], PatientSex=''),
+    _request('PATIENT', PatientBirthDate='19700101-', PatientID=''),
+    _request('PATIENT', PatientBirthDate='-19700101', PatientID=''),
+    _request('PATIENT', PatientSex='F', NumberOfPatientRelatedInstances=''),
+    _request('STUDY', StudyInstanceUID='', StudyDate='20200101-20201231'),
+    _request('STUDY', StudyInstanceUID='', StudyDate='20200215'),
+    _request('STUDY', StudyInstanceUID='', StudyDate='20200101-20200215',
+             StudyTime='090000-'),
+    _request('STUDY', StudyDescription='CHEST*', ModalitiesInStudy=''),
+    _request('STUDY', AccessionNumber='ACC?', PatientName='S*',
+             NumberOfStudyRelatedInstances=''),
+    _request('STUDY', PatientID='P1', StudyInstanceUID=''),
+    _request('STUDY', PatientID='P9', StudyInstanceUID=''),
+    _request('SERIES', Modality='CT', StudyInstanceUID='',
+             SeriesInstanceUID=''),
+    _request('SERIES', Modality=['MR', 'DX'], PatientName='',
+             NumberOfSeriesRelatedInstances=''),
+    _request('STUDY', StudyInstanceUID='', StudyDate='2020-'),
+    _request('STUDY', StudyInstanceUID='', StudyDate='-201906'),
+    _request('STUDY', StudyInstanceUID='', StudyDate='202002'),
+    _request('SERIES', StudyDate='2020*', SeriesInstanceUID='')
+]
+
+
+def _sql_find(ds):
+    model = pacs.LEVEL_MODELS[ds.QueryRetrieveLevel]
+    return list(model.c_find(ds))
+
+
+@pytest.mark.parametrize('ds', REQUESTS)
+def test_matches_sql(pacs_srv: pacs.PACS, ds):
+    if ds.get('StudyDate') == '2020*':
+        # Wildcards are not allowed for dates
+        ctx = PContextDef(1, uids.STUDY_ROOT_FIND_SOP_CLASS,
+                          ImplicitVRLittleEndian)
+        assert [status for _, status in pacs_srv.on_find(ctx, ds)] == [
+            statuses.C_FIND_UNABLE_TO_PROCESS
+        ]
+        return
+    expected = _sql_find(ds)
+    results = list(pacs_srv.c_find(ds))
+    assert sorted(map(str, results)) == sorted(map(str, expected))
+
+
+def test_load(pacs_srv: pacs.PACS):
+    pacs_srv.load_columnar()
+    assert len(pacs_srv.columnar.tables[pacs.Study]) == len(STUDIES)
+    assert pacs.Instance not in pacs_srv.columnar
+    for ds in REQUESTS[:-1]:
+        expected = _sql_find(ds)
+        assert sorted(map(str, pacs_srv.c_find(ds))) == \
+            sorted(map(str, expected))
+
+
+def test_no_database_queries(pacs_srv: pacs.PACS, monkeypatch):
+    def execute_sql(*args, **kwargs):
+        raise AssertionError('Unexpected query')
+
+    monkeypatch.setattr(db.DB.obj, 'execute_sql', execute_sql)
+    results = list(pacs_srv.c_find(REQUESTS[8]))
+    assert len(results) == 2
+
+
+def test_counters_updated_on_store(pacs_srv: pacs.PACS):
+    study = STUDIES[0]
+    patient = PATIENTS[0]
+    pacs_srv.c_store(_dataset(patient, study, SERIES[0], 5))
+    ds = _request('STUDY', StudyInstanceUID='1.1',
+                  NumberOfStudyRelatedInstances='')
+    result, = pacs_srv.c_find(ds)
+    assert result.NumberOfStudyRelatedInstances == 5
+
+
+def test_delete_reloads(pacs_srv: pacs.PACS):
+    pacs_srv.delete_instances(['1.4.1.0', '1.4.1.1'])
+    ds = _request('PATIENT', PatientID='', PatientName='')
+    assert sorted(r.PatientID for r in pacs_srv.c_find(ds)) == ['P1', 'P2']
+
+
+def test_rows_in_chunks(pacs_srv: pacs.PACS, monkeypatch):
+    monkeypatch.setattr(columnar, 'ROWS_CHUNK_SIZE', 2)
+    ds = _request('SERIES', SeriesInstanceUID='')
+    rows = list(pacs_srv.c_find(ds))
+    assert len(rows) == len(SERIES)
+
+    # Index can be reloaded while results are sent
+    model = pacs.LEVEL_MODELS['SERIES']
+    key, values = pacs.find_key(model, ds)
+    plan = columnar.ColumnarPlan.compile(model, key)
+    results = pacs_srv.columnar.rows(plan, values)
+    first = next(results)
+    pacs_srv.load_columnar()
+    assert len([first] + list(results)) == len(SERIES)
+
+
+def test_like_pattern():
+    match = columnar._like_re('AB%C_').fullmatch
+    assert match('abxxcd')
+    assert not match('abxxc')
+    assert not match('xabcd')
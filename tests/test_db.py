@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+import threading
+import time
+
+import peewee
+import pytest
+
+from playhouse import migrate
+
+from pydicom import Dataset
+
+from tiny_pacs import config
+from tiny_pacs import db
+from tiny_pacs import event_bus
+from tiny_pacs import index_report
+from tiny_pacs import pacs
+from tiny_pacs import storage
+
+
+@pytest.fixture
+def pooled_srv(tmp_path):
+    bus = event_bus.EventBus()
+    _db = db.Database(bus, {
+        'db_name': str(tmp_path / 'pacs.db'),
+        'pool': {'max_connections': 4}
+    })
+    _pacs_srv = pacs.PACS(bus, {})
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    yield _db, _pacs_srv
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def _dataset(uid):
+    ds = Dataset()
+    ds.PatientID = 'test1'
+    ds.PatientName = 'Test^Test'
+    ds.StudyInstanceUID = '1.2.3'
+    ds.SeriesInstanceUID = '1.2.3.4'
+    ds.SOPInstanceUID = uid
+    ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+    ds.Modality = 'OT'
+    return ds
+
+
+def test_connection_scope_reuses_open_connection(pooled_srv):
+    _db, _ = pooled_srv
+    with _db.connection():
+        conn = db.DB.connection()
+        with _db.connection():
+            assert db.DB.connection() is conn
+        assert not db.DB.is_closed()
+    assert db.DB.is_closed()
+
+
+def test_connection_scope_closes_lazy_connection(pooled_srv):
+    _db, _ = pooled_srv
+    with _db.connection():
+        db.DB.close()
+        # Reopened on demand by the query
+        db.DB.execute_sql('SELECT 1')
+    assert db.DB.is_closed()
+    assert _db.pool_stats()['in_use'] == 0
+
+
+def test_pool_reuses_connections(pooled_srv):
+    _db, _pacs_srv = pooled_srv
+    for i in range(5):
+        with _pacs_srv.connection():
+            _pacs_srv.c_store(_dataset(f'1.2.3.4.{i}'))
+
+    results = []
+
+    def find():
+        ds = Dataset()
+        ds.QueryRetrieveLevel = 'IMAGE'
+        ds.SeriesInstanceUID = '1.2.3.4'
+        ds.SOPInstanceUID = ''
+        for _ in range(5):
+            with _pacs_srv.connection():
+                results.append(len(list(_pacs_srv.c_find(ds))))
+
+    threads = [threading.Thread(target=find) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [5] * 15
+    stats = _db.pool_stats()
+    assert stats['in_use'] == 0
+    assert stats['checkouts'] >= 20
+    assert stats['connects'] <= stats['max_connections']
+
+
+def test_no_pool_stats_without_pool():
+    bus = event_bus.EventBus()
+    _db = db.Database(bus, {})
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    assert _db.pool_stats() == {}
+
+
+@pytest.fixture
+def wal_srv(tmp_path):
+    bus = event_bus.EventBus()
+    _db = db.Database(bus, {
+        'db_name': str(tmp_path / 'pacs.db'),
+        'wal': {'on': True}
+    })
+    _pacs_srv = pacs.PACS(bus, {})
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    yield _db, _pacs_srv
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def test_wal_mode(wal_srv):
+    _db, _ = wal_srv
+    assert db.DB.execute_sql('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert _db.writer is not None
+
+
+def test_wal_concurrent_store_and_find(wal_srv):
+    _, _pacs_srv = wal_srv
+    errors = []
+    found = []
+
+    def store(start):
+        try:
+            for i in range(start, start + 10):
+                with _pacs_srv.connection():
+                    _pacs_srv.c_store(_dataset(f'1.2.3.4.{i}'))
+        except Exception as e:
+            errors.append(e)
+
+    def find():
+        ds = Dataset()
+        ds.QueryRetrieveLevel = 'IMAGE'
+        ds.SeriesInstanceUID = '1.2.3.4'
+        ds.SOPInstanceUID = ''
+        try:
+            for _ in range(10):
+                with _pacs_srv.connection():
+                    found.append(len(list(_pacs_srv.c_find(ds))))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=store, args=(i * 100,))
+               for i in range(4)]
+    threads += [threading.Thread(target=find) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert len(found) == 20
+    assert pacs.Instance.select().count() == 40
+    series = pacs.Series.get(pacs.Series.series_instance_uid == '1.2.3.4')
+    assert series.number_of_series_related_instances == 40
+
+
+def test_write_runs_in_writer_thread(wal_srv):
+    _db, _ = wal_srv
+    assert _db.write(threading.current_thread) is _db.writer._thread
+    # Nested writes are executed by the writer itself
+    assert _db.write(_db.write, lambda: 1) == 1
+
+
+@pytest.fixture
+def replica_srv(tmp_path):
+    bus = event_bus.EventBus()
+    _db = db.Database(bus, {'db_name': str(tmp_path / 'primary.db')})
+    _pacs_srv = pacs.PACS(bus, {})
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    _pacs_srv.c_store(_dataset('1.2.3.4.1'))
+
+    # Replica that lags behind the primary
+    replica = peewee.SqliteDatabase(str(tmp_path / 'replica.db'))
+    with replica.bind_ctx(_pacs_srv.tables()):
+        replica.create_tables(_pacs_srv.tables())
+    replica.close()
+    _db.replicas.append(replica)
+    yield _db, _pacs_srv, replica
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def _find_images(pacs_srv):
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'IMAGE'
+    ds.SeriesInstanceUID = '1.2.3.4'
+    ds.SOPInstanceUID = ''
+    return [r.SOPInstanceUID for r in pacs_srv.c_find(ds)]
+
+
+def test_find_uses_replica(replica_srv):
+    _, _pacs_srv, replica = replica_srv
+    with _pacs_srv.connection():
+        assert _find_images(_pacs_srv) == []
+        assert not replica.is_closed()
+    assert replica.is_closed()
+
+
+def test_read_your_writes(replica_srv, monkeypatch):
+    _db, _pacs_srv, replica = replica_srv
+    monkeypatch.setattr(_db, '_primary_lsn', lambda: 2)
+    lsn = {replica: 1}
+    monkeypatch.setattr(_db, '_replica_caught_up',
+                        lambda r, primary_lsn: lsn[r] >= primary_lsn)
+    _pacs_srv.find_consistency = db.Consistency.READ_YOUR_WRITES
+    assert _find_images(_pacs_srv) == ['1.2.3.4.1']
+    assert _db.replica(db.Consistency.READ_YOUR_WRITES) is db.DB.obj
+
+    lsn[replica] = 2
+    assert _db.replica(db.Consistency.READ_YOUR_WRITES) is replica
+    assert _db.replica(db.Consistency.EVENTUAL) is replica
+
+
+def test_retrieve_replica_closed(replica_srv, monkeypatch):
+    _db, _pacs_srv, replica = replica_srv
+
+    def caught_up(r, primary_lsn):
+        return r.execute_sql('SELECT 1').fetchone()[0] >= primary_lsn
+
+    monkeypatch.setattr(
+        _db, '_primary_lsn', lambda: db.DB.execute_sql('SELECT 1').fetchone()[0]
+    )
+    monkeypatch.setattr(_db, '_replica_caught_up', caught_up)
+    _pacs_srv.retrieve_consistency = db.Consistency.READ_YOUR_WRITES
+    db.DB.obj.close()
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'SERIES'
+    ds.SeriesInstanceUID = '1.2.3.4'
+    results = _pacs_srv.c_move_get(ds)
+    assert results.count == 0
+    assert db.DB.obj.is_closed()
+    assert replica.is_closed()
+
+
+class LegacyPatient(peewee.Model):
+    patient_name = peewee.CharField(index=True, null=True)
+    patient_id = peewee.CharField(unique=True)
+
+    class Meta:
+        table_name = 'patient'
+
+
+class LegacyStudy(peewee.Model):
+    patient = peewee.ForeignKeyField(LegacyPatient)
+    study_date = peewee.CharField(index=True, null=True)
+    study_instance_uid = peewee.CharField(unique=True)
+
+    class Meta:
+        table_name = 'study'
+
+
+def _start(tmp_path, config=None):
+    bus = event_bus.EventBus()
+    _db = db.Database(bus, dict(config or {}, db_name=str(tmp_path / 'pacs.db')))
+    _pacs_srv = pacs.PACS(bus, {})
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    return bus, _db, _pacs_srv
+
+
+def test_new_database_schema_version(tmp_path):
+    bus, _, _ = _start(tmp_path)
+    version = db.SchemaVersion.get(db.SchemaVersion.component == 'pacs')
+    assert version.version == pacs.MIGRATIONS[-1].version
+    indexes = set(i.name for i in db.DB.get_indexes('series'))
+    assert 'series_study_id_modality' in indexes
+    assert 'series_modality' not in indexes
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def test_legacy_database_migration(tmp_path):
+    legacy = peewee.SqliteDatabase(str(tmp_path / 'pacs.db'))
+    with legacy.bind_ctx([LegacyPatient, LegacyStudy]):
+        legacy.create_tables([LegacyPatient, LegacyStudy])
+        patient = LegacyPatient.create(patient_name='Doe^John', patient_id='1')
+        LegacyStudy.create(patient=patient, study_date='20200101',
+                           study_instance_uid='1.2.3')
+    legacy.close()
+
+    bus, _, _ = _start(tmp_path)
+    version = db.SchemaVersion.get(db.SchemaVersion.component == 'pacs')
+    assert version.version == pacs.MIGRATIONS[-1].version
+
+    patient = pacs.Patient.get(pacs.Patient.patient_id == '1')
+    assert patient.patient_name_search == 'DOE^JOHN'
+    assert patient.number_of_patient_related_studies == 1
+    study = pacs.Study.get(pacs.Study.study_instance_uid == '1.2.3')
+    assert study.study_date_num == 20200101
+
+    indexes = set(i.name for i in db.DB.get_indexes('study'))
+    assert 'study_patient_id_study_date_num' in indexes
+    assert 'study_study_date' not in indexes
+    assert 'study_study_instance_uid' in indexes
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def test_migration_keeps_search_indexes(tmp_path):
+    bus, _, _ = _start(tmp_path)
+    names = ['patient_patient_name_search_pattern',
+             'patient_patient_name_search_trgm']
+    for name in names:
+        db.DB.execute_sql(
+            f'CREATE INDEX {name} ON patient (patient_name_search)'
+        )
+    migrator = migrate.SchemaMigrator.from_database(db.DB.obj)
+    for _ in range(2):
+        pacs.MIGRATIONS[-1].apply(migrator)
+        indexes = set(i.name for i in db.DB.get_indexes('patient'))
+        assert indexes.issuperset(names)
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def test_index_report(tmp_path):
+    workload_file = str(tmp_path / 'workload.json')
+    bus, _db, _pacs_srv = _start(tmp_path, {'workload_file': workload_file})
+    _pacs_srv.c_store(_dataset('1.2.3.4.1'))
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'STUDY'
+    ds.StudyDate = '20200101-20200201'
+    ds.StudyInstanceUID = ''
+    list(_pacs_srv.c_find(ds))
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+    workload = db.Workload.load(workload_file)
+    assert workload.queries
+    report = index_report.index_report(
+        db.DB.obj, _pacs_srv.tables(), workload
+    )
+    assert report['usage']['study_study_date_num'] == 1
+    assert 'study_study_date_time_num' in report['unused']
+    assert not report['redundant']
+    assert not report['failed']
+
+
+def test_index_report_main(tmp_path, monkeypatch, capsys):
+    workload_file = str(tmp_path / 'workload.json')
+    bus, _, _pacs_srv = _start(tmp_path, {'workload_file': workload_file})
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'STUDY'
+    ds.StudyDate = '20200101-20200201'
+    ds.StudyInstanceUID = ''
+    list(_pacs_srv.c_find(ds))
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+    config_file = tmp_path / 'config.json'
+    config_file.write_text(json.dumps({'components': {
+        'Database': {'on': True, 'db_name': str(tmp_path / 'pacs.db')},
+        'PACS': {'on': True},
+        'FileStorage': {'on': True, 'path': str(tmp_path / 'storage')}
+    }}))
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Components must not be started')
+
+    # Configuration is merged into default components
+    monkeypatch.setattr(config, 'DEFAULT_COMPONENTS',
+                        dict(config.DEFAULT_COMPONENTS))
+    # Neither tables nor migrations, nor storage maintenance are run
+    monkeypatch.setattr(db.Database, '_create_tables', fail)
+    monkeypatch.setattr(pacs.PACS, 'on_start', fail)
+    monkeypatch.setattr(storage.FileStorage, 'on_start', fail)
+    monkeypatch.setattr(sys, 'argv', [
+        'index_report', '-c', str(config_file), '-w', workload_file
+    ])
+    index_report.main()
+    output = capsys.readouterr().out
+    assert '  study_study_date_num: 1' in output
+    assert '  study_study_date_time_num' in output
+
+
+def test_query_timeout(tmp_path):
+    bus, _db, _ = _start(tmp_path)
+    endless = ('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 '
+               'FROM c) SELECT max(x) FROM c')
+    with _db.connection():
+        with pytest.raises(db.QueryTimeoutError):
+            with db.query_timeout(db.DB, 0.05):
+                db.DB.execute_sql(endless)
+        # Handler is removed once the block is left
+        with db.query_timeout(db.DB, 0.05):
+            assert db.DB.execute_sql('SELECT 1').fetchone() == (1,)
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def test_query_timeout_other_errors(tmp_path):
+    bus, _db, _ = _start(tmp_path)
+    with _db.connection():
+        with pytest.raises(peewee.OperationalError) as e:
+            with db.query_timeout(db.DB, 0.01):
+                time.sleep(0.05)
+                db.DB.execute_sql('SELECT * FROM missing')
+        assert not isinstance(e.value, db.QueryTimeoutError)
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def test_query_timeout_paused_while_yielding(tmp_path):
+    bus, _db, _ = _start(tmp_path)
+    # Every row takes many steps of the progress handler to compute
+    query = ('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 '
+             'FROM c LIMIT 100000) SELECT x FROM c WHERE x % 20000 = 0')
+    with _db.connection():
+        rows = pacs._with_timeout(iter(db.DB.execute_sql(query)), db.DB, 0.1)
+        result = []
+        for row in rows:
+            time.sleep(0.05)
+            result.append(row[0])
+        assert result == [20000, 40000, 60000, 80000, 100000]
+
+        # Fetching rows is still timed
+        with pytest.raises(db.QueryTimeoutError):
+            with db.query_timeout(db.DB, 0.1):
+                for _ in db.DB.execute_sql(query):
+                    time.sleep(0.05)
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def test_stream_closes_cursor(tmp_path):
+    bus, _db, _pacs_srv = _start(tmp_path)
+    for i in range(3):
+        _pacs_srv.c_store(_dataset(f'1.2.3.4.{i}'))
+    with _db.connection():
+        rows = db.stream(pacs.Instance.select().tuples())
+        next(rows)
+        # Unfinished statement holds a shared lock, that blocks writers
+        other = peewee.SqliteDatabase(str(tmp_path / 'pacs.db'), timeout=0)
+        with pytest.raises(peewee.OperationalError):
+            other.execute_sql('DELETE FROM instance')
+        rows.close()
+        other.execute_sql('DELETE FROM instance')
+        other.close()
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def test_replica_round_robin_threads():
+    bus = event_bus.EventBus()
+    _db = db.Database(bus, {})
+    _db.replicas = [object() for _ in range(3)]
+    used = []
+
+    def pick():
+        for _ in range(300):
+            used.append(_db.replica())
+
+    threads = [threading.Thread(target=pick) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [used.count(r) for r in _db.replicas] == [400, 400, 400]
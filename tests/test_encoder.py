@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from pydicom import Dataset
+from pynetdicom2 import dsutils
+
+from tiny_pacs import encoder
+from tiny_pacs import event_bus
+from tiny_pacs import db
+from tiny_pacs import pacs
+
+
+RESPONSE_ATTRS = [
+    (0x00100020, 0, 'LO', None),
+    (0x00100010, 1, 'PN', None),
+    (0x00100030, 2, 'DA', None),
+    (0x0020000D, 3, 'UI', None),
+    (0x00201208, 4, 'IS', None),
+    (0x00200011, 5, 'IS', None),
+    (0x00080061, 6, 'CS', None),
+    (0x00081030, 7, 'LO', None),
+    (0x00101020, 8, 'DS', None),
+    (0x00104000, 9, 'LT', None),
+    (0x00080050, None, 'SH', None),
+    (0x00080090, 10, 'PN', lambda v: v.upper() if v else v)
+]
+
+ROWS = [
+    ('P1', 'Doe^John', '19660101', '1.2.3', 5, '12', 'CT\\MR', 'Chest',
+     '1.75', 'a\\b', 'Ref^Phys'),
+    ('P22', 'Doe^Jo', None, '1.2.34', 0, ' 7 ', 'DX', '', '1e3', None, None),
+    ('P3', 'Müller^Jürgen', '', '1.2', 12345, '', '', 'Téte', '.5',
+     'odd', 'Dr^Ü'),
+    ('P4', '山田^太郎=やまだ^たろう', '2020', '1.2.3', 1, '-1\\2', 'CT\\',
+     'x' * 63, '1.5 ', 'Text', None),
+]
+
+
+@pytest.mark.parametrize('is_implicit_VR', [True, False])
+@pytest.mark.parametrize('encoding', [
+    'ISO_IR 100', 'ISO_IR 192', 'ISO-IR 6',
+    ['ISO 2022 IR 6', 'ISO 2022 IR 87'],
+    'ISO 2022 IR 6\\ISO 2022 IR 87'
+])
+def test_identical_to_pydicom(is_implicit_VR, encoding):
+    response_encoder = encoder.ResponseEncoder(
+        RESPONSE_ATTRS, encoding, is_implicit_VR
+    )
+    for row in ROWS:
+        if encoding in ('ISO_IR 100', 'ISO-IR 6') and row[0] == 'P4':
+            # Not representable in these character sets
+            continue
+        rsp = pacs._encode_response(row, RESPONSE_ATTRS, encoding)
+        expected = dsutils.encode(rsp, is_implicit_VR, True)
+        assert response_encoder.encode(row) == expected
+
+
+def test_big_endian_not_supported():
+    with pytest.raises(ValueError):
+        encoder.ResponseEncoder(RESPONSE_ATTRS, 'ISO_IR 100', False, False)
+
+
+@pytest.fixture
+def pacs_srv():
+    bus = event_bus.EventBus()
+    db.Database(bus, {})
+    _pacs_srv = pacs.PACS(bus, {})
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    for i, name in enumerate(['Doe^John', 'Doe^Jane', 'Smith^Anna']):
+        ds = Dataset()
+        ds.SpecificCharacterSet = 'ISO_IR 100'
+        ds.PatientID = f'P{i}'
+        ds.PatientName = name
+        ds.StudyInstanceUID = f'1.2.{i}'
+        ds.StudyDate = f'2020010{i + 1}'
+        ds.SeriesInstanceUID = f'1.2.{i}.1'
+        ds.SeriesNumber = str(i + 1)
+        ds.Modality = 'CT'
+        ds.SOPInstanceUID = f'1.2.{i}.1.1'
+        ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+        _pacs_srv.c_store(ds)
+    return _pacs_srv
+
+
+@pytest.mark.parametrize('level,attrs', [
+    ('PATIENT', dict(PatientName='DOE*', PatientID='',
+                     NumberOfPatientRelatedStudies='')),
+    ('STUDY', dict(StudyDate='20200101-', StudyInstanceUID='',
+                   ModalitiesInStudy='', AccessionNumber='',
+                   StudyDescription='')),
+    ('SERIES', dict(Modality='CT', SeriesNumber='', SeriesInstanceUID='',
+                    NumberOfSeriesRelatedInstances='', PatientName=''))
+])
+@pytest.mark.parametrize('is_implicit_VR', [True, False])
+def test_find_encoded(pacs_srv: pacs.PACS, level, attrs, is_implicit_VR):
+    request = Dataset()
+    request.QueryRetrieveLevel = level
+    request.SpecificCharacterSet = 'ISO_IR 100'
+    for name, value in attrs.items():
+        setattr(request, name, value)
+    expected = [
+        dsutils.encode(rsp, is_implicit_VR, True)
+        for rsp in pacs_srv.c_find(request)
+    ]
+    assert expected
+    assert list(pacs_srv.c_find_encoded(request, is_implicit_VR)) == expected
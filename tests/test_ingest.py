@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import collections
+import io
+
+import pydicom
+import pytest
+
+from pydicom import uid
+from pynetdicom2 import applicationentity
+from pynetdicom2 import asceprovider
+from pynetdicom2 import dsutils
+
+from tiny_pacs import ingest
+
+
+@pytest.fixture
+def ingest_ctx():
+    ts = uid.ImplicitVRLittleEndian
+    ctx = asceprovider.PContextDef(1, '1.2.3', ts)
+    cmd_ds = pydicom.Dataset()
+    cmd_ds.AffectedSOPClassUID = '1.2.3'
+    cmd_ds.AffectedSOPInstanceUID = '1.2.3.4'
+    fp = io.BytesIO()
+    applicationentity.write_meta(fp, cmd_ds, ts)
+    ds = pydicom.Dataset()
+    ds.PatientName = 'Test^Test'
+    ds.SOPInstanceUID = '1.2.3.4'
+    ds.SOPClassUID = '1.2.3'
+    fp.write(dsutils.encode(ds, ts.is_implicit_VR, ts.is_little_endian))
+    fp.seek(0)
+    return ingest.IngestContext(ctx, fp)
+
+
+def test_header_parsed_once(ingest_ctx: ingest.IngestContext):
+    header = ingest_ctx.header
+    assert header.PatientName == 'Test^Test'
+    assert ingest_ctx.fp.tell() == 0
+    assert ingest_ctx.header is header
+
+
+def test_sop_instance_uid_from_meta(ingest_ctx: ingest.IngestContext):
+    assert ingest_ctx.sop_instance_uid == '1.2.3.4'
+    assert ingest_ctx.fp.tell() == 0
+
+
+def test_index_writer_flush_waits_for_retries():
+    written = []
+    attempts = collections.Counter()
+
+    def handler(batch):
+        for item in batch:
+            attempts[item] += 1
+            if item == 'a' and attempts[item] < 3:
+                writer.retry(item)
+            else:
+                written.append(item)
+
+    writer = ingest.IndexWriter(handler, interval=10)
+    writer.start()
+    try:
+        writer.put('a')
+        writer.put('b')
+        assert writer.flush(5)
+        assert written == ['b', 'a']
+        assert attempts['a'] == 3
+        assert not len(writer)
+    finally:
+        writer.stop()
@@ -117,3 +117,86 @@ def test_full_cycle(pacs: server.Server, pacs_client: client.DICOMClient, test_d
         move_request.SeriesInstanceUID = test_ds.SeriesInstanceUID
         move_request.SOPInstanceUID = test_ds.SOPInstanceUID
         pacs_client.move(move_request)
+
+
+@pytest.fixture
+def file_pacs(tmp_path):
+    conf = config.Config()
+    conf.update_config({
+        'ae': {'port': 11113}
+    })
+    conf['components'] = {
+        'Database': {'on': True},
+        'Devices': {'on': True},
+        'PACS': {'on': True},
+        'FileStorage': {'on': True, 'storage_dir': str(tmp_path / 'storage')}
+    }
+    _pacs = server.Server(conf)
+    _pacs.start()
+    yield _pacs
+    _pacs.exit()
+
+
+def test_move_large_file(file_pacs: server.Server,
+                         pacs_client: client.DICOMClient,
+                         test_ds: pydicom.Dataset, tmp_path):
+    test_ds.SOPClassUID = uids.ENCAPSULATED_PDF_STORAGE
+    test_ds.EncapsulatedDocument = bytes(range(256)) * 20000
+    file_name = str(tmp_path / 'large.dcm')
+    test_ds.file_meta = pydicom.dataset.FileMetaDataset()
+    test_ds.file_meta.TransferSyntaxUID = uid.ImplicitVRLittleEndian
+    test_ds.is_implicit_VR = True
+    test_ds.is_little_endian = True
+    pydicom.dcmwrite(file_name, test_ds, write_like_original=False)
+    # Stored file is sent by memory mapped storage SCU
+    pacs_client.store(file_name)
+
+    ae = CStoreAE(test_ds, 'TEST_CLIENT', 11112)
+    ae.add_scp(sopclass.storage_scp)
+    received = []
+
+    def on_receive_store(context, ds):
+        received.append(pydicom.dcmread(ds))
+        return statuses.SUCCESS
+    ae.on_receive_store = on_receive_store
+    with ae:
+        move_request = pydicom.Dataset()
+        move_request.QueryRetrieveLevel = 'IMAGE'
+        move_request.StudyInstanceUID = test_ds.StudyInstanceUID
+        move_request.SeriesInstanceUID = test_ds.SeriesInstanceUID
+        move_request.SOPInstanceUID = test_ds.SOPInstanceUID
+        pacs_client.move(move_request)
+    d, = received
+    assert d.SOPInstanceUID == test_ds.SOPInstanceUID
+    assert d.EncapsulatedDocument == test_ds.EncapsulatedDocument
+
+
+def test_parallel_move(pacs: server.Server, pacs_client: client.DICOMClient,
+                       test_ds: pydicom.Dataset):
+    pacs.ae.move_associations = 3
+    for _ in range(6):
+        test_ds.SOPInstanceUID = uid.generate_uid()
+        pacs_client.store(test_ds, uids.BASIC_TEXT_SR_STORAGE,
+                          uid.ImplicitVRLittleEndian)
+
+    ae = CStoreAE(test_ds, 'TEST_CLIENT', 11112)
+    ae.add_scp(sopclass.storage_scp)
+    received = []
+    associations = []
+
+    def on_receive_store(context, ds):
+        received.append(pydicom.dcmread(ds).SOPInstanceUID)
+        return statuses.SUCCESS
+
+    def on_association_request(asce, assoc):
+        associations.append(assoc)
+    ae.on_receive_store = on_receive_store
+    ae.on_association_request = on_association_request
+    with ae:
+        move_request = pydicom.Dataset()
+        move_request.QueryRetrieveLevel = 'SERIES'
+        move_request.StudyInstanceUID = test_ds.StudyInstanceUID
+        move_request.SeriesInstanceUID = test_ds.SeriesInstanceUID
+        pacs_client.move(move_request)
+    assert len(received) == 6
+    assert len(associations) == 3
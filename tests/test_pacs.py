@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
+import peewee
 import pytest
 
 from pydicom import Dataset
-
+from pydicom.uid import ImplicitVRLittleEndian
+from pynetdicom2.asceprovider import PContextDef
+from pynetdicom2 import dsutils
+from pynetdicom2 import statuses
+from pynetdicom2 import uids
+
+from tiny_pacs import ae
+from tiny_pacs import cache
 from tiny_pacs import db
 from tiny_pacs import event_bus
+from tiny_pacs import ingest
 from tiny_pacs import pacs
+from tiny_pacs import storage
 
 
 @pytest.fixture
@@ -80,6 +90,7 @@ def pacs_srv():
             sop_instance_uid='1.2.3.5.6.6',
             sop_class_uid='2.3.7'
         )
+    _pacs_srv.refresh_counters()
     return _pacs_srv
 
 
@@ -127,6 +138,51 @@ def test_patient_find_text_filter_negative(pacs_srv: pacs.PACS):
     assert not list(pacs_srv.c_find(request))
 
 
+@pytest.mark.parametrize('patient_name', [
+    'test^test^test', 'TEST*', 'te?t^*', '*^TEST', 'Test^Test^Test^^'
+])
+def test_patient_find_name_matching(pacs_srv: pacs.PACS, patient_name):
+    request = Dataset()
+    request.QueryRetrieveLevel = 'PATIENT'
+    request.PatientName = patient_name
+    results = list(pacs_srv.c_find(request))
+    assert len(results) == 1
+    assert results[0].PatientName == 'Test^Test^Test'
+
+
+def test_patient_find_name_prefix_uses_index(pacs_srv: pacs.PACS):
+    request = Dataset()
+    request.QueryRetrieveLevel = 'PATIENT'
+    request.PatientName = 'Te*'
+    key, values = pacs.find_key(pacs.Patient, request)
+    plan = pacs.FindPlan.compile(pacs.Patient, key)
+    params = plan.bind(values)
+    assert 'LIKE' not in plan.sql
+    assert params == ['TE', 'TF']
+    rows = db.DB.execute_sql('EXPLAIN QUERY PLAN ' + plan.sql, params)
+    assert 'patient_patient_name_search' in ' '.join(str(r) for r in rows)
+
+
+def test_patient_find_name_prefix_postgres(monkeypatch):
+    postgres = peewee.PostgresqlDatabase('pacs')
+    monkeypatch.setattr(db.DB, 'obj', postgres)
+    request = Dataset()
+    request.QueryRetrieveLevel = 'PATIENT'
+    request.PatientName = 'Te*'
+    key, _ = pacs.find_key(pacs.Patient, request)
+    plan = pacs.FindPlan.compile(pacs.Patient, key)
+    # Range is compared character by character, regardless of collation
+    assert '"patient_name_search" ~>=~ ' in plan.sql
+    assert '"patient_name_search" ~<~ ' in plan.sql
+
+    statements = []
+    monkeypatch.setattr(postgres, 'execute_sql', statements.append)
+    pacs.PACS(event_bus.EventBus(), {}).create_pattern_indexes()
+    assert 'CREATE INDEX IF NOT EXISTS patient_patient_name_search_pattern '\
+        'ON patient USING btree (patient_name_search varchar_pattern_ops)' \
+        in statements
+
+
 def test_patient_find_date_single_positive(pacs_srv: pacs.PACS):
     request = Dataset()
     request.PatientName = None
@@ -262,3 +318,581 @@ def test_store(pacs_srv: pacs.PACS):
     request.Modality = None
     results = list(pacs_srv.c_find(request))
     assert len(results) == 1
+
+
+def _store_ds(sop_instance_uid):
+    ds = Dataset()
+    ds.SpecificCharacterSet = 'ISO_IR 192'
+    ds.PatientID = 'test_id'
+    ds.PatientName = 'Store^Store^Stor'
+    ds.PatientBirthDate = '19800101'
+    ds.StudyInstanceUID = '1.2.5'
+    ds.StudyDate = '20200301'
+    ds.SeriesInstanceUID = '1.2.5.6'
+    ds.Modality = 'CT'
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.SOPClassUID = '2.3.4'
+    return ds
+
+
+def test_store_lookup_cache(pacs_srv: pacs.PACS):
+    pacs_srv.c_store(_store_ds('1.2.5.6.1'))
+    stats = pacs_srv.lookup_cache.stats()
+    assert stats['hits'] == 0
+    assert stats['size'] == 3
+
+    pacs_srv.c_store(_store_ds('1.2.5.6.2'))
+    stats = pacs_srv.lookup_cache.stats()
+    assert stats['hits'] == 3
+    assert pacs.Instance.select().join(pacs.Series)\
+        .where(pacs.Series.series_instance_uid == '1.2.5.6').count() == 2
+
+
+def test_store_lookup_cache_rollback(pacs_srv: pacs.PACS):
+    ds = _store_ds('1.2.5.6.1')
+    del ds.SeriesInstanceUID
+    with pytest.raises(AttributeError):
+        pacs_srv.c_store(ds)
+    assert not len(pacs_srv.lookup_cache)
+    assert not pacs.Study.select()\
+        .where(pacs.Study.study_instance_uid == '1.2.5').count()
+
+
+def test_delete_instances(pacs_srv: pacs.PACS):
+    pacs_srv.c_store(_store_ds('1.2.5.6.1'))
+    pacs_srv.c_store(_store_ds('1.2.5.6.2'))
+
+    assert pacs_srv.delete_instances(['1.2.5.6.1']) == 1
+    assert len(pacs_srv.lookup_cache) == 3
+
+    assert pacs_srv.delete_instances(['1.2.5.6.2']) == 1
+    assert not len(pacs_srv.lookup_cache)
+    assert not pacs.Patient.select()\
+        .where(pacs.Patient.patient_id == 'test_id').count()
+
+    pacs_srv.c_store(_store_ds('1.2.5.6.1'))
+    assert pacs.Series.get(pacs.Series.series_instance_uid == '1.2.5.6')
+
+
+def test_store_locks_parents(pacs_srv: pacs.PACS, monkeypatch):
+    locks = []
+    execute_sql = db.DB.obj.execute_sql
+    def _execute_sql(sql, *args, **kwargs):
+        if 'FOR UPDATE' in sql:
+            # SQLite can't lock rows, only statements are checked
+            locks.append(sql)
+            sql, args = 'SELECT 1 WHERE 0', ()
+        return execute_sql(sql, *args, **kwargs)
+    monkeypatch.setattr(db.DB.obj, 'execute_sql', _execute_sql)
+    monkeypatch.setattr(db.DB.obj, 'for_update', True)
+
+    pacs_srv.c_store_many([_store_ds('1.2.5.6.1'), _store_ds('1.2.5.6.2')])
+    assert len(locks) == 2
+    assert locks[0].startswith('SELECT "t1"."id" FROM "study"')
+    assert locks[1].startswith('SELECT "t1"."id" FROM "series"')
+    study = pacs.Study.get(pacs.Study.study_instance_uid == '1.2.5')
+    assert study.number_of_study_related_instances == 2
+    assert study.number_of_study_related_series == 1
+
+
+def test_store_concurrent_instance_not_counted(pacs_srv: pacs.PACS,
+                                               monkeypatch):
+    pacs_srv.c_store(_store_ds('1.2.5.6.1'))
+    # Instance is inserted by another transaction after the lookup
+    monkeypatch.setattr(pacs, '_select_by', lambda field, values: iter(()))
+    with pytest.raises(peewee.IntegrityError):
+        pacs_srv.c_store(_store_ds('1.2.5.6.1'))
+    series = pacs.Series.get(pacs.Series.series_instance_uid == '1.2.5.6')
+    assert series.number_of_series_related_instances == 1
+
+
+def test_store_counts_returned_instances(pacs_srv: pacs.PACS, monkeypatch):
+    monkeypatch.setattr(db.DB.obj, 'returning_clause', True)
+    pacs_srv.c_store_many([_store_ds('1.2.5.6.1'), _store_ds('1.2.5.6.2')])
+    pacs_srv.lookup_cache.clear()
+    pacs_srv.c_store_many([_store_ds('1.2.5.6.2'), _store_ds('1.2.5.6.3')])
+    series = pacs.Series.get(pacs.Series.series_instance_uid == '1.2.5.6')
+    assert series.number_of_series_related_instances == 3
+    study = pacs.Study.get(pacs.Study.study_instance_uid == '1.2.5')
+    assert study.number_of_study_related_series == 1
+
+
+def test_store_replaced_instance(cached_srv: pacs.PACS):
+    ds = _store_ds('1.2.5.6.1')
+    ds.file_meta = Dataset()
+    ds.file_meta.TransferSyntaxUID = '1.2.840.10008.1.2'
+    cached_srv.c_store(ds)
+    request = Dataset()
+    request.QueryRetrieveLevel = 'IMAGE'
+    request.SOPInstanceUID = '1.2.5.6.1'
+    request.TransferSyntaxUID = None
+    result, = cached_srv.c_find(request)
+    assert result.TransferSyntaxUID == '1.2.840.10008.1.2'
+
+    ds.file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    ds.InstanceNumber = '2'
+    cached_srv.c_store(ds)
+    instance = pacs.Instance.get(pacs.Instance.sop_instance_uid == '1.2.5.6.1')
+    assert instance.transfer_syntax_uid == '1.2.840.10008.1.2.1'
+    assert instance.instance_number == '2'
+    result, = cached_srv.c_find(request)
+    assert result.TransferSyntaxUID == '1.2.840.10008.1.2.1'
+    series = pacs.Series.get(pacs.Series.series_instance_uid == '1.2.5.6')
+    assert series.number_of_series_related_instances == 1
+
+
+def test_delete_then_store_again():
+    bus = event_bus.EventBus()
+    db.Database(bus, {})
+    pacs_srv = pacs.PACS(bus, {})
+    _storage = storage.InMemoryStorage(bus, {})
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+
+    def _receive(uid):
+        ctx = PContextDef(1, '2.3.4', ImplicitVRLittleEndian)
+        cmd = Dataset()
+        cmd.AffectedSOPClassUID = '2.3.4'
+        cmd.AffectedSOPInstanceUID = uid
+        fp, start = bus.send_one(ae.AEChannels.ON_GET_FILE, ctx, cmd)
+        # Duplicates are discarded by storage
+        assert not isinstance(fp, ingest.DiscardedDataset)
+        fp.write(dsutils.encode(_store_ds(uid), True, True))
+        fp.seek(start)
+        status, = bus.broadcast(ae.AEChannels.STORE, ctx,
+                                ingest.IngestContext(ctx, fp))
+        return status
+
+    request = Dataset()
+    request.QueryRetrieveLevel = 'IMAGE'
+    request.SOPInstanceUID = '1.2.5.6.1'
+    try:
+        assert _receive('1.2.5.6.1') == statuses.SUCCESS
+        assert pacs_srv.delete_instances(['1.2.5.6.1']) == 1
+        assert not _storage.is_known('1.2.5.6.1')
+        assert not list(pacs_srv.c_find(request))
+
+        assert _receive('1.2.5.6.1') == statuses.SUCCESS
+        assert len(list(pacs_srv.c_find(request))) == 1
+        assert len(list(_storage.on_store_get_files(['1.2.5.6.1']))) == 1
+    finally:
+        bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def test_write_behind_store():
+    bus = event_bus.EventBus()
+    db.Database(bus, {})
+    pacs_srv = pacs.PACS(bus, {'write_behind': {'on': True, 'interval': 10}})
+    done = []
+    bus.subscribe(storage.StorageChannels.ON_STORE_DONE, done.append)
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    try:
+        for uid in ('1.2.5.6.1', '1.2.5.6.2'):
+            ingest_ctx = ingest.IngestContext(None, None, _store_ds(uid))
+            assert pacs_srv.on_store(None, ingest_ctx) == statuses.SUCCESS
+
+        request = Dataset()
+        request.QueryRetrieveLevel = 'IMAGE'
+        request.SOPInstanceUID = None
+        results = list(pacs_srv.c_find(request))
+        assert len(results) == 2
+        assert len(done) == 2
+    finally:
+        bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def test_write_behind_failure_quarantined(monkeypatch):
+    bus = event_bus.EventBus()
+    db.Database(bus, {})
+    pacs_srv = pacs.PACS(bus, {
+        'write_behind': {'on': True, 'interval': 10, 'attempts': 2}
+    })
+    done, failed, quarantined = [], [], []
+    bus.subscribe(storage.StorageChannels.ON_STORE_DONE, done.append)
+    bus.subscribe(storage.StorageChannels.ON_STORE_FAILURE, failed.append)
+    bus.subscribe(storage.StorageChannels.ON_STORE_QUARANTINE,
+                  quarantined.append)
+
+    _c_store = pacs_srv._c_store
+    def _failing_c_store(datasets, *args):
+        changed = _c_store(datasets, *args)
+        if any(ds.SOPInstanceUID == '1.2.5.6.2' for ds in datasets):
+            raise RuntimeError('Broken dataset')
+        return changed
+    monkeypatch.setattr(pacs_srv, '_c_store', _failing_c_store)
+
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    try:
+        for uid in ('1.2.5.6.1', '1.2.5.6.2'):
+            ingest_ctx = ingest.IngestContext(None, None, _store_ds(uid))
+            assert pacs_srv.on_store(None, ingest_ctx) == statuses.SUCCESS
+        # Flush waits for retries as well
+        pacs_srv.flush_index()
+        # Batch was rolled back, only dataset indexed on retry is done
+        assert [c.sop_instance_uid for c in done] == ['1.2.5.6.1']
+        assert not failed
+        assert [c.sop_instance_uid for c in quarantined] == ['1.2.5.6.2']
+        assert quarantined[0].attempts == 2
+        assert [i.sop_instance_uid for i in pacs.Instance.select()] == \
+            ['1.2.5.6.1']
+    finally:
+        bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def test_image_find_flat_rows(pacs_srv: pacs.PACS, monkeypatch):
+    for i in range(10):
+        pacs_srv.c_store(_store_ds(f'1.2.5.6.{i}'))
+
+    queries = []
+    execute_sql = db.DB.obj.execute_sql
+    def _execute_sql(sql, *args, **kwargs):
+        queries.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+    monkeypatch.setattr(db.DB.obj, 'execute_sql', _execute_sql)
+
+    request = Dataset()
+    request.QueryRetrieveLevel = 'IMAGE'
+    request.PatientID = 'test_id'
+    request.PatientName = None
+    request.StudyDate = None
+    request.Modality = 'CT'
+    request.SOPInstanceUID = None
+    results = list(pacs_srv.c_find(request))
+    assert len(results) == 10
+    assert all(r.PatientName == 'Store^Store^Stor' for r in results)
+    assert all(r.StudyDate == '20200301' for r in results)
+    assert len(queries) == 1
+    assert 'COUNT' not in queries[0]
+
+
+def test_store_counters(pacs_srv: pacs.PACS):
+    pacs_srv.c_store(_store_ds('1.2.5.6.1'))
+    pacs_srv.c_store(_store_ds('1.2.5.6.1'))
+    ds = _store_ds('1.2.5.6.2')
+    ds.SeriesInstanceUID = '1.2.5.7'
+    ds.Modality = 'MR'
+    ds.SOPClassUID = '2.3.5'
+    pacs_srv.c_store(ds)
+
+    request = Dataset()
+    request.QueryRetrieveLevel = 'STUDY'
+    request.StudyInstanceUID = '1.2.5'
+    request.ModalitiesInStudy = None
+    request.SOPClassesInStudy = None
+    request.NumberOfStudyRelatedSeries = None
+    request.NumberOfStudyRelatedInstances = None
+    result, = pacs_srv.c_find(request)
+    assert result.ModalitiesInStudy == ['CT', 'MR']
+    assert result.SOPClassesInStudy == ['2.3.4', '2.3.5']
+    assert result.NumberOfStudyRelatedSeries == 2
+    assert result.NumberOfStudyRelatedInstances == 2
+
+    pacs_srv.delete_instances(['1.2.5.6.2'])
+    result, = pacs_srv.c_find(request)
+    assert result.ModalitiesInStudy == 'CT'
+    assert result.SOPClassesInStudy == '2.3.4'
+    assert result.NumberOfStudyRelatedSeries == 1
+    assert result.NumberOfStudyRelatedInstances == 1
+
+    request = Dataset()
+    request.QueryRetrieveLevel = 'PATIENT'
+    request.PatientID = 'test_id'
+    request.NumberOfPatientRelatedStudies = None
+    request.NumberOfPatientRelatedSeries = None
+    request.NumberOfPatientRelatedInstances = None
+    result, = pacs_srv.c_find(request)
+    assert result.NumberOfPatientRelatedStudies == 1
+    assert result.NumberOfPatientRelatedSeries == 1
+    assert result.NumberOfPatientRelatedInstances == 1
+
+
+def test_find_plan_cache(pacs_srv: pacs.PACS):
+    for patient_name in ('Test*', 'Other*', 'Test^Test^Test'):
+        request = Dataset()
+        request.QueryRetrieveLevel = 'STUDY'
+        request.PatientName = patient_name
+        request.StudyDate = '20200101-20200101'
+        request.AccessionNumber = None
+        request.ModalitiesInStudy = None
+        results = list(pacs_srv.c_find(request))
+
+    stats = pacs_srv.plan_cache.stats()
+    assert stats['size'] == 2
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+    assert len(results) == 1
+    assert results[0].AccessionNumber == '1234'
+    assert results[0].ModalitiesInStudy == ['DX', 'SR']
+
+
+@pytest.mark.parametrize('study_date,study_time,count', [
+    ('20200101', None, 1),
+    ('2020.01.01', None, 1),
+    ('-20200101', None, 1),
+    ('20200101-', None, 2),
+    ('20191231-20200102', None, 1),
+    ('20200101', '10', 1),
+    ('20200101', '1030-', 1),
+    ('20200101', '11-', 0),
+    ('20200101-', '1030-1000', 2),
+    ('20200101-', '1100-1000', 1),
+    ('20200101-20200101', '1100-', 0),
+])
+def test_study_find_date_time(pacs_srv: pacs.PACS, study_date, study_time,
+                              count):
+    with db.DB.atomic():
+        study = pacs.Study.get(pacs.Study.study_instance_uid == '1.2.3.4')
+        study.study_time = '103015.5'
+        study.save()
+
+    request = Dataset()
+    request.QueryRetrieveLevel = 'STUDY'
+    request.StudyDate = study_date
+    request.StudyTime = study_time
+    results = list(pacs_srv.c_find(request))
+    assert len(results) == count
+
+
+def test_numeric_value():
+    assert pacs.numeric_value('20200101', 'DA') == 20200101
+    assert pacs.numeric_value('10', 'TM') == 100000000000
+    assert pacs.numeric_value('10', 'TM', upper=True) == 105959999999
+    assert pacs.numeric_value('10:30:15.5', 'TM') == 103015500000
+    assert pacs.date_time_value('20200101', '', upper=True) == 20200101235959
+    assert pacs.numeric_value('2020', 'DA') == 20200101
+    assert pacs.numeric_value('2020', 'DA', upper=True) == 20201231
+    assert pacs.numeric_value('202002', 'DA', upper=True) == 20200231
+    assert pacs.date_time_value('2020', '', upper=True) == 20201231235959
+    with pytest.raises(ValueError):
+        pacs.numeric_value('2020*', 'DA')
+
+
+def test_store_many(pacs_srv: pacs.PACS, monkeypatch):
+    queries = []
+    execute_sql = db.DB.obj.execute_sql
+    def _execute_sql(sql, *args, **kwargs):
+        queries.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+    monkeypatch.setattr(db.DB.obj, 'execute_sql', _execute_sql)
+
+    datasets = [_store_ds(f'1.2.5.6.{i}') for i in range(50)]
+    pacs_srv.c_store_many(datasets + datasets[:10])
+    assert len(queries) < 15
+
+    pacs_srv.c_store_many(datasets)
+    series = pacs.Series.get(pacs.Series.series_instance_uid == '1.2.5.6')
+    assert series.number_of_series_related_instances == 50
+    assert pacs.Patient.get(pacs.Patient.patient_id == 'test_id')\
+        .number_of_patient_related_instances == 50
+
+
+def test_store_many_patient_conflict(pacs_srv: pacs.PACS):
+    ds = _store_ds('1.2.5.6.1')
+    ds.PatientID = 'test1'
+    with pytest.raises(peewee.IntegrityError):
+        pacs_srv.c_store_many([ds])
+    assert not pacs.Study.select()\
+        .where(pacs.Study.study_instance_uid == '1.2.5').count()
+
+
+@pytest.fixture
+def cached_srv(pacs_srv: pacs.PACS):
+    pacs_srv.find_cache = cache.LRUCache(16, 30)
+    pacs_srv.find_cache_max_results = 10
+    return pacs_srv
+
+
+def _study_request(**attrs):
+    request = Dataset()
+    request.QueryRetrieveLevel = 'STUDY'
+    request.StudyInstanceUID = None
+    request.NumberOfStudyRelatedInstances = None
+    for name, value in attrs.items():
+        setattr(request, name, value)
+    return request
+
+
+def test_find_cache_hit(cached_srv: pacs.PACS, monkeypatch):
+    request = _study_request(PatientName='Test*')
+    first = list(cached_srv.c_find(request))
+
+    def _execute_sql(*args, **kwargs):
+        raise AssertionError('Unexpected query')
+    monkeypatch.setattr(db.DB.obj, 'execute_sql', _execute_sql)
+    assert list(map(str, cached_srv.c_find(request))) == \
+        list(map(str, first))
+    stats = cached_srv.find_cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+
+def test_find_cache_encoding_in_key(cached_srv: pacs.PACS):
+    list(cached_srv.c_find(_study_request(PatientName='Test*')))
+    request = _study_request(PatientName='Test*')
+    request.SpecificCharacterSet = 'ISO_IR 192'
+    result = list(cached_srv.c_find(request))
+    assert result[0].SpecificCharacterSet == 'ISO_IR 192'
+    assert len(cached_srv.find_cache) == 2
+
+
+def test_find_cache_selective_invalidation(cached_srv: pacs.PACS):
+    test_patient = _study_request(PatientName='Test*')
+    new_patient = _study_request(PatientName='Store*')
+    all_studies = _study_request()
+    assert len(list(cached_srv.c_find(test_patient))) == 2
+    assert not list(cached_srv.c_find(new_patient))
+    assert len(list(cached_srv.c_find(all_studies))) == 2
+
+    cached_srv.c_store(_store_ds('1.2.5.6.1'))
+    assert len(cached_srv.find_cache) == 1
+    assert len(list(cached_srv.c_find(test_patient))) == 2
+    assert len(list(cached_srv.c_find(new_patient))) == 1
+    assert len(list(cached_srv.c_find(all_studies))) == 3
+
+    # Counters of the found study are updated
+    cached_srv.c_store(_store_ds('1.2.5.6.2'))
+    result, = cached_srv.c_find(new_patient)
+    assert result.NumberOfStudyRelatedInstances == 2
+    assert cached_srv.find_cache.stats()['invalidations'] == 4
+
+
+def test_find_cache_parent_filter(cached_srv: pacs.PACS):
+    request = Dataset()
+    request.QueryRetrieveLevel = 'SERIES'
+    request.StudyDate = '20200301'
+    request.SeriesInstanceUID = None
+    cached_srv.c_store(_store_ds('1.2.5.6.1'))
+    assert len(list(cached_srv.c_find(request))) == 1
+
+    # Study is already stored, its date is matched
+    ds = _store_ds('1.2.5.7.1')
+    ds.SeriesInstanceUID = '1.2.5.7'
+    del ds.StudyDate
+    cached_srv.c_store(ds)
+    assert len(list(cached_srv.c_find(request))) == 2
+
+
+def test_find_cache_max_results(cached_srv: pacs.PACS):
+    cached_srv.find_cache_max_results = 1
+    assert len(list(cached_srv.c_find(_study_request()))) == 2
+    assert not len(cached_srv.find_cache)
+
+
+def test_find_cache_cleared_on_delete(cached_srv: pacs.PACS):
+    request = _study_request()
+    list(cached_srv.c_find(request))
+    cached_srv.delete_instances(['1.2.3.5.5.6', '1.2.3.5.6.6'])
+    assert len(list(cached_srv.c_find(request))) == 1
+
+
+def test_cache_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    lru = cache.LRUCache(2, ttl=10)
+    lru.put('a', 1)
+    assert lru.get('a') == 1
+    now[0] += 10
+    assert lru.get('a') is None
+    stats = lru.stats()
+    assert stats['expirations'] == 1
+    assert stats['hit_ratio'] == 0.5
+
+
+def _find_statuses(pacs_srv, request, calling_ae=None):
+    ctx = PContextDef(1, uids.STUDY_ROOT_FIND_SOP_CLASS,
+                      ImplicitVRLittleEndian)
+    return [status for _, status in
+            pacs_srv.on_find(ctx, request, calling_ae)]
+
+
+def _image_request():
+    request = Dataset()
+    request.QueryRetrieveLevel = 'IMAGE'
+    request.SOPInstanceUID = None
+    return request
+
+
+def test_find_limit_per_level(pacs_srv: pacs.PACS):
+    pacs_srv.find_max_results = {'IMAGE': 3}
+    result = _find_statuses(pacs_srv, _image_request())
+    assert result == [statuses.C_FIND_PENDING] * 3 + \
+        [statuses.C_FIND_OUT_OF_RESOURCES]
+    assert len(_find_statuses(pacs_srv, _study_request())) == 2
+
+
+def test_find_limit_per_ae(pacs_srv: pacs.PACS):
+    pacs_srv.find_max_results = {'IMAGE': 3}
+    pacs_srv.find_ae_max_results = {'VIEWER': 1}
+    result = _find_statuses(pacs_srv, _image_request(), 'VIEWER')
+    assert result == [statuses.C_FIND_PENDING,
+                      statuses.C_FIND_OUT_OF_RESOURCES]
+    assert pacs_srv.find_limit('STUDY', 'VIEWER') == 1
+    assert pacs_srv.find_limit('STUDY', 'OTHER') is None
+
+
+def test_find_timeout(pacs_srv: pacs.PACS, monkeypatch):
+    def c_find_encoded(ds, is_implicit_VR):
+        yield b''
+        raise db.QueryTimeoutError('Query exceeded time limit')
+
+    monkeypatch.setattr(pacs_srv, 'c_find_encoded', c_find_encoded)
+    assert _find_statuses(pacs_srv, _image_request()) == [
+        statuses.C_FIND_PENDING, statuses.C_FIND_UNABLE_TO_PROCESS
+    ]
+
+
+def test_find_partial_date_range(pacs_srv: pacs.PACS):
+    request = _study_request(StudyDate='2020-')
+    assert _find_statuses(pacs_srv, request) == [statuses.C_FIND_PENDING] * 2
+
+
+def test_find_malformed_value(pacs_srv: pacs.PACS):
+    request = _study_request(StudyDate='2020*')
+    assert _find_statuses(pacs_srv, request) == [
+        statuses.C_FIND_UNABLE_TO_PROCESS
+    ]
+
+
+def test_find_with_timeout(pacs_srv: pacs.PACS):
+    pacs_srv.find_timeout = 10
+    assert len(list(pacs_srv.c_find(_image_request()))) == 5
+
+
+def test_move_in_batches(pacs_srv: pacs.PACS):
+    for i in range(7):
+        pacs_srv.c_store(_store_ds(f'1.2.5.6.{i}'))
+    pacs_srv.retrieve_batch_size = 3
+    batches = []
+
+    def get_files(sop_instance_uids):
+        batches.append(sop_instance_uids)
+        return [('2.3.4', ImplicitVRLittleEndian, uid)
+                for uid in sop_instance_uids]
+
+    contexts = set([('2.3.4', ImplicitVRLittleEndian)])
+    pacs_srv.bus.subscribe(storage.StorageChannels.ON_GET_FILES, get_files)
+    pacs_srv.bus.subscribe(storage.StorageChannels.ON_GET_CONTEXTS,
+                           lambda sop_instance_uids: contexts)
+    request = Dataset()
+    request.QueryRetrieveLevel = 'PATIENT'
+    request.PatientID = 'test_id'
+    results = pacs_srv.on_move(None, request, 'REMOTE')
+    assert len(results) == 7
+    assert results.contexts == contexts
+    assert not batches
+
+    results = iter(results)
+    assert next(results)[2] == '1.2.5.6.0'
+    assert len(batches) == 1
+    assert [uid for _, _, uid in results] == [
+        f'1.2.5.6.{i}' for i in range(1, 7)
+    ]
+    assert [len(b) for b in batches] == [3, 3, 1]
+
+
+def test_move_nothing_found(pacs_srv: pacs.PACS):
+    request = Dataset()
+    request.QueryRetrieveLevel = 'STUDY'
+    request.StudyInstanceUID = '1.2.3.404'
+    results = pacs_srv.on_get(None, request)
+    assert len(results) == 0
+    assert not list(results)
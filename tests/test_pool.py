@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+from pydicom import Dataset
+from pydicom import uid
+from pynetdicom2 import applicationentity
+from pynetdicom2 import exceptions
+from pynetdicom2 import sopclass
+from pynetdicom2 import statuses
+from pynetdicom2 import uids
+
+from tiny_pacs import ae
+from tiny_pacs import client
+from tiny_pacs import pool
+
+
+REMOTE_AE = {'aet': 'REMOTE', 'address': '127.0.0.1', 'port': 11121}
+
+
+class RemoteAE(applicationentity.AE):
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__('REMOTE', REMOTE_AE['port'], [
+            uid.ImplicitVRLittleEndian, uid.ExplicitVRLittleEndian
+        ])
+        self.add_scp(sopclass.verification_scp)
+        self.add_scp(sopclass.storage_scp)
+        self.associations = 0
+        self.stored = 0
+
+    def on_association_request(self, asce, assoc):
+        self.associations += 1
+
+    def on_receive_echo(self, context):
+        return statuses.SUCCESS
+
+    def on_receive_store(self, context, ds):
+        self.stored += 1
+        return statuses.SUCCESS
+
+
+@pytest.fixture
+def remote():
+    ae = RemoteAE()
+    with ae:
+        yield ae
+
+
+@pytest.fixture
+def association_pool():
+    _pool = pool.AssociationPool(max_per_destination=2, echo_after=60)
+    yield _pool
+    _pool.close()
+
+
+def _client(association_pool):
+    return client.DICOMClient('LOCAL', REMOTE_AE, association_pool)
+
+
+def _store(dicom_client, ts):
+    ds = Dataset()
+    ds.SOPClassUID = uids.CT_IMAGE_STORAGE
+    ds.SOPInstanceUID = '1.2.3.4'
+    dicom_client.store(ds, uids.CT_IMAGE_STORAGE, ts)
+
+
+def test_reuse(remote, association_pool):
+    for _ in range(3):
+        _client(association_pool).echo()
+    assert remote.associations == 1
+    stats = association_pool.stats()
+    assert stats['created'] == 1
+    assert stats['reused'] == 2
+    assert stats['idle'] == 1
+
+
+def test_new_context_renegotiated(remote, association_pool):
+    dicom_client = _client(association_pool)
+    dicom_client.echo()
+    _store(dicom_client, uid.ImplicitVRLittleEndian)
+    _store(dicom_client, uid.ImplicitVRLittleEndian)
+    _store(dicom_client, uid.ExplicitVRLittleEndian)
+    assert remote.stored == 3
+    assert remote.associations == 3
+    stats = association_pool.stats()
+    assert stats['reused'] == 1
+    # Limit is reached, association without contexts is replaced
+    assert stats['renegotiated'] == 1
+    assert stats['idle'] == 2
+
+
+def test_max_per_destination(remote, association_pool):
+    client_ae = applicationentity.ClientAE('LOCAL')
+    client_ae.add_scu(sopclass.verification_scu)
+    acquired = []
+
+    def acquire():
+        with association_pool.association(client_ae, REMOTE_AE):
+            acquired.append(time.monotonic())
+            time.sleep(0.2)
+
+    threads = [threading.Thread(target=acquire) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    acquired.sort()
+    assert acquired[2] - acquired[0] >= 0.2
+    assert remote.associations == 2
+
+
+def test_failed_health_check(remote, monkeypatch):
+    association_pool = pool.AssociationPool(echo_after=0)
+    _client(association_pool).echo()
+
+    def verification_scu(*args):
+        raise exceptions.AssociationAbortedError(2, 0)
+    monkeypatch.setattr(sopclass, 'verification_scu', verification_scu)
+    with association_pool.association(_client(association_pool).aet,
+                                      REMOTE_AE):
+        pass
+    assert remote.associations == 2
+    assert association_pool.stats()['failed_checks'] == 1
+    association_pool.close()
+
+
+def test_idle_timeout(remote):
+    association_pool = pool.AssociationPool(idle_timeout=0)
+    _client(association_pool).echo()
+    _client(association_pool).echo()
+    assert remote.associations == 2
+    assert association_pool.stats()['expired'] >= 1
+    association_pool.close()
+
+
+def test_idle_released_in_background(remote):
+    association_pool = pool.AssociationPool(idle_timeout=0.2)
+    _client(association_pool).echo()
+    assert association_pool.stats()['idle'] == 1
+    time.sleep(0.5)
+    stats = association_pool.stats()
+    assert stats['idle'] == 0
+    assert stats['expired'] == 1
+    association_pool.close()
+
+
+def test_pool_off_by_default():
+    assert ae.new_pool({}) is None
+    assert ae.new_pool({'on': True}) is not None
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import queue
+import time
+
+import pytest
+
+from pydicom import Dataset
+from pydicom import dcmwrite
+from pydicom.dataset import FileMetaDataset
+from pydicom.errors import InvalidDicomError
+from pydicom.uid import ImplicitVRLittleEndian
+from pynetdicom2 import asceprovider
+from pynetdicom2 import dimsemessages
+from pynetdicom2 import dsutils
+from pynetdicom2 import exceptions
+from pynetdicom2 import pdu
+from pynetdicom2 import statuses
+from pynetdicom2 import uids
+
+from tiny_pacs import services
+
+
+class FakeDUL:
+    def __init__(self):
+        self.to_service_user = queue.Queue()
+
+    def receive(self, timeout):
+        return self.to_service_user.get_nowait()
+
+
+class FakeAssociation:
+    def __init__(self, results):
+        self.dul = FakeDUL()
+        self.ae = self
+        self.remote_ae = 'CALLING_AE  '
+        self.timeout = 1
+        self.results = results
+        self.sent = []
+        self.incoming = []
+        self.closed = False
+        self.calling_ae = None
+
+    def on_receive_find(self, ctx, ds, calling_ae):
+        self.calling_ae = calling_ae
+        try:
+            for i, result in enumerate(self.results):
+                if i == 2:
+                    # Request arrives while matching
+                    for primitive in self.incoming:
+                        self.dul.to_service_user.put(primitive)
+                yield result
+        finally:
+            self.closed = True
+
+    def get_dul_message(self):
+        return asceprovider.Association.get_dul_message(self)
+
+    def send(self, msg, pc_id):
+        self.sent.append((int(msg.status), msg.data_set))
+
+
+def _message_pdus(msg):
+    msg.set_length()
+    return list(msg.encode(1, 16000))
+
+
+def _cancel(message_id):
+    msg = dimsemessages.CCancelRQMessage()
+    msg.message_id_being_responded_to = message_id
+    return _message_pdus(msg)
+
+def _request():
+    ctx = asceprovider.PContextDef(1, uids.STUDY_ROOT_FIND_SOP_CLASS,
+                                   ImplicitVRLittleEndian)
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'STUDY'
+    msg = dimsemessages.CFindRQMessage()
+    msg.message_id = 1
+    msg.sop_class_uid = uids.STUDY_ROOT_FIND_SOP_CLASS
+    msg.data_set = dsutils.encode(ds, True, True)
+    return ctx, msg
+
+
+def _result(uid):
+    ds = Dataset()
+    ds.StudyInstanceUID = uid
+    return ds
+
+
+def test_find_encoded_and_datasets():
+    encoded = dsutils.encode(_result('1.2.3'), True, True)
+    asce = FakeAssociation([(encoded, statuses.C_FIND_PENDING),
+                            (_result('1.2.3'), statuses.C_FIND_PENDING)])
+    services.qr_find_scp(asce, *_request())
+    assert asce.calling_ae == 'CALLING_AE'
+    assert asce.sent == [
+        (0xFF00, encoded), (0xFF00, encoded), (0x0000, None)
+    ]
+
+
+def test_find_stops_on_failure_status():
+    asce = FakeAssociation([(_result('1'), statuses.C_FIND_PENDING),
+                            (None, statuses.C_FIND_OUT_OF_RESOURCES),
+                            (_result('2'), statuses.C_FIND_PENDING)])
+    services.qr_find_scp(asce, *_request())
+    assert [status for status, _ in asce.sent] == [0xFF00, 0xA700]
+    assert asce.closed
+
+
+def _pending(count=5):
+    return [(_result(str(i)), statuses.C_FIND_PENDING) for i in range(count)]
+
+
+def test_find_cancel():
+    asce = FakeAssociation(_pending())
+    asce.incoming = _cancel(1)
+    services.qr_find_scp(asce, *_request())
+    assert [status for status, _ in asce.sent] == [0xFF00, 0xFF00, 0xFE00]
+    assert asce.closed
+    assert asce.dul.to_service_user.empty()
+
+
+def test_find_keeps_next_request():
+    asce = FakeAssociation(_pending())
+    echo = dimsemessages.CEchoRQMessage()
+    echo.message_id = 2
+    echo.sop_class_uid = uids.VERIFICATION_SOP_CLASS
+    asce.incoming = _message_pdus(echo) + _cancel(1)
+    services.qr_find_scp(asce, *_request())
+    # Matching is not interrupted, request is left for association loop
+    assert [status for status, _ in asce.sent] == [0xFF00] * 5 + [0x0000]
+    assert asce.dul.to_service_user.qsize() == 2
+
+
+def test_find_other_cancel_ignored():
+    asce = FakeAssociation(_pending())
+    asce.incoming = _cancel(7)
+    services.qr_find_scp(asce, *_request())
+    assert [status for status, _ in asce.sent] == [0xFF00] * 5 + [0x0000]
+    assert asce.dul.to_service_user.empty()
+
+
+@pytest.mark.parametrize('primitive,error', [
+    (pdu.AReleaseRqPDU(), exceptions.AssociationReleasedError),
+    (pdu.AAbortPDU(source=2, reason_diag=0),
+     exceptions.AssociationAbortedError)
+])
+def test_find_release_or_abort(primitive, error):
+    asce = FakeAssociation(_pending())
+    asce.incoming = [primitive]
+    with pytest.raises(error):
+        services.qr_find_scp(asce, *_request())
+    assert asce.closed
+    assert [status for status, _ in asce.sent] == [0xFF00, 0xFF00]
+
+
+def test_fragment_encoding():
+    data = memoryview(b'\x01\x02\x03\x04')
+    fragment = services.DataSetFragment(3, data, True)
+    expected = pdu.PDataTfPDU([pdu.PresentationDataValueItem(
+        3, b'\x02' + data.tobytes()
+    )])
+    assert fragment.encode() == expected.encode()
+
+
+def test_mapped_store_fragments(tmp_path):
+    ds = Dataset()
+    ds.SOPClassUID = uids.ENCAPSULATED_PDF_STORAGE
+    ds.SOPInstanceUID = '1.2.3.4'
+    ds.EncapsulatedDocument = bytes(range(256)) * 200
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    ds.is_implicit_VR = True
+    ds.is_little_endian = True
+    file_name = str(tmp_path / 'test.dcm')
+    dcmwrite(file_name, ds, write_like_original=False)
+
+    with services.MappedFile(file_name) as mapped:
+        assert mapped.meta.MediaStorageSOPInstanceUID == '1.2.3.4'
+        msg = services.MappedCStoreRQMessage()
+        msg.data_set = mapped.data_set
+        msg.message_id = 1
+        fragments = [p for p in msg.encode(1, 16000)
+                     if isinstance(p, services.DataSetFragment)]
+        data = b''.join(f.data for f in fragments)
+        assert [f.is_last for f in fragments] == [False] * 3 + [True]
+        assert all(len(f.data) <= 16000 - 6 for f in fragments)
+        assert data == dsutils.encode(ds, True, True)
+        for fragment in fragments:
+            fragment.data.release()
+
+
+def test_mapped_store_unlimited_pdu(tmp_path):
+    ds = Dataset()
+    ds.SOPClassUID = uids.ENCAPSULATED_PDF_STORAGE
+    ds.SOPInstanceUID = '1.2.3.4'
+    ds.EncapsulatedDocument = bytes(range(256)) * 200
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    ds.is_implicit_VR = True
+    ds.is_little_endian = True
+    file_name = str(tmp_path / 'test.dcm')
+    dcmwrite(file_name, ds, write_like_original=False)
+
+    with services.MappedFile(file_name) as mapped:
+        msg = services.MappedCStoreRQMessage()
+        msg.data_set = mapped.data_set
+        msg.message_id = 1
+        pdus = list(msg.encode(1, 0))
+        fragments = [p for p in pdus
+                     if isinstance(p, services.DataSetFragment)]
+        assert len(pdus) > len(fragments) > 0
+        assert fragments[-1].is_last
+        data = b''.join(f.data for f in fragments)
+        assert data == dsutils.encode(ds, True, True)
+        for fragment in fragments:
+            fragment.data.release()
+
+
+def test_mapped_empty_file(tmp_path):
+    file_name = tmp_path / 'empty.dcm'
+    file_name.write_bytes(b'')
+    with pytest.raises(InvalidDicomError):
+        services.MappedFile(str(file_name))
+
+
+def test_mapped_file_without_meta_uids(tmp_path):
+    ds = Dataset()
+    ds.SOPClassUID = uids.ENCAPSULATED_PDF_STORAGE
+    ds.SOPInstanceUID = '1.2.3.4'
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    ds.is_implicit_VR = True
+    ds.is_little_endian = True
+    ds.preamble = b'\0' * 128
+    file_name = str(tmp_path / 'test.dcm')
+    dcmwrite(file_name, ds, write_like_original=True)
+
+    with services.MappedFile(file_name) as mapped:
+        assert 'MediaStorageSOPInstanceUID' not in mapped.meta
+        assert mapped.sop_class_uid == uids.ENCAPSULATED_PDF_STORAGE
+        assert mapped.sop_instance_uid == '1.2.3.4'
+        assert mapped.data_set.tobytes() == dsutils.encode(ds, True, True)
+
+
+class FakeStoreAssociation:
+    def __init__(self, fail_on=None):
+        self.association_established = True
+        self.stored = []
+        self.fail_on = fail_on
+
+    def get_scu(self, sop_class):
+        return self.store
+
+    def store(self, data_set, msg_id):
+        if data_set == self.fail_on:
+            self.association_established = False
+            raise exceptions.AssociationAbortedError(2, 0)
+        time.sleep(0.001)
+        self.stored.append(data_set)
+        if data_set == 'warning':
+            return statuses.Status(0xB000, dimsemessages.CStoreRSPMessage)
+        return statuses.SUCCESS
+
+
+class FakeDestination:
+    def __init__(self, max_associations, fail_on=None):
+        self.max_associations = max_associations
+        self.fail_on = fail_on
+        self.associations = []
+
+    @contextlib.contextmanager
+    def connect(self):
+        if len(self.associations) >= self.max_associations:
+            raise exceptions.AssociationRejectedError(1, 2, 2)
+        assoc = FakeStoreAssociation(self.fail_on)
+        self.associations.append(assoc)
+        yield assoc
+
+
+def _send(destination, datasets, associations=3):
+    sender = services.ParallelSender(destination.connect, associations)
+    sub_ops = services.SubOperations(len(datasets))
+    for _, _, status in sender.send(((uids.CT_IMAGE_STORAGE, d)
+                                     for d in datasets), len(datasets)):
+        sub_ops.update(status)
+    return sub_ops
+
+
+def test_parallel_sender():
+    destination = FakeDestination(3)
+    datasets = [str(i) for i in range(30)] + ['warning']
+    sub_ops = _send(destination, datasets)
+    assert (sub_ops.completed, sub_ops.warning, sub_ops.failed) == (30, 1, 0)
+    assert sub_ops.remaining == 0
+    assert len(destination.associations) == 3
+    stored = [d for a in destination.associations for d in a.stored]
+    assert sorted(stored) == sorted(datasets)
+
+
+def test_parallel_sender_single_association():
+    destination = FakeDestination(1)
+    sub_ops = _send(destination, [str(i) for i in range(10)])
+    assert sub_ops.completed == 10
+    assert len(destination.associations[0].stored) == 10
+
+
+def test_parallel_sender_refused():
+    destination = FakeDestination(0)
+    with pytest.raises(exceptions.AssociationRejectedError):
+        _send(destination, ['1'])
+
+
+def test_parallel_sender_aborted():
+    destination = FakeDestination(1, fail_on='3')
+    sub_ops = _send(destination, [str(i) for i in range(10)])
+    assert sub_ops.completed == 3
+    assert sub_ops.failed == 7
+
+
+def test_retrieve_results_combine():
+    streamed = services.RetrieveResults(
+        iter([('1.2.3', '1.2.5', 'a')]), 1, set([('1.2.3', '1.2.5')])
+    )
+    combined = services.RetrieveResults.combine(
+        [streamed, [('1.2.4', '1.2.5', 'b')]]
+    )
+    assert len(combined) == 2
+    assert combined.contexts == set([('1.2.3', '1.2.5'), ('1.2.4', '1.2.5')])
+    assert [d for _, _, d in combined] == ['a', 'b']
+
+
+def test_sub_operations_finish():
+    sub_ops = services.SubOperations(3)
+    sub_ops.update(statuses.SUCCESS)
+    sub_ops.finish()
+    assert (sub_ops.completed, sub_ops.failed, sub_ops.remaining) == (1, 2, 0)
+
+    # More datasets than expected
+    sub_ops = services.SubOperations(1)
+    for _ in range(2):
+        sub_ops.update(statuses.SUCCESS)
+    sub_ops.finish()
+    assert (sub_ops.completed, sub_ops.failed, sub_ops.remaining) == (2, 0, 0)
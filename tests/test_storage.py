@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import datetime
+import os
+
 import pydicom
 import pytest
 
@@ -7,8 +10,10 @@ from pydicom import uid
 from pynetdicom2 import dsutils
 
 from tiny_pacs import ae
+from tiny_pacs import cache
 from tiny_pacs import db
 from tiny_pacs import event_bus
+from tiny_pacs import ingest
 from tiny_pacs import storage
 
 
@@ -45,7 +50,8 @@ def test_successful_storage(memory_storage: storage.InMemoryStorage):
     )
     ds = pydicom.Dataset()
     ds.SOPInstanceUID = '1.2.3.4'
-    memory_storage.bus.broadcast(storage.StorageChannels.ON_STORE_DONE, ds)
+    ingest_ctx = ingest.IngestContext(None, None, ds)
+    memory_storage.bus.broadcast(storage.StorageChannels.ON_STORE_DONE, ingest_ctx)
     _file = storage.StorageFiles.get(storage.StorageFiles.sop_instance_uid == '1.2.3.4')
     assert _file.is_stored == True
 
@@ -59,7 +65,8 @@ def test_failure_storage(memory_storage: storage.InMemoryStorage):
     )
     ds = pydicom.Dataset()
     ds.SOPInstanceUID = '1.2.3.4'
-    memory_storage.bus.broadcast(storage.StorageChannels.ON_STORE_FAILURE, ds)
+    ingest_ctx = ingest.IngestContext(None, None, ds)
+    memory_storage.bus.broadcast(storage.StorageChannels.ON_STORE_FAILURE, ingest_ctx)
     with pytest.raises(storage.StorageFiles.DoesNotExist):  # pylint: disable=no-member
         storage.StorageFiles.get(storage.StorageFiles.sop_instance_uid == '1.2.3.4')
 
@@ -77,7 +84,8 @@ def test_get_files(memory_storage: storage.InMemoryStorage):
     ds_stream = dsutils.encode(ds, ts.is_implicit_VR, ts.is_little_endian)
     fp.write(ds_stream)
     fp.seek(start)
-    memory_storage.bus.broadcast(storage.StorageChannels.ON_STORE_DONE, ds)
+    ingest_ctx = ingest.IngestContext(ctx, fp)
+    memory_storage.bus.broadcast(storage.StorageChannels.ON_STORE_DONE, ingest_ctx)
     for sop_class_uid, _ts, ds in memory_storage.on_store_get_files(['1.2.3.4']):
         assert sop_class_uid == '1.2.3'
         assert _ts == ts
@@ -93,3 +101,339 @@ def test_get_files_empty(memory_storage: storage.InMemoryStorage):
     )
     results = memory_storage.on_store_get_files(['1.2.3.4'])
     assert not len(list(results))
+
+
+def _receive(_storage, sop_instance_uid, patient_name='Test'):
+    ts = uid.ImplicitVRLittleEndian
+    ctx = asceprovider.PContextDef(1, '1.2.3', ts)
+    cmd_ds = pydicom.Dataset()
+    cmd_ds.AffectedSOPClassUID = '1.2.3'
+    cmd_ds.AffectedSOPInstanceUID = sop_instance_uid
+    fp, start = _storage.bus.send_one(ae.AEChannels.ON_GET_FILE, ctx, cmd_ds)
+    ds = pydicom.Dataset()
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.SOPClassUID = '1.2.3'
+    ds.PatientName = patient_name
+    fp.write(dsutils.encode(ds, ts.is_implicit_VR, ts.is_little_endian))
+    fp.seek(start)
+    return ingest.IngestContext(ctx, fp)
+
+
+def _store(_storage, sop_instance_uid, patient_name='Test'):
+    ingest_ctx = _receive(_storage, sop_instance_uid, patient_name)
+    if isinstance(ingest_ctx.fp, ingest.DiscardedDataset):
+        return ingest_ctx.fp
+    _storage.bus.broadcast(storage.StorageChannels.ON_STORE_DONE, ingest_ctx)
+    ingest_ctx.fp.close()
+    return ingest_ctx.fp
+
+
+def _file_storage(tmp_path, duplicates):
+    bus = event_bus.EventBus()
+    db.Database(bus, {})
+    _storage = storage.FileStorage(bus, {
+        'storage_dir': str(tmp_path), 'duplicates': duplicates
+    })
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    return _storage
+
+
+def _stored_name(_storage, sop_instance_uid):
+    file_record = storage.StorageFiles.get(
+        storage.StorageFiles.sop_instance_uid == sop_instance_uid
+    )
+    return os.path.join(_storage.storage_dir, file_record.file_name)
+
+
+def test_duplicate_ignored(memory_storage: storage.InMemoryStorage,
+                           monkeypatch):
+    _store(memory_storage, '1.2.3.4')
+    assert isinstance(_store(memory_storage, '1.2.3.4'),
+                      ingest.DiscardedDataset)
+    assert storage.StorageFiles.select().count() == 1
+
+    def _execute_sql(*args, **kwargs):
+        raise AssertionError('Unexpected query')
+    monkeypatch.setattr(db.DB.obj, 'execute_sql', _execute_sql)
+    assert not memory_storage.is_known('1.2.3.5')
+
+
+def test_duplicate_overwrite(tmp_path):
+    _storage = _file_storage(tmp_path, 'overwrite')
+    _store(_storage, '1.2.3.4', 'First')
+    first = _stored_name(_storage, '1.2.3.4')
+    _store(_storage, '1.2.3.4', 'Second')
+    second = _stored_name(_storage, '1.2.3.4')
+    assert not os.path.exists(first)
+    assert pydicom.dcmread(second).PatientName == 'Second'
+    assert storage.StorageFiles.select().count() == 1
+    assert not storage.StorageFileVersions.select().count()
+
+
+def test_duplicate_version(tmp_path):
+    _storage = _file_storage(tmp_path, 'version')
+    _store(_storage, '1.2.3.4', 'First')
+    first = _stored_name(_storage, '1.2.3.4')
+    _store(_storage, '1.2.3.4', 'Second')
+    version = storage.StorageFileVersions.get()
+    assert os.path.join(_storage.storage_dir, version.file_name) == first
+    assert pydicom.dcmread(first).PatientName == 'First'
+    assert pydicom.dcmread(_stored_name(_storage, '1.2.3.4')).PatientName \
+        == 'Second'
+
+
+def test_duplicate_failure_restores_file(tmp_path):
+    _storage = _file_storage(tmp_path, 'overwrite')
+    _store(_storage, '1.2.3.4', 'First')
+    first = _stored_name(_storage, '1.2.3.4')
+    ingest_ctx = _receive(_storage, '1.2.3.4', 'Second')
+    ingest_ctx.header
+    ingest_ctx.fp.close()
+    _storage.bus.broadcast(storage.StorageChannels.ON_STORE_FAILURE,
+                           ingest_ctx)
+    assert _stored_name(_storage, '1.2.3.4') == first
+    assert pydicom.dcmread(first).PatientName == 'First'
+    assert len(os.listdir(os.path.dirname(first))) == 1
+
+
+def _finish(_storage, ingest_ctx, channel):
+    ingest_ctx.header
+    ingest_ctx.fp.close()
+    _storage.bus.broadcast(channel, ingest_ctx)
+
+
+def test_concurrent_overwrite_failure(tmp_path):
+    _storage = _file_storage(tmp_path, 'overwrite')
+    _store(_storage, '1.2.3.4', 'First')
+    first = _stored_name(_storage, '1.2.3.4')
+    second = _receive(_storage, '1.2.3.4', 'Second')
+    third = _receive(_storage, '1.2.3.4', 'Third')
+    _finish(_storage, third, storage.StorageChannels.ON_STORE_DONE)
+    _finish(_storage, second, storage.StorageChannels.ON_STORE_FAILURE)
+    stored = _stored_name(_storage, '1.2.3.4')
+    assert pydicom.dcmread(stored).PatientName == 'Third'
+    assert os.listdir(os.path.dirname(first)) == [os.path.basename(stored)]
+
+
+def test_concurrent_overwrite_restored(tmp_path):
+    _storage = _file_storage(tmp_path, 'overwrite')
+    _store(_storage, '1.2.3.4', 'First')
+    second = _receive(_storage, '1.2.3.4', 'Second')
+    third = _receive(_storage, '1.2.3.4', 'Third')
+    _finish(_storage, second, storage.StorageChannels.ON_STORE_DONE)
+    _finish(_storage, third, storage.StorageChannels.ON_STORE_FAILURE)
+    file_record = storage.StorageFiles.get()
+    assert file_record.is_stored
+    stored = _stored_name(_storage, '1.2.3.4')
+    assert pydicom.dcmread(stored).PatientName == 'Second'
+    assert os.listdir(os.path.dirname(stored)) == [os.path.basename(stored)]
+
+
+def test_quarantine_keeps_file(tmp_path):
+    _storage = _file_storage(tmp_path, 'ignore')
+    ingest_ctx = _receive(_storage, '1.2.3.4')
+    ingest_ctx.header
+    ingest_ctx.fp.close()
+    received = _stored_name(_storage, '1.2.3.4')
+    _storage.bus.broadcast(storage.StorageChannels.ON_STORE_QUARANTINE,
+                           ingest_ctx)
+    assert not os.path.exists(received)
+    assert not storage.StorageFiles.select().count()
+    quarantined = os.path.join(
+        _storage.storage_dir, storage.QUARANTINE_FOLDER,
+        os.path.relpath(received, _storage.storage_dir)
+    )
+    assert pydicom.dcmread(quarantined).SOPInstanceUID == '1.2.3.4'
+
+
+def test_memory_quarantine(memory_storage: storage.InMemoryStorage):
+    ingest_ctx = _receive(memory_storage, '1.2.3.4')
+    memory_storage.bus.broadcast(storage.StorageChannels.ON_STORE_QUARANTINE,
+                                 ingest_ctx)
+    assert '1.2.3.4' in memory_storage.quarantined
+    assert not storage.StorageFiles.select().count()
+
+
+def test_delete_removes_files(tmp_path):
+    _storage = _file_storage(tmp_path, 'version')
+    _store(_storage, '1.2.3.4', 'First')
+    _store(_storage, '1.2.3.4', 'Second')
+    folder = os.path.dirname(_stored_name(_storage, '1.2.3.4'))
+    _storage.bus.broadcast(storage.StorageChannels.ON_STORE_DELETE,
+                           ['1.2.3.4'])
+    assert not storage.StorageFiles.select().count()
+    assert not storage.StorageFileVersions.select().count()
+    assert not os.listdir(folder)
+    assert not _storage.is_known('1.2.3.4')
+
+
+def test_known_instances_loaded(tmp_path):
+    _storage = _file_storage(tmp_path, 'ignore')
+    _store(_storage, '1.2.3.4')
+    _storage.load_known_instances()
+    assert '1.2.3.4' in _storage.known_instances
+    assert _storage.is_known('1.2.3.4')
+    assert not _storage.is_known('1.2.3.5')
+
+
+def test_bloom_filter():
+    bloom = cache.BloomFilter(1000, 0.01)
+    bloom.update(str(i) for i in range(1000))
+    assert all(str(i) in bloom for i in range(1000))
+    false_positives = sum(str(i) in bloom for i in range(1000, 11000))
+    assert false_positives < 300
+    bloom.clear()
+    assert '1' not in bloom
+
+
+def test_hashed_layout(tmp_path):
+    bus = event_bus.EventBus()
+    db.Database(bus, {})
+    _storage = storage.FileStorage(bus, {
+        'storage_dir': str(tmp_path), 'layout': 'hashed',
+        'duplicates': 'overwrite'
+    })
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    _store(_storage, '1.2.3.4', 'First')
+    file_record = storage.StorageFiles.get()
+    folder, file_name = os.path.split(file_record.file_name)
+    assert file_name == '1.2.3.4.dcm'
+    assert folder == _storage.get_folder('1.2.3.4')
+    assert len(folder.split(os.sep)) == 2
+
+    # Re-sent instance never reuses stored file name
+    _store(_storage, '1.2.3.4', 'Second')
+    file_name = _stored_name(_storage, '1.2.3.4')
+    assert os.path.basename(file_name).startswith('1.2.3.4_')
+    assert pydicom.dcmread(file_name).PatientName == 'Second'
+
+
+def test_create_file_exclusive(tmp_path):
+    _storage = _file_storage(tmp_path, 'ignore')
+    fp, file_name = _storage.create_file('1.2.3.4')
+    other_fp, other_name = _storage.create_file('1.2.3.4')
+    fp.close()
+    other_fp.close()
+    assert os.path.basename(file_name) == '1.2.3.4.dcm'
+    assert os.path.dirname(other_name) == os.path.dirname(file_name)
+    assert other_name != file_name
+
+
+def test_migrate_layout(tmp_path):
+    db_name = str(tmp_path / 'pacs.db')
+    storage_dir = str(tmp_path / 'storage')
+    bus = event_bus.EventBus()
+    db.Database(bus, {'db_name': db_name})
+    _storage = storage.FileStorage(bus, {'storage_dir': storage_dir})
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    for i in range(3):
+        _store(_storage, f'1.2.3.{i}')
+    date_folder = _storage.get_folder('1.2.3.0')
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+    bus = event_bus.EventBus()
+    db.Database(bus, {'db_name': db_name})
+    _storage = storage.FileStorage(bus, {
+        'storage_dir': storage_dir, 'layout': 'hashed',
+        'migrate_layout': True
+    })
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    assert not os.path.exists(os.path.join(storage_dir, date_folder))
+    files = list(_storage.on_store_get_files([f'1.2.3.{i}' for i in range(3)]))
+    assert len(files) == 3
+    for _, _, file_name in files:
+        ds = pydicom.dcmread(file_name)
+        assert os.path.dirname(file_name) == os.path.join(
+            storage_dir, _storage.get_folder(ds.SOPInstanceUID)
+        )
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def test_migrate_layout_keeps_date_folders(tmp_path):
+    db_name = str(tmp_path / 'pacs.db')
+    storage_dir = str(tmp_path / 'storage')
+    for layout, uid in (('hashed', '1.2.3.0'), ('date', '1.2.3.1')):
+        bus = event_bus.EventBus()
+        db.Database(bus, {'db_name': db_name})
+        _storage = storage.FileStorage(bus, {
+            'storage_dir': storage_dir, 'layout': layout
+        })
+        bus.broadcast(event_bus.DefaultChannels.ON_START)
+        _store(_storage, uid)
+        stored_name = _stored_name(_storage, uid)
+        # Record time doesn't match the folder file is stored in
+        storage.StorageFiles.update(added=datetime.datetime(2001, 1, 1))\
+            .execute()
+        bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+    bus = event_bus.EventBus()
+    db.Database(bus, {'db_name': db_name})
+    _storage = storage.FileStorage(bus, {
+        'storage_dir': storage_dir, 'migrate_layout': True
+    })
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    assert _stored_name(_storage, '1.2.3.1') == stored_name
+    assert _stored_name(_storage, '1.2.3.0') == os.path.join(
+        storage_dir, '20010101', '1.2.3.0.dcm'
+    )
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+
+
+def test_memory_budget_spills_to_disk(tmp_path):
+    bus = event_bus.EventBus()
+    db.Database(bus, {})
+    _storage = storage.InMemoryStorage(bus, {
+        'max_bytes': 1, 'spill_dir': str(tmp_path)
+    })
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    for i in range(3):
+        _store(_storage, f'1.2.3.{i}')
+    stats = _storage.memory_stats()
+    assert stats['in_memory'] == 1
+    assert stats['spilled'] == 2
+    assert len(os.listdir(tmp_path)) == 2
+
+    # Spilled dataset is loaded back, least recently used one is spilled
+    (_, _, ds), = _storage.on_store_get_files(['1.2.3.0'])
+    assert ds.SOPInstanceUID == '1.2.3.0'
+    assert '1.2.3.0' in _storage._stored_files
+    assert '1.2.3.2' in _storage._spilled_files
+    assert _storage.memory_stats()['bytes'] == \
+        len(_storage._stored_files['1.2.3.0'])
+
+    bus.broadcast(event_bus.DefaultChannels.ON_EXIT)
+    assert not os.listdir(tmp_path)
+
+
+def test_memory_overwrite_discards_spilled(tmp_path):
+    bus = event_bus.EventBus()
+    db.Database(bus, {})
+    _storage = storage.InMemoryStorage(bus, {
+        'max_bytes': 1, 'spill_dir': str(tmp_path),
+        'duplicates': 'overwrite'
+    })
+    bus.broadcast(event_bus.DefaultChannels.ON_START)
+    _store(_storage, '1.2.3.4', 'First')
+    _store(_storage, '1.2.3.5')
+    _store(_storage, '1.2.3.4', 'Second')
+    assert _storage.memory_stats()['in_memory'] == 1
+    assert len(os.listdir(tmp_path)) == 1
+    (_, _, ds), = _storage.on_store_get_files(['1.2.3.4'])
+    assert ds.PatientName == 'Second'
+
+
+def test_get_contexts(memory_storage: storage.InMemoryStorage):
+    for sop_instance_uid, sop_class_uid in [('1.2.3.4', '1.2.3'),
+                                            ('1.2.3.5', '1.2.3'),
+                                            ('1.2.3.6', '1.2.4')]:
+        memory_storage.new_file(sop_instance_uid, sop_class_uid, '1.2.5', 'test')
+        memory_storage.file_stored(sop_instance_uid)
+    memory_storage.new_file('1.2.3.7', '1.2.6', '1.2.5', 'test')
+
+    query = storage.StorageFiles.select(storage.StorageFiles.sop_instance_uid)
+    assert memory_storage.on_get_contexts(query) == set([
+        ('1.2.3', '1.2.5'), ('1.2.4', '1.2.5')
+    ])
+    assert memory_storage.on_get_contexts(['1.2.3.4']) == set([
+        ('1.2.3', '1.2.5')
+    ])
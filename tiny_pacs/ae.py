@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import contextlib
 import enum
 from itertools import chain
 import logging
@@ -11,8 +12,11 @@ from pynetdicom2 import sopclass
 from pynetdicom2 import exceptions
 from pynetdicom2 import statuses
 
+from . import db
 from . import event_bus
 from . import devices
+from . import ingest
+from . import pool
 from . import services
 
 
@@ -38,6 +42,10 @@ class AE(applicationentity.AE):
         max_pdu_length = config.get('max_pdu_length', 65536)
 
         self.dump_ds = config.get('dump_ds', False)
+        #: Number of parallel associations for C-MOVE sub-operations
+        self.move_associations = config.get('move_associations', 1)
+        #: Pool of associations for C-MOVE destinations
+        self.association_pool = new_pool(config.get('association_pool', {}))
 
         if isinstance(ae_title, list):
             main_aet = ae_title[0]
@@ -48,7 +56,7 @@ class AE(applicationentity.AE):
 
         super().__init__(main_aet, port, supported_ts, max_pdu_length)
         self.add_scp(sopclass.verification_scp)
-        self.add_scp(sopclass.qr_find_scp)
+        self.add_scp(services.qr_find_scp)
         self.add_scp(services.qr_move_scp)
         self.add_scp(services.qr_get_scp)
         self.add_scp(sopclass.storage_scp)
@@ -58,8 +66,27 @@ class AE(applicationentity.AE):
     def get_main_aet(self):
         return self.valid_aet[0]
 
+    def quit(self):
+        if self.association_pool is not None:
+            self.association_pool.close()
+        super().quit()
+
+    def connection(self):
+        """Database connection scope for a single DIMSE operation
+
+        Connection that is taken from the pool by the handlers is returned
+        once the scope is left, so association threads never keep it.
+
+        :return: connection scope
+        """
+        if not self.bus.listeners.get(db.DBChannels.CONNECTION):
+            return contextlib.nullcontext()
+        return self.bus.send_one(db.DBChannels.CONNECTION)
+
     def get_file(self, context, command_set: pydicom.Dataset):
-        return self.bus.send_one(AEChannels.ON_GET_FILE, context, command_set)
+        with self.connection():
+            return self.bus.send_one(AEChannels.ON_GET_FILE, context,
+                                     command_set)
 
     def on_association_request(self, asce, assoc):
         called_ae_title = assoc.called_ae_title.strip()
@@ -78,21 +105,27 @@ class AE(applicationentity.AE):
 
     def on_receive_store(self, context, ds):
         self.log.info('Received C-STORE %r', context)
+        if isinstance(ds, ingest.DiscardedDataset):
+            self.log.info('C-STORE dataset discarded by storage: %s',
+                          ds.sop_instance_uid)
+            return statuses.SUCCESS
+
+        ingest_ctx = ingest.IngestContext(context, ds)
         if self.dump_ds:
             try:
-                _ds = pydicom.dcmread(ds, stop_before_pixels=True)
-
+                header = ingest_ctx.header
             except Exception:
                 self.log.error(
                     'C-STORE failed to read dataset. C-STORE operation aborted'
                 )
                 raise
             else:
-                self.log.debug('C-STORE dataset: %r', _ds)
-            ds.seek(0)
+                self.log.debug('C-STORE dataset: %r', header)
 
         try:
-            results = self.bus.broadcast(AEChannels.STORE, context, ds)
+            with self.connection():
+                results = self.bus.broadcast(AEChannels.STORE, context,
+                                             ingest_ctx)
         except Exception as e:
             msg = f'C-STORE handling failed: {e}'
             self.log.exception(msg)
@@ -103,13 +136,14 @@ class AE(applicationentity.AE):
                 return status
         return statuses.SUCCESS
 
-    def on_receive_find(self, context, ds):
+    def on_receive_find(self, context, ds, calling_ae=None):
         self.log.info('Received C-FIND %r', context)
         if self.dump_ds:
             self.log.debug('C-FIND dataset %r', ds)
 
         try:
-            results = self.bus.broadcast(AEChannels.FIND, context, ds)
+            results = self.bus.broadcast(AEChannels.FIND, context, ds,
+                                         calling_ae=calling_ae)
         except Exception as e:
             msg = f'C-FIND handling failed {e}'
             self.log.exception(msg)
@@ -135,7 +169,7 @@ class AE(applicationentity.AE):
             self.log.exception(msg)
             raise exceptions.EventHandlingError(msg)
 
-        datasets = chain.from_iterable(results)
+        datasets = services.RetrieveResults.combine(results)
         return remote_ae, datasets
 
     def on_receive_get(self, context: asceprovider.PContextDef,
@@ -160,7 +194,7 @@ class AE(applicationentity.AE):
             msg = f'C-GET handling failed {e}'
             self.log.exception(msg)
             raise exceptions.EventHandlingError(msg)
-        datasets = chain.from_iterable(results)
+        datasets = services.RetrieveResults.combine(results)
         return datasets
 
     def on_commitment_request(self, remote_ae, uids):
@@ -174,12 +208,27 @@ class AE(applicationentity.AE):
             raise exceptions.EventHandlingError(msg)
 
         try:
-            results = self.bus.broadcast(AEChannels.COMMITMENT, uids)
+            with self.connection():
+                results = self.bus.broadcast(AEChannels.COMMITMENT, uids)
+                success = list(chain.from_iterable(s for s, _ in results))
+                failure = list(chain.from_iterable(f for _, f in results))
         except Exception as e:
             msg = f'Storage Commitment handling failed: {e}'
             self.log.exception(msg)
             raise exceptions.EventHandlingError(msg)
-
-        success = chain.from_iterable(s for s, _ in results)
-        failure = chain.from_iterable(f for _, f in results)
-        return list(success), list(failure)
+        return success, failure
+
+
+def new_pool(config: dict):
+    """Creates association pool from configuration
+
+    :param config: pool configuration (``on``, ``max_per_destination``,
+                   ``idle_timeout`` and ``echo_after``)
+    :type config: dict
+    :return: association pool or `None` if pool is not turned on
+    :rtype: pool.AssociationPool
+    """
+    config = dict(config)
+    if not config.pop('on', False):
+        return None
+    return pool.AssociationPool(**config)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+import collections
+import hashlib
+import math
+import threading
+import time
+
+
+class LRUCache:
+    """Bounded thread-safe mapping with least-recently-used eviction.
+
+    Cache keeps track of hits, misses and evictions, so its efficiency can be
+    monitored. Optionally entries expire `ttl` seconds after they were put.
+
+    :ivar maxsize: maximum number of entries
+    :ivar ttl: entry time to live in seconds, `None` if entries don't expire
+    :ivar hits: number of successful lookups
+    :ivar misses: number of failed lookups
+    :ivar evictions: number of entries evicted due to size limit
+    :ivar expirations: number of entries that expired
+    :ivar invalidations: number of entries removed by invalidation
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        """Initializes cache
+
+        :param maxsize: maximum number of entries, defaults to 1024
+        :type maxsize: int, optional
+        :param ttl: entry time to live in seconds, defaults to None
+        :type ttl: float, optional
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._data = collections.OrderedDict()
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """Gets value from cache and marks it as recently used
+
+        :param key: cache key
+        :param default: value returned on cache miss, defaults to None
+        :return: cached value or default
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and self._expires[key] <= time.monotonic():
+                del self._data[key]
+                del self._expires[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Puts value into cache, evicting least recently used entries
+
+        :param key: cache key
+        :param value: cached value
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if self.ttl is not None:
+                self._expires[key] = time.monotonic() + self.ttl
+            while len(self._data) > self.maxsize:
+                evicted, _ = self._data.popitem(last=False)
+                self._expires.pop(evicted, None)
+                self.evictions += 1
+
+    def update(self, items: dict):
+        """Puts multiple values into cache
+
+        :param items: mapping of keys to values
+        :type items: dict
+        """
+        for key, value in items.items():
+            self.put(key, value)
+
+    def invalidate(self, *keys):
+        """Removes provided keys from cache, missing keys are ignored"""
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    del self._data[key]
+                    self._expires.pop(key, None)
+                    self.invalidations += 1
+
+    def invalidate_if(self, predicate):
+        """Removes all entries that satisfy predicate
+
+        :param predicate: callable that accepts key and value
+        :return: number of removed entries
+        :rtype: int
+        """
+        with self._lock:
+            keys = [k for k, v in self._data.items() if predicate(k, v)]
+            for key in keys:
+                del self._data[key]
+                self._expires.pop(key, None)
+            self.invalidations += len(keys)
+        return len(keys)
+
+    def clear(self):
+        """Removes all entries from cache"""
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+            self._expires.clear()
+
+    def stats(self) -> dict:
+        """Cache statistics
+
+        :return: dictionary with size, hits, misses, evictions, expirations,
+                 invalidations and hit ratio
+        :rtype: dict
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+class BloomFilter:
+    """Probabilistic set of strings.
+
+    Filter answers whether value was *possibly* added, there are no false
+    negatives, so only positive answers have to be confirmed (e.g. by the
+    database). Values can't be removed.
+
+    :ivar capacity: expected number of values
+    :ivar error_rate: false positive rate at full capacity
+    :ivar count: number of added values
+    """
+
+    def __init__(self, capacity: int = 1000000, error_rate: float = 0.001):
+        """Initializes filter
+
+        :param capacity: expected number of values, defaults to 1000000
+        :type capacity: int, optional
+        :param error_rate: false positive rate, defaults to 0.001
+        :type error_rate: float, optional
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = 0
+        self._size = max(8, int(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        ))
+        self._hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, value: str) -> bool:
+        bits = self._bits
+        return all(
+            bits[i >> 3] & (1 << (i & 7)) for i in self._positions(value)
+        )
+
+    def add(self, value: str):
+        """Adds value to the filter
+
+        :param value: added value
+        :type value: str
+        """
+        with self._lock:
+            for i in self._positions(value):
+                self._bits[i >> 3] |= 1 << (i & 7)
+            self.count += 1
+
+    def update(self, values):
+        """Adds multiple values to the filter
+
+        :param values: iterable of values
+        """
+        for value in values:
+            self.add(value)
+
+    def clear(self):
+        """Removes all values"""
+        with self._lock:
+            self._bits = bytearray(len(self._bits))
+            self.count = 0
+
+    def _positions(self, value: str):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self._size for i in range(self._hashes)]
@@ -13,6 +13,7 @@ from . import ae
 from . import component
 from . import devices
 from . import event_bus
+from . import services
 
 
 class ClientChannels(enum.Enum):
@@ -58,29 +59,52 @@ class DestinationUnknownError(Exception):
 class Client(component.Component):
     def __init__(self, bus: event_bus.EventBus, config: dict):
         super().__init__(bus, config)
+        # Clients are mostly short-lived, pool is used only if configured
+        self.association_pool = ae.new_pool(config.get('association_pool', {}))
         self.subscribe(ClientChannels.GET_CLIENT, self.get)
 
+    def on_exit(self):
+        super().on_exit()
+        if self.association_pool is not None:
+            self.association_pool.close()
+
     def get(self, remote_aet):
         remote_ae = self.send_any(devices.DevicesChannels.DEVICE_BY_AE, remote_aet)
         if not remote_ae:
             raise DestinationUnknownError()
         local_ae = self.send_one(ae.AEChannels.MAIN_AET)
         self.log_info('Getting DICOM client for %r', remote_ae)
-        return DICOMClient(local_ae, remote_ae)
+        return DICOMClient(local_ae, remote_ae, self.association_pool)
 
 
 class DICOMClient:
-    def __init__(self, local_ae, remote_ae):
+    def __init__(self, local_ae, remote_ae, association_pool=None):
         self.msg_id = 0
         self.local_ae = local_ae
         self.remote_ae = remote_ae
         self.aet = applicationentity.ClientAE(local_ae)
+        self.association_pool = association_pool
         self.log = logging.getLogger('DICOMClient')
 
+    def association(self, sop_class_uid, transfer_syntax=None):
+        """Gets association with remote AE, pooled one if pool is used
+
+        :param sop_class_uid: SOP Class UID of the operation
+        :param transfer_syntax: required transfer syntax, defaults to any
+                                of the proposed ones
+        :return: context manager with established association
+        """
+        if self.association_pool is None:
+            return self.aet.request_association(self.remote_ae)
+        return self.association_pool.association(
+            self.aet, self.remote_ae, [sop_class_uid],
+            [transfer_syntax] if transfer_syntax else None
+        )
+
     def echo(self):
         self.log.info('Sending C-ECHO request to %r', self.remote_ae)
         self.aet.add_scu(sopclass.verification_scu)
-        with self.aet.request_association(self.remote_ae) as asce:
+        with self.association(uids.VERIFICATION_SOP_CLASS) as asce:
             service = asce.get_scu(uids.VERIFICATION_SOP_CLASS)
             self.msg_id += 1
             status = service(self.msg_id)
@@ -91,7 +115,7 @@ class DICOMClient:
     def find(self, ds, root=FindRoot.STUDY):
         self.aet.add_scu(sopclass.qr_find_scu)
         self.log.info('Sending C-FIND request to %r', self.remote_ae)
-        with self.aet.request_association(self.remote_ae) as asce:
+        with self.association(root.value) as asce:
             self.log.debug('Association established with %r', self.remote_ae)
             service = asce.get_scu(root.value)
             self.msg_id += 1
@@ -112,9 +136,9 @@ class DICOMClient:
             sop_class_uid = file_meta.MediaStorageSOPClassUID
             transfer_syntax = file_meta.TransferSyntaxUID
         self.aet.supported_ts = frozenset([transfer_syntax])
-        self.aet.supported_scu[sop_class_uid] = sopclass.storage_scu
+        self.aet.supported_scu[sop_class_uid] = services.storage_scu
         self.aet.update_context_def_list([sop_class_uid])
-        with self.aet.request_association(self.remote_ae) as asce:
+        with self.association(sop_class_uid, transfer_syntax) as asce:
             self.log.debug('Association established with %r', self.remote_ae)
             self.store_with_asce(asce, ds, sop_class_uid)
 
@@ -132,7 +156,7 @@ class DICOMClient:
         self.log.info('Sending C-MOVE request to %r -> %s', self.remote_ae, dest_ae)
 
         self.aet.add_scu(sopclass.qr_move_scu)
-        with self.aet.request_association(self.remote_ae) as asce:
+        with self.association(root.value) as asce:
             self.log.debug('Association established with %r', self.remote_ae)
             self._move(asce, ds, dest_ae, root)
 
@@ -149,7 +173,7 @@ class DICOMClient:
         ds.QueryRetrieveLevel = 'IMAGE'
         self.aet.add_scu(sopclass.qr_move_scu)
         if asce is None:
-            with self.aet.request_association(self.remote_ae) as asce:
+            with self.association(MoveRoot.STUDY.value) as asce:
                 self.log.debug('Association established with %r', self.remote_ae)
                 self._move(asce, ds, dest_ae, MoveRoot.STUDY)
         else:
@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+"""In-memory columnar C-FIND engine.
+
+Records of the C-FIND levels are kept in array-backed columns: integer
+columns (numeric dates, counters, parent row references) and interned
+string columns, where every distinct value is stored once and rows hold
+integer codes. Filters are evaluated over whole columns, producing row
+masks that are combined across levels through parent references, so only
+matching rows are read to build responses.
+
+NumPy is used for column storage and scans if it is installed, otherwise
+columns are backed by :class:`array.array` and scanned in Python.
+"""
+import array
+import re
+import threading
+
+import peewee
+
+from . import db
+from . import pacs
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+#: Stored value of NULL in integer columns
+NULL = -2 ** 63
+
+#: Number of result rows built at once, while index is locked
+ROWS_CHUNK_SIZE = 1000
+
+
+class IntColumn:
+    """Growable column of 64-bit integers, NULL is stored as :data:`NULL`"""
+
+    def __init__(self):
+        self._size = 0
+        if numpy is not None:
+            self._data = numpy.empty(1024, dtype=numpy.int64)
+        else:
+            self._data = array.array('q')
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, row: int):
+        return int(self._data[row])
+
+    def __setitem__(self, row: int, value: int):
+        self._data[row] = value
+
+    def append(self, value: int):
+        """Appends value to the column
+
+        :param value: integer value
+        :type value: int
+        """
+        if numpy is None:
+            self._data.append(value)
+        else:
+            if self._size == len(self._data):
+                data = numpy.empty(self._size * 2, dtype=numpy.int64)
+                data[:self._size] = self._data
+                self._data = data
+            self._data[self._size] = value
+        self._size += 1
+
+    def values(self):
+        """Column values, NumPy array or :class:`array.array`"""
+        return self._data[:self._size]
+
+
+class TextColumn:
+    """Column of interned strings
+
+    :ivar strings: distinct values, code 0 is NULL
+    :ivar codes: row codes
+    """
+
+    def __init__(self):
+        self.strings = [None]
+        self.codes = IntColumn()
+        self._code_by_value = {None: 0}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, row: int):
+        return self.strings[self.codes[row]]
+
+    def __setitem__(self, row: int, value):
+        self.codes[row] = self._code(value)
+
+    def append(self, value):
+        """Appends value to the column
+
+        :param value: string value or None
+        """
+        self.codes.append(self._code(value))
+
+    def code(self, value):
+        """Code of the value, `None` if value is not stored"""
+        return self._code_by_value.get(value)
+
+    def _code(self, value):
+        code = self._code_by_value.get(value)
+        if code is None:
+            code = len(self.strings)
+            self.strings.append(value)
+            self._code_by_value[value] = code
+        return code
+
+
+def _isin(values, accepted: list):
+    if numpy is not None:
+        return numpy.isin(values, accepted)
+    accepted = set(accepted)
+    return [v in accepted for v in values]
+
+
+def _range(values, lower, upper):
+    if numpy is not None:
+        mask = values != NULL
+        if lower is not None:
+            mask &= values >= lower
+        if upper is not None:
+            mask &= values <= upper
+        return mask
+    return [
+        v != NULL and (lower is None or v >= lower) and
+        (upper is None or v <= upper)
+        for v in values
+    ]
+
+
+def _and(mask, other):
+    if mask is None:
+        return other
+    if other is None:
+        return mask
+    if numpy is not None:
+        return mask & other
+    return [a and b for a, b in zip(mask, other)]
+
+
+def _take(mask, index):
+    if numpy is not None:
+        return mask[index]
+    return [mask[i] for i in index]
+
+
+def _rows(mask) -> list:
+    if numpy is not None:
+        return numpy.flatnonzero(mask).tolist()
+    return [i for i, m in enumerate(mask) if m]
+
+
+def _like_re(pattern: str):
+    """Compiles SQL LIKE pattern, matching is case-insensitive like in
+    :func:`tiny_pacs.pacs._apply_filter`"""
+    parts = (
+        '.*' if c == '%' else '.' if c == '_' else re.escape(c)
+        for c in pattern
+    )
+    return re.compile(''.join(parts), re.IGNORECASE | re.DOTALL)
+
+
+def _predicate(shape: tuple, values: list):
+    kind = shape[0]
+    if kind == 'eq':
+        return lambda v: v == values[0]
+    elif kind == 'in':
+        return set(values).__contains__
+    elif kind == 'like':
+        return _like_re(values[0]).fullmatch
+    elif kind == 'prefix':
+        lower, upper = values
+        return lambda v: lower <= v < upper
+    elif kind == 'prefix_like':
+        lower, upper, pattern = values
+        like = _like_re(pattern).fullmatch
+        return lambda v: lower <= v < upper and like(v)
+    elif kind == 'range':
+        values = iter(values)
+        lower = next(values) if shape[1] else None
+        upper = next(values) if shape[2] else None
+        return lambda v: ((lower is None or v >= lower) and
+                          (upper is None or v <= upper))
+    raise ValueError(f'Unsupported filter: {kind}')
+
+
+def match_value(value, shape: tuple, values: list) -> bool:
+    """Matches a single stored value against filter
+
+    :param value: stored value
+    :param shape: filter shape, see :func:`tiny_pacs.pacs.find_key`
+    :type shape: tuple
+    :param values: filter values
+    :type values: list
+    :return: `True` if value matches
+    :rtype: bool
+    """
+    if value is None:
+        return False
+    return bool(_predicate(shape, values)(value))
+
+
+class Table:
+    """Columns of a single C-FIND level
+
+    :ivar model: level model
+    :ivar columns: mapping of field name to column
+    :ivar parent: column with parent row numbers
+    :ivar ids: column with record ids
+    :ivar row_by_id: mapping of record id to row number
+    """
+
+    def __init__(self, model, parent_field: peewee.ForeignKeyField = None):
+        self.model = model
+        self.fields = [
+            f for f in model._meta.sorted_fields
+            if not isinstance(f, (peewee.AutoField, peewee.ForeignKeyField))
+        ]
+        self.columns = {
+            f.name: (IntColumn() if isinstance(f, peewee.IntegerField)
+                     else TextColumn())
+            for f in self.fields
+        }
+        self.parent_field = parent_field
+        self.parent = IntColumn()
+        self.ids = IntColumn()
+        self.row_by_id = {}
+
+    def __len__(self):
+        return len(self.parent)
+
+    def select(self):
+        """Query that loads table rows"""
+        fields = [self.model.id] + self.fields
+        if self.parent_field is not None:
+            fields.append(self.parent_field)
+        return self.model.select(*fields).order_by(self.model.id).tuples()
+
+    def upsert(self, row: tuple, parent_rows: dict):
+        """Inserts or updates row
+
+        :param row: row selected by :meth:`select`
+        :type row: tuple
+        :param parent_rows: mapping of parent ids to row numbers
+        :type parent_rows: dict
+        """
+        row_id = row[0]
+        values = row[1:len(self.fields) + 1]
+        parent = parent_rows[row[-1]] if self.parent_field is not None else -1
+        index = self.row_by_id.get(row_id)
+        if index is None:
+            self.row_by_id[row_id] = len(self.parent)
+            for field, value in zip(self.fields, values):
+                column = self.columns[field.name]
+                if isinstance(column, IntColumn) and value is None:
+                    value = NULL
+                column.append(value)
+            self.parent.append(parent)
+            self.ids.append(row_id)
+        else:
+            for field, value in zip(self.fields, values):
+                column = self.columns[field.name]
+                if isinstance(column, IntColumn) and value is None:
+                    value = NULL
+                column[index] = value
+            self.parent[index] = parent
+
+    def value(self, index: int, name: str):
+        """Stored value of the field
+
+        :param index: row number
+        :type index: int
+        :param name: field name
+        :type name: str
+        """
+        value = self.columns[name][index]
+        return None if value == NULL else value
+
+    def mask(self, name: str, shape: tuple, values: list):
+        """Evaluates filter over a column
+
+        :param name: filtered field name
+        :type name: str
+        :param shape: filter shape, see :func:`tiny_pacs.pacs.find_key`
+        :type shape: tuple
+        :param values: filter values
+        :type values: list
+        :return: row mask
+        """
+        column = self.columns[name]
+        kind = shape[0]
+        if isinstance(column, IntColumn):
+            if kind == 'range':
+                values = iter(values)
+                lower = next(values) if shape[1] else None
+                upper = next(values) if shape[2] else None
+                return _range(column.values(), lower, upper)
+            return _isin(column.values(), [int(v) for v in values])
+
+        if kind in ('eq', 'in'):
+            codes = [column.code(v) for v in values]
+        else:
+            predicate = _predicate(shape, values)
+            codes = [
+                code for code, value in enumerate(column.strings)
+                if value is not None and predicate(value)
+            ]
+        return _isin(column.codes.values(), [c for c in codes if c])
+
+
+class ColumnarPlan:
+    """Compiled columnar C-FIND query
+
+    :ivar model: C-FIND level model
+    :ivar filters: list of filters (model, field name, shape and range of
+                   filter values)
+    :ivar response_attrs: list of response attributes (tag, model and
+                          field name or `None`, VR)
+    """
+
+    def __init__(self, model, filters: list, response_attrs: list):
+        self.model = model
+        self.filters = filters
+        self.response_attrs = response_attrs
+        self.encode_attrs = [
+            (tag, i if column is not None else None, vr, None)
+            for i, (tag, column, vr) in enumerate(response_attrs)
+        ]
+
+    @classmethod
+    def compile(cls, model, key: tuple):
+        """Compiles query for request key
+
+        :param model: C-FIND level model
+        :param key: request key produced by :func:`tiny_pacs.pacs.find_key`
+        :type key: tuple
+        :return: compiled query
+        :rtype: ColumnarPlan
+        """
+        attrs = pacs._level_attrs(model)
+        filters = []
+        response_attrs = []
+        slot = 0
+        for entry in key[1:]:
+            kind, tag = entry[:2]
+            if kind == 'echo':
+                response_attrs.append((tag, None, entry[2]))
+                continue
+            attr_model, attr_name, vr, _ = attrs[tag]
+            response_attrs.append((tag, (attr_model, attr_name), vr))
+            if kind == 'filter':
+                _, _, shape, filter_name = entry
+                count = pacs._shape_size(shape)
+                filters.append(
+                    (attr_model, filter_name, shape, slot, slot + count)
+                )
+                slot += count
+        return cls(model, filters, response_attrs)
+
+
+class ColumnarIndex:
+    """In-memory copy of C-FIND levels
+
+    Index is loaded from the database and is updated by the store path via
+    :meth:`refresh`. Removal of records requires index to be reloaded.
+
+    :ivar models: indexed level models, from the top level down
+    :ivar tables: mapping of model to its table
+    """
+
+    def __init__(self, models: list):
+        """Initializes index
+
+        :param models: level models, from the top level down
+        :type models: list
+        """
+        self.models = models
+        self.tables = {}
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        tables = {}
+        parent = None
+        for model in self.models:
+            parent_field = None
+            if parent is not None:
+                parent_field = getattr(model, parent.__name__.lower())
+            tables[model] = Table(model, parent_field)
+            parent = model
+        self.tables = tables
+
+    def __contains__(self, model):
+        return model in self.tables
+
+    def load(self):
+        """Loads all indexed levels from the database"""
+        with self._lock:
+            self._reset()
+            for model in self.models:
+                self._load(model, self.tables[model].select())
+
+    def refresh(self, model, condition):
+        """Reloads records that match condition
+
+        :param model: level model
+        :param condition: peewee expression
+        """
+        if model not in self.tables:
+            return
+        with self._lock:
+            self._load(model, self.tables[model].select().where(condition))
+
+    def _load(self, model, query):
+        table = self.tables[model]
+        index = self.models.index(model)
+        parent_rows = (
+            self.tables[self.models[index - 1]].row_by_id if index else {}
+        )
+        for row in db.stream(query):
+            table.upsert(row, parent_rows)
+
+    def rows(self, plan: ColumnarPlan, values: list):
+        """Executes compiled query
+
+        Matching rows are found under the lock, but responses are built in
+        chunks of :data:`ROWS_CHUNK_SIZE` rows, so the index is not locked
+        while results are sent. Reloaded index doesn't affect results that
+        are being sent, refreshed records may.
+
+        :param plan: compiled query
+        :type plan: ColumnarPlan
+        :param values: filter values produced by
+                       :func:`tiny_pacs.pacs.find_key`
+        :type values: list
+        :yield: rows, record id is the last column
+        :rtype: tuple
+        """
+        level = self.models.index(plan.model)
+        with self._lock:
+            tables = self.tables
+            indexes = self._match(tables, plan, level, values)
+        for chunk in peewee.chunked(indexes, ROWS_CHUNK_SIZE):
+            with self._lock:
+                rows = [self._row(tables, plan, level, index) for index in chunk]
+            yield from rows
+
+    def _match(self, tables: dict, plan: ColumnarPlan, level: int,
+               values: list):
+        masks = {}
+        for model, name, shape, start, end in plan.filters:
+            mask = tables[model].mask(name, shape, values[start:end])
+            masks[model] = _and(masks.get(model), mask)
+
+        # Upper level masks are intersected through parent references
+        mask = None
+        for model in self.models[:level + 1]:
+            table = tables[model]
+            if mask is not None:
+                mask = _take(mask, table.parent.values())
+            mask = _and(mask, masks.get(model))
+        if mask is None:
+            return range(len(tables[plan.model]))
+        return _rows(mask)
+
+    def _row(self, tables: dict, plan: ColumnarPlan, level: int,
+             index: int) -> tuple:
+        row_id = tables[plan.model].ids[index]
+        # Row numbers of the record and its parents
+        level_rows = {}
+        for model in reversed(self.models[:level + 1]):
+            level_rows[model] = index
+            index = tables[model].parent[index]
+        return tuple(
+            tables[column[0]].value(level_rows[column[0]], column[1])
+            if column is not None else None
+            for _, column, _ in plan.response_attrs
+        ) + (row_id,)
@@ -81,6 +81,7 @@ DEFAULT_AE_CONFIG = {
     'port': 11112,
     'max_pdu_length': 65536,
     'dump_ds': True,
+    'move_associations': 1,
     'supported_ts': [
         uid.ImplicitVRLittleEndian,
         uid.ExplicitVRLittleEndian,
@@ -1,9 +1,20 @@
 # -*- coding: utf-8 -*-
+from concurrent import futures
+import collections
+import contextlib
 import datetime
 import enum
 from itertools import chain
+import json
+import sqlite3
+import threading
+import time
+import uuid
 
 import peewee
+from playhouse import migrate
+from playhouse import pool
+from playhouse import postgres_ext
 
 from pydicom import Dataset
 from pydicom import valuerep
@@ -24,22 +35,59 @@ class DBDrivers(enum.Enum):
     POSTGRES = 'postgres'
 
 
+class Consistency(enum.Enum):
+    """Consistency requirements of read-only queries."""
+
+    #: Any replica will do, results may lag behind the primary
+    EVENTUAL = 'eventual'
+
+    #: Query has to see all writes committed on the primary before it started
+    READ_YOUR_WRITES = 'read-your-writes'
+
+
 class DBChannels(enum.Enum):
     """Available DB channel messages."""
 
     #: Get an atomic transaction
     ATOMIC = 'db-atomic'
 
+    #: Run function in a write transaction
+    WRITE = 'db-write'
+
+    #: Get a connection scope for a single operation
+    CONNECTION = 'db-connection'
+
+    #: Get database for read-only queries
+    REPLICA = 'db-replica'
+
+    #: Get connection pool statistics
+    POOL_STATS = 'db-pool-stats'
+
     #: Request a list of available tables from other components
     TABLES = 'db-get-tables'
 
+    #: Request schema migrations from other components
+    MIGRATIONS = 'db-get-migrations'
+
 
 class Database(component.Component):
     """DB component
 
     Handles database connections, transaction and all database models.
+
+    SQLite database can be run in WAL mode (`wal` config section). In that
+    mode all write transactions submitted via :attr:`DBChannels.WRITE` are
+    serialized by a single writer thread, while readers use their own
+    connections and are not blocked by ingest.
+
+    PostgreSQL read-only replicas can be provided in `replicas` config
+    section. Read-only queries are bound to the database returned via
+    :attr:`DBChannels.REPLICA`, according to their :class:`Consistency`.
+
+    Schema of existing databases is upgraded with versioned migrations
+    provided by components via :attr:`DBChannels.MIGRATIONS`. Applied
+    versions are kept in `schema_version` table.
     """
-    # TODO: Add thread locking for SQLite, to prevent timeout errors
 
     def __init__(self, bus: event_bus.EventBus, config: dict):
         """Initializes component
@@ -50,7 +98,21 @@ class Database(component.Component):
         :type config: dict
         """
         super().__init__(bus, config)
+        self._keep_alive = None
+        self._lock_type = None
+        #: Writer thread, used only by SQLite in WAL mode
+        self.writer = None
+        #: Captured query workload, see :mod:`tiny_pacs.index_report`
+        self.workload = None
+        #: Read-only replicas, used only by PostgreSQL
+        self.replicas = []
+        self._next_replica = 0
+        self._replica_lock = threading.Lock()
         self.subscribe(DBChannels.ATOMIC, self.atomic)
+        self.subscribe(DBChannels.WRITE, self.write)
+        self.subscribe(DBChannels.CONNECTION, self.connection)
+        self.subscribe(DBChannels.REPLICA, self.replica)
+        self.subscribe(DBChannels.POOL_STATS, self.pool_stats)
 
     def on_start(self):
         """Handles start event.
@@ -61,6 +123,33 @@ class Database(component.Component):
                             provided in component config
         """
         super().on_start()
+        self.open()
+
+        # Request all available tables
+        tables = self.broadcast(DBChannels.TABLES)
+        tables = list(chain.from_iterable(tables))
+
+        # Binds all tables to Database instance
+        DB.bind(tables + [SchemaVersion])
+        with self.connection():
+            self._create_tables(tables)
+        workload_file = self.config.get('workload_file')
+        if workload_file:
+            self.log_info('Capturing query workload to %s', workload_file)
+            self.workload = Workload(workload_file)
+            self.workload.attach(DB.obj)
+        if self.writer is not None:
+            self.writer.start()
+
+    def open(self):
+        """Initializes database driver.
+
+        Tables are neither created nor migrated, so database can be opened
+        by tools without starting the other components.
+
+        :raises ValueError: raise `ValueError` if unsupported DB driver is
+                            provided in component config
+        """
         db_driver = self.config.get('driver', DBDrivers.SQLITE)
         if db_driver == DBDrivers.SQLITE:
             self._init_sqlite()
@@ -69,13 +158,26 @@ class Database(component.Component):
         else:
             raise ValueError('Unsupported DB driver')
 
-        # Request all available tables
-        tables = self.broadcast(DBChannels.TABLES)
-        tables = list(chain.from_iterable(tables))
+    def on_exit(self):
+        """Handles exit event.
 
-        # Binds all tables to Database instance
-        DB.bind(tables)
-        self._create_tables(tables)
+        Closes pooled connections and reports pool statistics.
+        """
+        super().on_exit()
+        if self.writer is not None:
+            self.writer.stop()
+        if self.workload is not None:
+            self.workload.save()
+        stats = self.pool_stats()
+        if stats:
+            self.log_info('Connection pool: %r', stats)
+            DB.close_all()
+        for replica in self.replicas:
+            if isinstance(replica, PoolStatsMixin):
+                replica.close_all()
+        if self._keep_alive is not None:
+            self._keep_alive.close()
+            self._keep_alive = None
 
     def atomic(self):
         """Create an atomic transaction
@@ -83,18 +185,146 @@ class Database(component.Component):
         :return: atomic transaction
         :rtype: [type]
         """
+        if self._lock_type:
+            return DB.atomic(lock_type=self._lock_type)
         return DB.atomic()
 
+    def write(self, func, *args, **kwargs):
+        """Run function in a write transaction
+
+        If writer thread is running, function is executed by it and calling
+        thread waits for the result. Otherwise function is executed in the
+        calling thread.
+
+        :param func: function that performs database modifications
+        :return: value returned by the function
+        """
+        if self.writer is not None:
+            return self.writer.submit(func, *args, **kwargs)
+        with self.atomic():
+            return func(*args, **kwargs)
+
+    def connection(self):
+        """Create a connection scope
+
+        Connection is opened (or checked out from the pool) when the scope is
+        entered and is closed (returned to the pool) on exit. If thread
+        already has an open connection, scope reuses it and leaves it open.
+
+        :return: connection scope
+        :rtype: ConnectionScope
+        """
+        return ConnectionScope(DB.obj, self.replicas)
+
+    def replica(self, consistency: Consistency = Consistency.EVENTUAL):
+        """Database for read-only queries
+
+        Replicas are used in round-robin order. For
+        :attr:`Consistency.READ_YOUR_WRITES` only replicas that have already
+        replayed current primary WAL position are used, if none of them has,
+        query goes to the primary.
+
+        :param consistency: consistency requirement, defaults to
+                            Consistency.EVENTUAL
+        :type consistency: Consistency, optional
+        :return: peewee database
+        :rtype: peewee.Database
+        """
+        if not self.replicas:
+            return DB.obj
+        consistency = Consistency(consistency)
+        with self._replica_lock:
+            start = self._next_replica % len(self.replicas)
+            self._next_replica = (start + 1) % len(self.replicas)
+        replicas = self.replicas[start:] + self.replicas[:start]
+        if consistency == Consistency.EVENTUAL:
+            return replicas[0]
+
+        try:
+            lsn = self._primary_lsn()
+        except peewee.DatabaseError as e:
+            self.log_warning('Failed to get primary WAL position: %s', e)
+            return DB.obj
+        for replica in replicas:
+            try:
+                if self._replica_caught_up(replica, lsn):
+                    return replica
+            except peewee.DatabaseError as e:
+                self.log_warning('Replica %s is not available: %s',
+                                 replica.database, e)
+        return DB.obj
+
+    @staticmethod
+    def _primary_lsn():
+        return DB.execute_sql('SELECT pg_current_wal_lsn()').fetchone()[0]
+
+    @staticmethod
+    def _replica_caught_up(replica: peewee.Database, lsn) -> bool:
+        cursor = replica.execute_sql(
+            'SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn', (lsn,)
+        )
+        return bool(cursor.fetchone()[0])
+
+    def pool_stats(self) -> dict:
+        """Connection pool statistics
+
+        :return: pool statistics or empty dictionary if pool is not used
+        :rtype: dict
+        """
+        if isinstance(DB.obj, PoolStatsMixin):
+            return DB.obj.stats()
+        return {}
+
+    def _pool_params(self):
+        pool_config = self.config.get('pool')
+        if pool_config is None:
+            return None
+        return {
+            'max_connections': pool_config.get('max_connections', 20),
+            'stale_timeout': pool_config.get('stale_timeout', 300),
+            'timeout': pool_config.get('timeout', 10)
+        }
+
     def _init_sqlite(self):
         """Initializes SQLite database."""
         db_name = self.config.get('db_name')
         self.log_info('Initializing SQLite database %s', db_name)
+        pool_params = self._pool_params()
         if db_name:
-            DB.initialize(peewee.SqliteDatabase(db_name))
+            params = {}
         else:
-            DB.initialize(
-                peewee.SqliteDatabase('file:pacs?mode=memory&cache=shared', uri=True)
-            )
+            # Every component gets its own in-memory database
+            db_name = f'file:pacs_{uuid.uuid4().hex}?mode=memory&cache=shared'
+            params = {'uri': True}
+            # In-memory database exists only while it has open connections
+            self._keep_alive = sqlite3.connect(db_name, uri=True)
+        wal = self.config.get('wal', {})
+        if wal.get('on', False):
+            if self._keep_alive is None:
+                params.update(self._wal_params(wal))
+                self.writer = WriterThread(DB)
+                self._lock_type = 'IMMEDIATE'
+            else:
+                self.log_warning('WAL mode is not supported by in-memory database')
+        if pool_params is None:
+            DB.initialize(peewee.SqliteDatabase(db_name, **params))
+        else:
+            self.log_info('Using connection pool %r', pool_params)
+            # Pooled connections are handed over between threads
+            DB.initialize(PooledSqliteDatabase(
+                db_name, check_same_thread=False, **params, **pool_params
+            ))
+
+    def _wal_params(self, wal: dict) -> dict:
+        pragmas = {
+            'journal_mode': 'wal',
+            'synchronous': wal.get('synchronous', 'normal'),
+            'cache_size': wal.get('cache_size', -64 * 1024),
+            'mmap_size': wal.get('mmap_size', 256 * 1024 * 1024)
+        }
+        self.log_info('Using WAL mode with pragmas %r', pragmas)
+        # Busy timeout in seconds, set by sqlite3 module
+        return {'pragmas': pragmas, 'timeout': wal.get('busy_timeout', 30)}
 
     def _init_postgres(self):
         """Initializes PostgreSQL database."""
@@ -105,14 +335,425 @@ class Database(component.Component):
         password = self.config.get('password', 'postgres')
         self.log_info('Initializing PostgreSQL database with parameters: %s, %d %s',
                       host, port, user)
-        DB.initialize(peewee.PostgresqlDatabase(
-            db_name, host=host, port=port, user=user, password=password
-        ))
+        params = {'host': host, 'port': port, 'user': user, 'password': password}
+        DB.initialize(self._postgres_database(db_name, params))
+        for replica in self.config.get('replicas', []):
+            replica_params = dict(params)
+            replica_params.update(
+                (k, v) for k, v in replica.items() if k in params
+            )
+            self.log_info('Adding read-only replica: %s, %s',
+                          replica_params['host'], replica_params['port'])
+            self.replicas.append(self._postgres_database(
+                replica.get('db_name', db_name), replica_params
+            ))
+
+    def _postgres_database(self, db_name: str, params: dict):
+        pool_params = self._pool_params()
+        # Extended database is required for server-side cursors
+        if pool_params is None:
+            return postgres_ext.PostgresqlExtDatabase(db_name, **params)
+        self.log_info('Using connection pool %r', pool_params)
+        return PooledPostgresqlDatabase(db_name, **params, **pool_params)
 
     def _create_tables(self, tables: list):
-        self.log_debug('Creating %d table', len(tables))
-        for table in tables:
-            table.create_table(safe=True)
+        """Creates missing tables and applies pending migrations.
+
+        New tables are created with the current schema, so if none of the
+        tables existed before, all migrations are considered applied.
+        """
+        existing = set(DB.get_tables())
+        is_new = not any(t._meta.table_name in existing for t in tables)
+        missing = [t for t in tables if t._meta.table_name not in existing]
+        self.log_debug('Creating %d table', len(missing))
+        DB.create_tables(missing + [SchemaVersion], safe=True)
+
+        migrator = migrate.SchemaMigrator.from_database(DB.obj)
+        for name, migrations in self.broadcast(DBChannels.MIGRATIONS):
+            migrations = sorted(migrations, key=lambda m: m.version)
+            latest = migrations[-1].version if migrations else 0
+            schema, created = SchemaVersion.get_or_create(
+                component=name, defaults={'version': latest if is_new else 0}
+            )
+            for migration in migrations:
+                if migration.version <= schema.version:
+                    continue
+                self.log_info('Applying %s migration %d: %s', name,
+                              migration.version, migration.description)
+                with DB.atomic():
+                    migration.apply(migrator)
+                    schema.version = migration.version
+                    schema.applied = datetime.datetime.utcnow()
+                    schema.save()
+
+
+class SchemaVersion(peewee.Model):
+    """Applied schema version of a component"""
+
+    #: Name of the component that provides migrations
+    component = peewee.CharField(max_length=64, unique=True)
+
+    #: Version of the last applied migration
+    version = peewee.IntegerField(default=0)
+
+    #: Time when the last migration was applied
+    applied = peewee.DateTimeField(default=datetime.datetime.utcnow)
+
+    class Meta:
+        table_name = 'schema_version'
+
+
+class Migration:
+    """Versioned schema change.
+
+    Migrations are provided by components in response to
+    :attr:`DBChannels.MIGRATIONS` as a tuple of component name and list of
+    migrations. Each migration is applied in its own transaction. Since
+    databases created before versioning could be in any state, migrations
+    should check current schema rather than assume it (see
+    :func:`add_missing_columns` and :func:`sync_indexes`).
+
+    :ivar version: migration version, increasing within component
+    :ivar description: short description of the change
+    """
+
+    def __init__(self, version: int, description: str, func):
+        """Initializes migration
+
+        :param version: migration version
+        :type version: int
+        :param description: short description of the change
+        :type description: str
+        :param func: callable that accepts
+                     :class:`playhouse.migrate.SchemaMigrator`
+        """
+        self.version = version
+        self.description = description
+        self._func = func
+
+    def __repr__(self):
+        return f'Migration({self.version!r}, {self.description!r})'
+
+    def apply(self, migrator: migrate.SchemaMigrator):
+        """Applies migration
+
+        :param migrator: schema migrator for current database
+        :type migrator: migrate.SchemaMigrator
+        """
+        self._func(migrator)
+
+
+def add_missing_columns(migrator: migrate.SchemaMigrator, model) -> list:
+    """Adds model columns that are missing from the database table
+
+    :param migrator: schema migrator
+    :type migrator: migrate.SchemaMigrator
+    :param model: peewee model
+    :return: list of added column names
+    :rtype: list
+    """
+    table = model._meta.table_name
+    existing = set(c.name for c in DB.get_columns(table))
+    fields = [f for f in model._meta.sorted_fields
+              if f.column_name not in existing]
+    if fields:
+        migrate.migrate(*(
+            migrator.add_column(table, f.column_name, f) for f in fields
+        ))
+    return [f.column_name for f in fields]
+
+
+def sync_indexes(migrator: migrate.SchemaMigrator, model,
+                 preserve=None) -> tuple:
+    """Makes table indexes match model declaration
+
+    Indexes that are not declared by the model are dropped (unique indexes
+    are kept, since they enforce constraints), declared indexes that are
+    missing are created.
+
+    :param migrator: schema migrator
+    :type migrator: migrate.SchemaMigrator
+    :param model: peewee model
+    :param preserve: predicate that accepts index name and returns `True`
+                     if undeclared index should be kept, defaults to None
+    :return: tuple of two lists: dropped and created index names
+    :rtype: tuple
+    """
+    table = model._meta.table_name
+    declared = set(i._name for i in model._meta.fields_to_index())
+    existing = DB.get_indexes(table)
+    dropped = [
+        i.name for i in existing
+        if i.name not in declared and not i.unique and
+        not (preserve and preserve(i.name))
+    ]
+    if dropped:
+        migrate.migrate(*(migrator.drop_index(table, i) for i in dropped))
+    created = declared - set(i.name for i in existing)
+    model._schema.create_indexes(safe=True)
+    return dropped, sorted(created)
+
+
+class Workload:
+    """Captured query workload.
+
+    Distinct SELECT statements executed by the database are counted along
+    with sample parameters, so their plans can be analyzed later (see
+    :mod:`tiny_pacs.index_report`).
+
+    :ivar file_name: file workload is saved to
+    :ivar queries: mapping of SQL to a list of count and sample parameters
+    """
+
+    def __init__(self, file_name: str = None):
+        """Initializes workload
+
+        :param file_name: file workload is saved to, defaults to None
+        :type file_name: str, optional
+        """
+        self.file_name = file_name
+        self.queries = {}
+        self._lock = threading.Lock()
+
+    def attach(self, database: peewee.Database):
+        """Starts capturing queries executed by database
+
+        :param database: peewee database
+        :type database: peewee.Database
+        """
+        execute_sql = database.execute_sql
+
+        def capture(sql, params=None, *args, **kwargs):
+            self.record(sql, params)
+            return execute_sql(sql, params, *args, **kwargs)
+
+        database.execute_sql = capture
+
+    def record(self, sql: str, params=None):
+        """Counts query execution
+
+        :param sql: executed SQL
+        :type sql: str
+        :param params: query parameters, defaults to None
+        """
+        if not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+            return
+        with self._lock:
+            entry = self.queries.get(sql)
+            if entry is None:
+                self.queries[sql] = [1, list(params or ())]
+            else:
+                entry[0] += 1
+
+    def save(self, file_name: str = None):
+        """Saves workload as JSON
+
+        :param file_name: target file, defaults to workload file
+        :type file_name: str, optional
+        """
+        with self._lock:
+            queries = [
+                {'sql': sql, 'count': count, 'params': params}
+                for sql, (count, params) in self.queries.items()
+            ]
+        with open(file_name or self.file_name, 'w') as fp:
+            json.dump({'queries': queries}, fp, indent=2, default=str)
+
+    @classmethod
+    def load(cls, file_name: str):
+        """Loads saved workload
+
+        :param file_name: workload file
+        :type file_name: str
+        :return: workload
+        :rtype: Workload
+        """
+        with open(file_name) as fp:
+            data = json.load(fp)
+        workload = cls(file_name)
+        for query in data['queries']:
+            workload.queries[query['sql']] = [query['count'], query['params']]
+        return workload
+
+
+class ConnectionScope:
+    """Context manager that keeps database connection open for a single
+    operation (e.g. DIMSE request)
+
+    Connections to replicas are opened on demand. Any connection that was
+    closed when the scope was entered is closed on exit, including the ones
+    that were opened lazily inside it (e.g. reopened after nested scope
+    had closed them).
+
+    :ivar database: peewee database
+    :ivar replicas: list of read-only replicas
+    """
+
+    def __init__(self, database: peewee.Database, replicas: list = ()):
+        self.database = database
+        self.replicas = replicas
+        self._was_open = True
+        self._closed_replicas = []
+
+    def __enter__(self):
+        self._was_open = not self.database.is_closed()
+        self.database.connect(reuse_if_open=True)
+        self._closed_replicas = [r for r in self.replicas if r.is_closed()]
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for replica in self._closed_replicas:
+            if not replica.is_closed():
+                replica.close()
+        self._closed_replicas = []
+        if not self._was_open and not self.database.is_closed():
+            self.database.close()
+        self._was_open = True
+
+
+class WriterThread:
+    """Thread that runs all write transactions one after another.
+
+    SQLite allows only one writer at a time, so instead of competing for
+    the database lock (and failing with "database is locked" errors) writes
+    are queued and executed in order by a single thread with its own
+    connection.
+
+    :ivar database: peewee database
+    """
+
+    def __init__(self, database: peewee.Database):
+        """Initializes writer
+
+        :param database: peewee database
+        :type database: peewee.Database
+        """
+        self.database = database
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """Starts writer thread"""
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name='DBWriter', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Executes all queued writes and stops writer thread"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, func, *args, **kwargs):
+        """Executes function in a write transaction and waits for the result
+
+        Nested writes (submitted by the writer thread itself) are executed
+        right away within the current transaction.
+
+        :param func: function that performs database modifications
+        :raises RuntimeError: if writer is not running
+        :return: value returned by the function
+        """
+        if threading.current_thread() is self._thread:
+            with self.database.atomic():
+                return func(*args, **kwargs)
+        future = futures.Future()
+        with self._cond:
+            if self._thread is None or self._stopping:
+                raise RuntimeError('Writer thread is not running')
+            self._queue.append((future, func, args, kwargs))
+            self._cond.notify_all()
+        return future.result()
+
+    def _next(self):
+        with self._cond:
+            while not self._queue:
+                if self._stopping:
+                    return None
+                self._cond.wait()
+            return self._queue.popleft()
+
+    def _run(self):
+        with ConnectionScope(self.database):
+            while True:
+                item = self._next()
+                if item is None:
+                    break
+                future, func, args, kwargs = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with self.database.atomic(lock_type='IMMEDIATE'):
+                        result = func(*args, **kwargs)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+
+
+class PoolStatsMixin:
+    """Connection pool mixin that keeps track of connection checkouts.
+
+    :ivar checkouts: number of connections taken from the pool
+    :ivar connects: number of new connections opened by the pool
+    :ivar wait_time: total time spent waiting for connection
+    :ivar max_wait_time: maximum time spent waiting for connection
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.connects = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _connect(self):
+        start = time.monotonic()
+        idle = len(self._connections)
+        conn = super()._connect()
+        elapsed = time.monotonic() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            if not idle:
+                self.connects += 1
+            self.wait_time += elapsed
+            self.max_wait_time = max(self.max_wait_time, elapsed)
+        return conn
+
+    def stats(self) -> dict:
+        """Pool statistics
+
+        :return: dictionary with pool size, usage and checkout timings
+        :rtype: dict
+        """
+        with self._stats_lock:
+            return {
+                'max_connections': self._max_connections,
+                'in_use': len(self._in_use),
+                'idle': len(self._connections),
+                'checkouts': self.checkouts,
+                'connects': self.connects,
+                'avg_wait_time': (
+                    self.wait_time / self.checkouts if self.checkouts else 0.0
+                ),
+                'max_wait_time': self.max_wait_time
+            }
+
+
+class PooledSqliteDatabase(PoolStatsMixin, pool.PooledSqliteDatabase):
+    """Pooled SQLite database with checkout statistics"""
+
+
+class PooledPostgresqlDatabase(PoolStatsMixin, pool.PooledPostgresqlExtDatabase):
+    """Pooled PostgreSQL database with checkout statistics"""
 
 
 def string_agg_func():
@@ -121,3 +762,142 @@ def string_agg_func():
     elif isinstance(DB.obj, peewee.PostgresqlDatabase):
         return getattr(peewee.fn, 'string_agg')
     raise ValueError(f'Unexpected DB object {DB.obj}')
+
+
+def stream(query, chunk_size: int = 1000):
+    """Iterates over query results without caching them
+
+    On PostgreSQL rows are fetched from a server-side cursor in chunks,
+    SQLite cursor fetches rows one by one. Either way memory usage doesn't
+    depend on the size of the result.
+
+    :param query: select query
+    :type query: peewee.Select
+    :param chunk_size: number of rows fetched at once, defaults to 1000
+    :type chunk_size: int, optional
+    :return: iterator over query rows
+    """
+    database = query._database
+    if isinstance(database, peewee.DatabaseProxy):
+        database = database.obj
+    if isinstance(database, postgres_ext.PostgresqlExtDatabase):
+        return postgres_ext.ServerSide(query, array_size=chunk_size)
+    return _iterate(query)
+
+
+def _iterate(query):
+    """Executes query on the first row, cursor is closed once iteration
+    stops (e.g. generator is closed before all rows are fetched)"""
+    wrapper = query.execute()
+    try:
+        yield from wrapper.iterator()
+    finally:
+        wrapper.cursor.close()
+
+
+class QueryTimeoutError(peewee.OperationalError):
+    """Query was interrupted, since it exceeded its time limit"""
+
+
+# SQLSTATE of statements canceled by PostgreSQL (e.g. on statement_timeout)
+QUERY_CANCELED = '57014'
+
+
+class QueryDeadline:
+    """Time limit of queries, that counts only the time spent in the database
+
+    Clock is paused while results are handled by the caller (see
+    :meth:`paused`), so a slow peer doesn't use up query time.
+
+    :ivar timeout: time limit in seconds, `None` for no limit
+    :ivar expired: query was interrupted, since limit was exceeded
+    """
+
+    def __init__(self, timeout: float = None):
+        self.timeout = timeout
+        self.expired = False
+        self._remaining = timeout
+        self._started = time.monotonic()
+
+    def exceeded(self) -> bool:
+        """Progress handler, that interrupts query once time is up
+
+        :return: `True` if query has to be interrupted
+        :rtype: bool
+        """
+        if self._started is None or not self.timeout:
+            return False
+        if time.monotonic() - self._started > self._remaining:
+            self.expired = True
+        return self.expired
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Context manager that stops the clock, while results are handled
+        outside of the database"""
+        if self._started is None:
+            yield
+            return
+        self._remaining -= time.monotonic() - self._started
+        self._started = None
+        try:
+            yield
+        finally:
+            self._started = time.monotonic()
+
+
+def _statement_canceled(error: Exception) -> bool:
+    """Checks if PostgreSQL error was caused by statement cancellation
+
+    Errors raised while rows are fetched come from the driver as is, the
+    ones raised by peewee wrap driver errors.
+    """
+    original = error.args[0] if error.args else None
+    return QUERY_CANCELED in (getattr(error, 'pgcode', None),
+                              getattr(original, 'pgcode', None))
+
+
+@contextlib.contextmanager
+def query_timeout(database: peewee.Database, timeout: float):
+    """Context manager that limits execution time of queries
+
+    Limit is enforced by the database itself: PostgreSQL cancels statements
+    that run longer than `statement_timeout`, SQLite statements are
+    interrupted by progress handler once the time spent in the database
+    has exceeded the limit. Only errors caused by these interruptions are
+    reported as timeouts.
+
+    :param database: peewee database
+    :type database: peewee.Database
+    :param timeout: time limit in seconds, `None` for no limit
+    :type timeout: float
+    :raises QueryTimeoutError: query exceeded time limit
+    :return: query deadline
+    :rtype: QueryDeadline
+    """
+    deadline = QueryDeadline(timeout)
+    if not timeout:
+        yield deadline
+        return
+    if isinstance(database, peewee.DatabaseProxy):
+        database = database.obj
+    is_postgres = isinstance(database, peewee.PostgresqlDatabase)
+    if is_postgres:
+        database.execute_sql('SET statement_timeout = %s',
+                             (int(timeout * 1000),))
+    else:
+        conn = database.connection()
+        conn.set_progress_handler(deadline.exceeded, 1000)
+    try:
+        yield deadline
+    except Exception as e:  # pylint: disable=broad-except
+        if deadline.expired or (is_postgres and _statement_canceled(e)):
+            raise QueryTimeoutError(
+                f'Query exceeded time limit of {timeout}s'
+            ) from e
+        raise
+    finally:
+        if is_postgres:
+            database.execute_sql('SET statement_timeout = DEFAULT')
+        else:
+            conn.set_progress_handler(None, 1000)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Encoding of C-FIND responses directly from database rows.
+
+Response layout (tags and VRs) is known once the query is compiled, so
+element headers are prepared in advance and every row is written straight
+into bytes, without creating :class:`pydicom.Dataset` and its elements.
+Encoded data set is identical to the one produced by pydicom. Values that
+can't be written as plain ASCII (e.g. names in other character sets) are
+encoded by pydicom itself.
+"""
+import re
+import struct
+
+from pydicom.dataelem import DataElement
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_data_element
+
+
+#: Specific Character Set (0008, 0005) CS
+SPECIFIC_CHARACTER_SET = 0x00080005
+
+#: VRs with 4 byte value length in explicit VR encoding
+LONG_LENGTH_VRS = set([
+    'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'SQ', 'SV', 'UC', 'UN', 'UR', 'UT',
+    'UV'
+])
+
+#: String VRs that are written as is
+STRING_VRS = set([
+    'AE', 'AS', 'CS', 'DA', 'DT', 'LO', 'LT', 'PN', 'SH', 'ST', 'TM', 'UC',
+    'UI', 'UR', 'UT'
+])
+
+#: Integer string, pydicom keeps original string of the valid ones
+IS_RE = re.compile(r'\s*[+-]?[0-9]+\s*', re.ASCII)
+
+#: Decimal string, pydicom keeps original string of the valid ones
+DS_RE = re.compile(
+    r'\s*[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?\s*', re.ASCII
+)
+
+_NUMBER_RE = {'IS': IS_RE, 'DS': DS_RE}
+
+
+class ResponseEncoder:
+    """Writes C-FIND response data sets from database rows
+
+    Only little endian transfer syntaxes are supported, big endian is
+    retired and is left to pydicom.
+
+    :ivar encoding: response Specific Character Set
+    :ivar is_implicit_VR: data set is encoded with implicit VR
+    """
+
+    def __init__(self, response_attrs: list, encoding,
+                 is_implicit_VR: bool = True, is_little_endian: bool = True):
+        """Prepares response layout
+
+        :param response_attrs: list of response attributes (tag, column index
+                               in the row, VR and conversion function)
+        :type response_attrs: list
+        :param encoding: response Specific Character Set
+        :param is_implicit_VR: use implicit VR, defaults to True
+        :type is_implicit_VR: bool, optional
+        :param is_little_endian: use little endian, defaults to True
+        :type is_little_endian: bool, optional
+        :raises ValueError: big endian transfer syntax is requested
+        """
+        if not is_little_endian:
+            raise ValueError('Only little endian encoding is supported')
+        # Multiple character sets are split the same way as in the dataset
+        self.encoding = DataElement(
+            SPECIFIC_CHARACTER_SET, 'CS', encoding
+        ).value
+        self.is_implicit_VR = is_implicit_VR
+        elements = {
+            SPECIFIC_CHARACTER_SET: (
+                self._pydicom_element(SPECIFIC_CHARACTER_SET, 'CS', encoding),
+                None, None, None, None
+            )
+        }
+        for tag, index, vr, func in response_attrs:
+            if index is None:
+                # Attribute not supported, always empty
+                elements[tag] = (
+                    self._header(tag, vr, 0), None, None, None, None
+                )
+            else:
+                elements[tag] = (None, tag, index, vr, func)
+        # Elements are written in tag order, retired group length is skipped
+        self._elements = [
+            elements[tag] for tag in sorted(elements)
+            if tag & 0xffff or tag >> 16 <= 6
+        ]
+
+    def encode(self, row: tuple) -> bytes:
+        """Encodes response data set
+
+        :param row: database row
+        :type row: tuple
+        :return: encoded data set
+        :rtype: bytes
+        """
+        parts = []
+        for const, tag, index, vr, func in self._elements:
+            if const is not None:
+                parts.append(const)
+                continue
+            value = row[index]
+            if func:
+                value = func(value)
+            parts.append(self._element(tag, vr, value))
+        return b''.join(parts)
+
+    def _element(self, tag: int, vr: str, value) -> bytes:
+        if value is None:
+            return self._header(tag, vr, 0)
+        if type(value) is int and vr == 'IS':
+            value = str(value)
+        elif not isinstance(value, str) or not value.isascii():
+            return self._pydicom_element(tag, vr, value)
+        elif vr in _NUMBER_RE:
+            match = _NUMBER_RE[vr].fullmatch
+            if not all(v == '' or match(v) for v in value.split('\\')):
+                return self._pydicom_element(tag, vr, value)
+        elif vr not in STRING_VRS:
+            return self._pydicom_element(tag, vr, value)
+
+        data = value.encode('ascii')
+        if len(data) % 2:
+            data += b'\0' if vr == 'UI' else b' '
+        if len(data) > 0xffff and vr not in LONG_LENGTH_VRS:
+            return self._pydicom_element(tag, vr, value)
+        return self._header(tag, vr, len(data)) + data
+
+    def _header(self, tag: int, vr: str, length: int) -> bytes:
+        group, element = tag >> 16, tag & 0xffff
+        if self.is_implicit_VR:
+            return struct.pack('<HHL', group, element, length)
+        if vr in LONG_LENGTH_VRS:
+            return struct.pack('<HH2s2xL', group, element, vr.encode(), length)
+        return struct.pack('<HH2sH', group, element, vr.encode(), length)
+
+    def _pydicom_element(self, tag: int, vr: str, value) -> bytes:
+        fp = DicomBytesIO()
+        fp.is_implicit_VR = self.is_implicit_VR
+        fp.is_little_endian = True
+        write_data_element(fp, DataElement(tag, vr, value), self.encoding)
+        return fp.getvalue()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""Reports unused and redundant indexes against captured query workload.
+
+Workload is captured by the Database component when `workload_file` is set
+in its configuration. Report is built against the same database, using the
+same configuration. Only the database is opened, components are not
+started, so no migrations or storage maintenance are run::
+
+    python -m tiny_pacs.index_report -c config.yml -w workload.json
+"""
+import argparse
+import re
+
+import peewee
+
+from . import config
+from . import db
+from . import event_bus
+
+
+#: Index name in SQLite query plan
+SQLITE_INDEX_RE = re.compile(r'USING (?:COVERING )?INDEX (\S+)')
+
+
+def query_indexes(database: peewee.Database, sql: str, params: list) -> set:
+    """Indexes used by the query plan
+
+    :param database: peewee database
+    :type database: peewee.Database
+    :param sql: query SQL
+    :type sql: str
+    :param params: query parameters
+    :type params: list
+    :return: set of index names
+    :rtype: set
+    """
+    if isinstance(database, peewee.PostgresqlDatabase):
+        cursor = database.execute_sql(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+        return set(_plan_indexes(plan))
+    cursor = database.execute_sql(f'EXPLAIN QUERY PLAN {sql}', params)
+    return set(
+        m.group(1) for row in cursor.fetchall()
+        for m in SQLITE_INDEX_RE.finditer(row[-1])
+    )
+
+
+def _plan_indexes(plan):
+    if isinstance(plan, list):
+        for item in plan:
+            yield from _plan_indexes(item)
+    elif isinstance(plan, dict):
+        for key, value in plan.items():
+            if key == 'Index Name':
+                yield value
+            else:
+                yield from _plan_indexes(value)
+
+
+def index_report(database: peewee.Database, tables: list,
+                 workload: db.Workload) -> dict:
+    """Builds index usage report
+
+    Index is considered redundant if its columns are a prefix of another
+    index of the same table. Unique indexes are never reported as unused,
+    since they enforce constraints.
+
+    :param database: peewee database
+    :type database: peewee.Database
+    :param tables: list of models
+    :type tables: list
+    :param workload: captured workload
+    :type workload: db.Workload
+    :return: dictionary with index usage counts, unused and redundant
+             indexes and queries that could not be explained
+    :rtype: dict
+    """
+    usage = {}
+    failed = []
+    for sql, (count, params) in workload.queries.items():
+        try:
+            indexes = query_indexes(database, sql, params)
+        except peewee.DatabaseError:
+            failed.append(sql)
+            continue
+        for index in indexes:
+            usage[index] = usage.get(index, 0) + count
+
+    unused = []
+    redundant = []
+    for model in tables:
+        indexes = database.get_indexes(model._meta.table_name)
+        for index in indexes:
+            if not index.unique and index.name not in usage:
+                unused.append(index.name)
+            if index.unique:
+                continue
+            for other in indexes:
+                if other.name == index.name:
+                    continue
+                columns = other.columns[:len(index.columns)]
+                if columns == index.columns and (
+                        len(other.columns) > len(index.columns) or
+                        other.unique or other.name < index.name):
+                    redundant.append((index.name, other.name))
+                    break
+    return {
+        'usage': usage,
+        'unused': sorted(unused),
+        'redundant': sorted(redundant),
+        'failed': failed
+    }
+
+
+def main():
+    args = parse_args()
+    pacs_conf = config.Config()
+    pacs_conf.update_config(args.config)
+    bus = event_bus.EventBus()
+    components = pacs_conf.components
+    database = db.Database(bus, components.get('Database', {}))
+    database.open()
+    tables = [
+        t for name, conf in components.items()
+        if conf.get('on', False) and name in config.COMPONENT_REGISTRY
+        for t in component_tables(config.COMPONENT_REGISTRY[name])
+    ]
+    try:
+        with database.connection():
+            report = index_report(
+                db.DB.obj, tables, db.Workload.load(args.workload)
+            )
+    finally:
+        bus.broadcast_nothrow(event_bus.DefaultChannels.ON_EXIT)
+
+    print('Index usage:')
+    for name, count in sorted(report['usage'].items(), key=lambda i: -i[1]):
+        print(f'  {name}: {count}')
+    print('Unused indexes:')
+    for name in report['unused']:
+        print(f'  {name}')
+    print('Redundant indexes:')
+    for name, other in report['redundant']:
+        print(f'  {name} (covered by {other})')
+    if report['failed']:
+        print(f'Failed to explain {len(report["failed"])} queries')
+
+
+def component_tables(component) -> list:
+    """Tables of component class, without creating the component
+
+    :param component: component class
+    :return: list of models
+    :rtype: list
+    """
+    tables = getattr(component, 'tables', None)
+    return tables() if tables is not None else []
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Report unused and redundant indexes'
+    )
+    parser.add_argument('-c', '--config', default=[], nargs='*',
+                        help='Tiny PACS configuration')
+    parser.add_argument('-w', '--workload', required=True,
+                        help='Captured query workload')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    main()
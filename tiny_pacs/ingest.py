@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+import collections
+import io
+import logging
+import threading
+import time
+
+import pydicom
+from pydicom import filereader
+
+try:
+    # Reads only file meta group from an open file, there is no public
+    # equivalent for file-like objects in pydicom 2.x
+    from pydicom.filereader import _read_file_meta_info
+except ImportError:  # pragma: no cover
+    _read_file_meta_info = None
+
+
+def read_file_meta(fp) -> pydicom.Dataset:
+    """Reads file meta information from the current position of the file
+
+    :param fp: file-like object positioned at the start of the file
+               (preamble)
+    :return: file meta information
+    :rtype: pydicom.Dataset
+    """
+    if _read_file_meta_info is None:  # pragma: no cover
+        ds = pydicom.dcmread(fp, stop_before_pixels=True,
+                             specific_tags=['SOPInstanceUID'])
+        return ds.file_meta
+    filereader.read_preamble(fp, False)
+    return _read_file_meta_info(fp)
+
+
+class IngestContext:
+    """Incoming C-STORE dataset
+
+    Context is created once per C-STORE request by the AE and is passed to
+    every :attr:`~tiny_pacs.ae.AEChannels.STORE` and
+    :attr:`~tiny_pacs.storage.StorageChannels.ON_STORE_DONE` subscriber.
+    Dataset header is decoded at most once and shared between them.
+
+    :ivar context: presentation context
+    :ivar fp: file-like object that holds received dataset (including
+              file meta information)
+    :ivar attempts: number of failed write-behind indexing attempts
+    """
+
+    def __init__(self, context, fp, header: pydicom.Dataset = None):
+        """Initializes ingest context
+
+        :param context: presentation context
+        :type context: pynetdicom2.asceprovider.PContextDef
+        :param fp: file-like object with received dataset
+        :type fp: file
+        :param header: already parsed dataset header, defaults to None
+        :type header: pydicom.Dataset, optional
+        """
+        self.context = context
+        self.fp = fp
+        self._header = header
+        self._meta = None
+        self.attempts = 0
+
+    def __repr__(self):
+        return f'IngestContext({self.context!r}, {self.fp!r})'
+
+    @property
+    def header(self) -> pydicom.Dataset:
+        """Received dataset without Pixel Data.
+
+        Dataset is parsed on first access, file position is restored
+        afterwards.
+
+        :return: dataset header
+        :rtype: pydicom.Dataset
+        """
+        if self._header is None:
+            start = self.fp.tell()
+            try:
+                self._header = pydicom.dcmread(self.fp, stop_before_pixels=True)
+            finally:
+                self.fp.seek(start)
+        return self._header
+
+    @property
+    def meta(self) -> pydicom.Dataset:
+        """File meta information of the received dataset.
+
+        If header was not parsed yet (or could not be parsed) only file meta
+        group is read from the file.
+
+        :return: file meta information
+        :rtype: pydicom.Dataset
+        """
+        if self._header is not None:
+            return getattr(self._header, 'file_meta', self._header)
+        if self._meta is None:
+            start = self.fp.tell()
+            try:
+                self._meta = read_file_meta(self.fp)
+            finally:
+                self.fp.seek(start)
+        return self._meta
+
+    @property
+    def sop_instance_uid(self) -> str:
+        """SOP Instance UID of the received dataset"""
+        if self._header is not None:
+            return self._header.SOPInstanceUID
+        return self.meta.MediaStorageSOPInstanceUID
+
+
+class DiscardedDataset(io.RawIOBase):
+    """File-like object that discards received dataset
+
+    Returned instead of a real file for datasets that should not be stored
+    (e.g. duplicates), so they are received without any disk writes.
+
+    :ivar sop_instance_uid: SOP Instance UID of the discarded dataset
+    """
+
+    def __init__(self, sop_instance_uid: str):
+        super().__init__()
+        self.sop_instance_uid = sop_instance_uid
+        self._position = 0
+        self._size = 0
+
+    def __repr__(self):
+        return f'DiscardedDataset({self.sop_instance_uid!r})'
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def write(self, data):
+        self._position += len(data)
+        self._size = max(self._size, self._position)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+
+class IndexWriter:
+    """Background writer for write-behind indexing of received datasets.
+
+    Items are put into in-process queue and are handed over to the handler
+    in batches: either when `batch_size` items are queued or when the oldest
+    queued item waited for `interval` seconds. Handler is expected to index
+    the whole batch in a single transaction.
+
+    :ivar batch_size: maximum number of items in one batch
+    :ivar interval: maximum time in seconds item waits in the queue
+    """
+
+    def __init__(self, handler, batch_size: int = 100, interval: float = 0.05):
+        """Initializes writer
+
+        :param handler: callable that accepts a list of queued items
+        :param batch_size: maximum batch size, defaults to 100
+        :type batch_size: int, optional
+        :param interval: maximum queueing time in seconds, defaults to 0.05
+        :type interval: float, optional
+        """
+        self.batch_size = batch_size
+        self.interval = interval
+        self.log = logging.getLogger('IndexWriter')
+        self._handler = handler
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        # Sequence numbers of items that are not written yet, in the order
+        # they were put into the queue (retried items keep their numbers)
+        self._pending = collections.OrderedDict()
+        self._next_seq = 0
+        self._batch = {}
+        self._flush_requests = 0
+        self._stopping = False
+        self._thread = None
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def start(self):
+        """Starts writer thread"""
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name='IndexWriter', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Writes all queued items and stops writer thread"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def put(self, item):
+        """Puts item into the queue
+
+        :param item: item that should be written
+        """
+        with self._cond:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._pending[seq] = None
+            self._queue.append((time.monotonic(), seq, item))
+            self._cond.notify_all()
+
+    def retry(self, item):
+        """Puts item of the batch, that is being written, into the queue
+        again. Should be called by the handler.
+
+        Item is not considered written, until handler processes it without
+        retrying, so :meth:`flush` waits for it as well.
+
+        :param item: item from the current batch
+        """
+        with self._cond:
+            seq = self._batch.pop(id(item))
+            self._queue.append((time.monotonic(), seq, item))
+            self._cond.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Waits until all items queued before the call are written,
+        including their retries
+
+        :param timeout: maximum time to wait in seconds, defaults to None
+        :type timeout: float, optional
+        :return: `True` if all items were written, `False` on timeout
+        :rtype: bool
+        """
+        if self._thread is None or threading.current_thread() is self._thread:
+            return True
+        with self._cond:
+            target = self._next_seq
+            if self._written_before(target):
+                return True
+            self._flush_requests += 1
+            self._cond.notify_all()
+            try:
+                return self._cond.wait_for(
+                    lambda: self._written_before(target), timeout
+                )
+            finally:
+                self._flush_requests -= 1
+
+    def _written_before(self, seq: int) -> bool:
+        return not self._pending or next(iter(self._pending)) >= seq
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._queue:
+                    if (len(self._queue) >= self.batch_size or
+                            self._flush_requests or self._stopping):
+                        break
+                    queued_at, _, _ = self._queue[0]
+                    wait = queued_at + self.interval - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                elif self._stopping:
+                    return None
+                else:
+                    self._cond.wait()
+
+            size = min(len(self._queue), self.batch_size)
+            batch = [self._queue.popleft() for _ in range(size)]
+            self._batch = {id(item): seq for _, seq, item in batch}
+            return [item for _, _, item in batch]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            try:
+                self._handler(batch)
+            except Exception:
+                self.log.exception('Failed to write batch of %d items', len(batch))
+            finally:
+                with self._cond:
+                    for seq in self._batch.values():
+                        del self._pending[seq]
+                    self._batch = {}
+                    self._cond.notify_all()
@@ -1,16 +1,22 @@
 # -*- coding: utf-8 -*-
 import enum
+import threading
 from itertools import chain
 
 import peewee
 import pydicom
-from pydicom.tag import Tag
+from pydicom.multival import MultiValue
 from pynetdicom2 import statuses
 
 from . import ae
+from . import cache
+from . import columnar
 from . import component
 from . import db
+from . import encoder
 from . import event_bus
+from . import ingest
+from . import services
 from . import storage
 
 
@@ -30,6 +36,17 @@ EXCLUDED_ATTRS = set([
 ])
 
 
+#: Suffix of normalized search columns
+SEARCH_SUFFIX = '_search'
+
+#: Suffixes of search column indexes, that are created outside of models
+#: (see :meth:`PACS.create_pattern_indexes` and
+#: :meth:`PACS.create_trigram_indexes`)
+SEARCH_INDEX_SUFFIXES = ('_pattern', '_trgm')
+
+#: Suffix of numeric date and time columns
+NUMERIC_SUFFIX = '_num'
+
 #: List of text VRs
 TEXT_VR = ['AE', 'CS', 'LO', 'LT', 'PN', 'SH', 'ST', 'UC', 'UR', 'UT', 'UI']
 
@@ -83,12 +100,89 @@ class PACS(component.Component):
         :type config: dict
         """
         super().__init__(bus, config)
+        #: Patient/Study/Series row ids, used by C-STORE
+        self.lookup_cache = cache.LRUCache(
+            config.get('lookup_cache_size', 10000)
+        )
+
+        #: Compiled C-FIND queries keyed by request shape
+        self.plan_cache = cache.LRUCache(config.get('plan_cache_size', 1024))
+
+        find_cache = config.get('find_cache', {})
+        if find_cache.get('on', False):
+            #: C-FIND results keyed by request, see :class:`CachedFind`
+            self.find_cache = cache.LRUCache(
+                find_cache.get('size', 1024), find_cache.get('ttl', 30)
+            )
+            #: Results of larger requests are not cached
+            self.find_cache_max_results = find_cache.get('max_results', 1000)
+        else:
+            self.find_cache = None
+        self._store_generation = 0
+        self._find_cache_lock = threading.Lock()
+
+        #: Maximum number of C-FIND results per level
+        self.find_max_results = config.get('find_max_results', {})
+        #: Maximum number of C-FIND results per calling AE
+        self.find_ae_max_results = config.get('find_ae_max_results', {})
+        #: C-FIND query time limit in seconds
+        self.find_timeout = config.get('find_timeout')
+
+        #: Consistency of C-FIND queries
+        self.find_consistency = db.Consistency(
+            config.get('find_consistency', db.Consistency.EVENTUAL)
+        )
+        #: Consistency of C-MOVE and C-GET queries
+        self.retrieve_consistency = db.Consistency(
+            config.get('retrieve_consistency', db.Consistency.READ_YOUR_WRITES)
+        )
+        #: Number of instances that are looked up in storage at once by
+        #: C-MOVE and C-GET
+        self.retrieve_batch_size = config.get('retrieve_batch_size', 500)
+
+        #: C-FIND levels handled by in-memory columnar engine
+        self.columnar_levels = set(
+            level for level, engine in config.get('find_engine', {}).items()
+            if engine == 'columnar'
+        )
+        if self.columnar_levels:
+            deepest = max(QR_LEVEL[level].value for level in self.columnar_levels)
+            #: In-memory columnar index
+            self.columnar = columnar.ColumnarIndex(
+                list(LEVEL_MODELS.values())[:deepest + 1]
+            )
+            self.subscribe(event_bus.DefaultChannels.ON_START,
+                           self.load_columnar, self.priority + 10)
+        else:
+            self.columnar = None
+
+        write_behind = config.get('write_behind', {})
+        if write_behind.get('on', False):
+            #: Write-behind indexing queue
+            self.index_writer = ingest.IndexWriter(
+                self._index_batch,
+                write_behind.get('batch_size', 100),
+                write_behind.get('interval', 0.05)
+            )
+            #: Number of indexing attempts before dataset is quarantined
+            self.index_attempts = write_behind.get('attempts', 3)
+            # Database has to be initialized before queue is recovered
+            self.subscribe(event_bus.DefaultChannels.ON_START,
+                           self.start_index_writer, self.priority + 10)
+        else:
+            self.index_writer = None
+        self.subscribe(event_bus.DefaultChannels.ON_START,
+                       self.create_pattern_indexes, self.priority + 10)
+        if config.get('trigram_index', False):
+            self.subscribe(event_bus.DefaultChannels.ON_START,
+                           self.create_trigram_indexes, self.priority + 10)
         self.subscribe(ae.AEChannels.STORE, self.on_store)
         self.subscribe(ae.AEChannels.FIND, self.on_find)
         self.subscribe(ae.AEChannels.MOVE, self.on_move)
         self.subscribe(ae.AEChannels.GET, self.on_get)
         self.subscribe(ae.AEChannels.COMMITMENT, self.on_commitment)
         self.subscribe(db.DBChannels.TABLES, self.tables)
+        self.subscribe(db.DBChannels.MIGRATIONS, self.migrations)
 
     @staticmethod
     def tables():
@@ -99,6 +193,15 @@ class PACS(component.Component):
         """
         return [Patient, Study, Series, Instance]
 
+    @staticmethod
+    def migrations():
+        """Returns schema migrations for DB component
+
+        :return: tuple of component name and list of migrations
+        :rtype: tuple
+        """
+        return 'pacs', MIGRATIONS
+
     def atomic(self):
         """Context manager for handling simple transactions
 
@@ -106,41 +209,298 @@ class PACS(component.Component):
         """
         return self.send_one(db.DBChannels.ATOMIC)
 
-    def on_store(self, context, ds):
+    def write(self, func, *args, **kwargs):
+        """Runs function in a write transaction (see
+        :meth:`tiny_pacs.db.Database.write`)
+
+        :param func: function that performs database modifications
+        :return: value returned by the function
+        """
+        return self.send_one(db.DBChannels.WRITE, func, *args, **kwargs)
+
+    def connection(self):
+        """Context manager that holds database connection for the duration of
+        a single DIMSE operation
+
+        :return: connection scope
+        """
+        return self.send_one(db.DBChannels.CONNECTION)
+
+    def replica(self, consistency: db.Consistency):
+        """Database for read-only queries (see
+        :meth:`tiny_pacs.db.Database.replica`)
+
+        :param consistency: consistency requirement
+        :type consistency: db.Consistency
+        :return: peewee database
+        """
+        return self.send_one(db.DBChannels.REPLICA, consistency)
+
+    def create_pattern_indexes(self):
+        """Creates indexes for prefix matching of normalized search columns.
+
+        Prefix of wildcard value is matched as a range of strings compared
+        character by character (see :func:`_prefix_range`). On PostgreSQL
+        default indexes follow database collation, so only indexes with
+        `varchar_pattern_ops` operator class can serve these ranges. Other
+        databases compare strings in binary order and use regular indexes.
+        """
+        if not isinstance(db.DB.obj, peewee.PostgresqlDatabase):
+            return
+        self.log_info('Creating pattern indexes')
+        self._create_search_indexes('pattern', 'btree', 'varchar_pattern_ops')
+
+    def _create_search_indexes(self, name: str, method: str, opclass: str):
+        for model in self.tables():
+            table = model._meta.table_name
+            for field in model._meta.sorted_fields:
+                if not field.name.endswith(SEARCH_SUFFIX):
+                    continue
+                db.DB.execute_sql(
+                    f'CREATE INDEX IF NOT EXISTS {table}_{field.column_name}_{name} '
+                    f'ON {table} USING {method} ({field.column_name} {opclass})'
+                )
+
+    def create_trigram_indexes(self):
+        """Creates trigram indexes for normalized search columns.
+
+        Trigram indexes speed up wildcard matching that doesn't start with a
+        literal prefix (e.g. `*SMITH*`). Indexes are only supported on
+        PostgreSQL (`pg_trgm` extension is required).
+        """
+        if not isinstance(db.DB.obj, peewee.PostgresqlDatabase):
+            self.log_warning('Trigram indexes are only supported on PostgreSQL')
+            return
+        self.log_info('Creating trigram indexes')
+        db.DB.execute_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        self._create_search_indexes('trgm', 'gin', 'gin_trgm_ops')
+
+    def load_columnar(self):
+        """Loads columnar C-FIND index from the database"""
+        self.log_info('Loading columnar index for levels: %s',
+                      ', '.join(sorted(self.columnar_levels)))
+        with self.connection():
+            self.columnar.load()
+        self.log_info('Columnar index loaded: %r', {
+            model.__name__: len(table)
+            for model, table in self.columnar.tables.items()
+        })
+
+    def update_columnar(self, patient_ids, study_ids, series_ids,
+                        sop_instance_uids):
+        """Reloads changed records into columnar C-FIND index
+
+        :param patient_ids: ids of changed patients
+        :param study_ids: ids of changed studies
+        :param series_ids: ids of changed series
+        :param sop_instance_uids: SOP Instance UIDs of stored instances
+        """
+        if self.columnar is None:
+            return
+        for field, values in ((Patient.id, patient_ids),
+                              (Study.id, study_ids),
+                              (Series.id, series_ids),
+                              (Instance.sop_instance_uid, sop_instance_uids)):
+            for batch in peewee.chunked(list(values), SELECT_BATCH_SIZE):
+                self.columnar.refresh(field.model, field << batch)
+
+    def start_index_writer(self):
+        """Starts write-behind indexing.
+
+        Datasets that were received, but were not indexed before shutdown
+        are put into the queue again.
+        """
+        self.log_info('Starting write-behind indexing')
+        self.index_writer.start()
+        results = self.broadcast(storage.StorageChannels.ON_GET_UNINDEXED)
+        for ingest_ctx in chain.from_iterable(results):
+            self.index_writer.put(ingest_ctx)
+
+    def on_exit(self):
+        super().on_exit()
+        if self.index_writer is not None:
+            self.index_writer.stop()
+        self.log_info('Lookup cache: %r', self.lookup_cache.stats())
+        self.log_info('C-FIND plan cache: %r', self.plan_cache.stats())
+        if self.find_cache is not None:
+            self.log_info('C-FIND result cache: %r', self.find_cache.stats())
+
+    def on_store(self, context, ingest_ctx: ingest.IngestContext):
         """Handling of incoming storage request
 
+        If write-behind indexing is enabled, dataset is only put into the
+        indexing queue, once storage confirms that it is received.
+
         :param context: presentation context
         :type context: pynetdicom2.asceprovider.PContextDef
-        :param ds: incoming dataset
-        :type ds: file
+        :param ingest_ctx: incoming dataset
+        :type ingest_ctx: ingest.IngestContext
         :return: C-STORE handling status
         :rtype: pynetdicom2.statuses.Status
         """
         self.log_info('Handling store request (%r)', context)
+        if self.index_writer is None:
+            with self.connection():
+                return self._index(ingest_ctx)
+
+        try:
+            # Header has to be parsed while file is still open
+            ingest_ctx.header
+            self.broadcast(storage.StorageChannels.ON_STORE_RECEIVED, ingest_ctx)
+        except Exception as e:
+            self.log_exception(f'Failed to receive dataset: {e}')
+            self.broadcast(storage.StorageChannels.ON_STORE_FAILURE, ingest_ctx)
+            return statuses.C_STORE_CANNON_UNDERSTAND
+        self.index_writer.put(ingest_ctx)
+        return statuses.SUCCESS
+
+    def _index(self, ingest_ctx: ingest.IngestContext,
+               acknowledged: bool = False):
         try:
-            ds = pydicom.dcmread(ds, stop_before_pixels=True)
-            self.c_store(ds)
+            self.c_store(ingest_ctx.header)
         except Exception as e:
             self.log_exception(f'Failed to store dataset: {e}')
-            self.broadcast(storage.StorageChannels.ON_STORE_FAILURE, ds)
+            if acknowledged:
+                self._index_failed(ingest_ctx)
+            else:
+                self.broadcast(storage.StorageChannels.ON_STORE_FAILURE,
+                               ingest_ctx)
             return statuses.C_STORE_CANNON_UNDERSTAND
         else:
-            self.log_info('Dataset successfully stored (%r)', context)
-            self.broadcast(storage.StorageChannels.ON_STORE_DONE, ds)
+            self.log_info('Dataset successfully stored (%r)', ingest_ctx.context)
+            self.broadcast(storage.StorageChannels.ON_STORE_DONE, ingest_ctx)
             return statuses.SUCCESS
 
-    def on_find(self, context, ds: pydicom.Dataset):
+    def _index_failed(self, ingest_ctx: ingest.IngestContext):
+        """Handles dataset from write-behind queue, that failed to index.
+
+        Dataset was already acknowledged, so it is never removed. It is
+        queued again, until `attempts` are exhausted, then storage keeps it
+        in quarantine.
+
+        :param ingest_ctx: acknowledged dataset
+        :type ingest_ctx: ingest.IngestContext
+        """
+        ingest_ctx.attempts += 1
+        if ingest_ctx.attempts < self.index_attempts:
+            self.log_warning('Indexing of %s will be retried (attempt %d)',
+                             ingest_ctx.sop_instance_uid, ingest_ctx.attempts)
+            self.index_writer.retry(ingest_ctx)
+            return
+        self.broadcast(storage.StorageChannels.ON_STORE_QUARANTINE, ingest_ctx)
+
+    def _index_batch(self, batch: list):
+        """Indexes batch of datasets from write-behind queue.
+
+        Whole batch is indexed in a single transaction. If it fails datasets
+        are indexed one by one, so only broken datasets are retried (see
+        :meth:`_index_failed`). Storage is notified only once the
+        transaction is committed.
+
+        :param batch: list of ingest contexts
+        :type batch: list
+        """
+        with self.connection():
+            self._index_batch_in_scope(batch)
+
+    def _index_batch_in_scope(self, batch: list):
+        new_keys = {}
+        used_keys = []
+
+        def index():
+            return self._c_store(
+                [ingest_ctx.header for ingest_ctx in batch],
+                new_keys, used_keys
+            )
+
+        try:
+            changed = self.write(index)
+        except Exception as e:
+            self.lookup_cache.invalidate(*used_keys)
+            self.log_warning(f'Failed to index batch, retrying one by one: {e}')
+            for ingest_ctx in batch:
+                self._index(ingest_ctx, acknowledged=True)
+        else:
+            for ingest_ctx in batch:
+                self.broadcast(storage.StorageChannels.ON_STORE_DONE, ingest_ctx)
+            self.lookup_cache.update(new_keys)
+            self.update_columnar(*changed)
+            self.invalidate_find_cache(
+                [ingest_ctx.header for ingest_ctx in batch], changed
+            )
+            self.log_debug('Indexed batch of %d datasets', len(batch))
+
+    def flush_index(self):
+        """Waits for write-behind queue to be indexed.
+
+        Used by the read paths, so they always see all acknowledged datasets.
+        """
+        if self.index_writer is not None:
+            self.index_writer.flush()
+
+    def on_find(self, context, ds: pydicom.Dataset, calling_ae: str = None):
         """Handling of incoming find request
 
+        Number of results is limited per level (`find_max_results`) and per
+        calling AE (`find_ae_max_results`). Once the limit is exceeded,
+        matching stops with "Out of Resources" status. Queries that run
+        longer than `find_timeout` are interrupted by the database and fail
+        with "Unable to process" status, as well as requests with values
+        that can't be matched (e.g. malformed dates).
+
+        Closing the generator (e.g. on C-CANCEL) closes database cursor.
+
         :param context: presentation context
         :type context: pynetdicom2.asceprovider.PContextDef
         :param ds: incoming dataset
         :type ds: pydicom.Dataset
-        :yield: tuple of find result and pending status
+        :param calling_ae: calling AE title, defaults to None
+        :type calling_ae: str, optional
+        :yield: tuple of find result and status
         :rtype: tuple
         """
-        results = self.c_find(ds)
-        yield from ((r, statuses.C_FIND_PENDING) for r in results)
+        limit = self.find_limit(ds.get('QueryRetrieveLevel'), calling_ae)
+        transfer_syntax = context.supported_ts
+        with self.connection():
+            if transfer_syntax.is_little_endian:
+                results = self.c_find_encoded(
+                    ds, transfer_syntax.is_implicit_VR
+                )
+            else:
+                results = self.c_find(ds)
+            try:
+                for count, result in enumerate(results):
+                    if limit is not None and count >= limit:
+                        self.log_warning(
+                            'C-FIND from %s exceeded limit of %d results',
+                            calling_ae, limit
+                        )
+                        yield None, statuses.C_FIND_OUT_OF_RESOURCES
+                        return
+                    yield result, statuses.C_FIND_PENDING
+            except (db.QueryTimeoutError, ValueError) as e:
+                # Timed out query or request with malformed values
+                self.log_warning(f'C-FIND from {calling_ae} failed: {e}')
+                yield None, statuses.C_FIND_UNABLE_TO_PROCESS
+            finally:
+                results.close()
+
+    def find_limit(self, level: str, calling_ae: str = None):
+        """Maximum number of C-FIND results
+
+        :param level: Query/Retrieve level
+        :type level: str
+        :param calling_ae: calling AE title, defaults to None
+        :type calling_ae: str, optional
+        :return: the lowest of level and calling AE limits, `None` if there
+                 is no limit
+        :rtype: int
+        """
+        limits = [
+            self.find_max_results.get(level),
+            self.find_ae_max_results.get(calling_ae)
+        ]
+        return min((n for n in limits if n is not None), default=None)
 
     def on_move(self, context, ds: pydicom.Dataset, destination: str):
         """Handling of incoming move request
@@ -151,15 +511,12 @@ class PACS(component.Component):
         :type ds: pydicom.Dataset
         :param destination: move destination
         :type destination: str
-        :return: list of tuples: SOP Class UID, Transfer Syntax and either
-                 filename or dataset
-        :rtype: list
+        :return: tuples of SOP Class UID, Transfer Syntax and either
+                 filename or dataset, retrieved lazily
+        :rtype: services.RetrieveResults
         """
         self.log_info('Handling move request to %s (%r)', destination, context)
-        instances = [uid for _, _, uid in self.c_move_get_instances(ds)]
-        self.log_debug('Moving instances: %r', instances)
-        results = self.broadcast(storage.StorageChannels.ON_GET_FILES, instances)
-        return list(chain.from_iterable(results))
+        return self.c_move_get(ds)
 
     def on_get(self, context, ds: pydicom.Dataset):
         """Handling of incoming get request
@@ -168,15 +525,12 @@ class PACS(component.Component):
         :type context: pynetdicom2.asceprovider.PContextDef
         :param ds: incoming dataset
         :type ds: pydicom.Dataset
-        :return: list of tuples: SOP Class UID, Transfer Syntax and either
-                 filename or dataset
-        :rtype: list
+        :return: tuples of SOP Class UID, Transfer Syntax and either
+                 filename or dataset, retrieved lazily
+        :rtype: services.RetrieveResults
         """
         self.log_info('Handling get request (%r)', context)
-        instances = [uid for _, _, uid in self.c_move_get_instances(ds)]
-        self.log_debug('Getting instances: %r', instances)
-        results = self.broadcast(storage.StorageChannels.ON_GET_FILES, instances)
-        return list(chain.from_iterable(results))
+        return self.c_move_get(ds)
 
     def on_commitment(self, uids: list):
         """Handling of incoming storage commitment request
@@ -188,7 +542,11 @@ class PACS(component.Component):
         """
         self.log_info('Handling Storage Commitment')
         self.log_debug('Verifying %r instances', uids)
-        results = self.broadcast(storage.StorageChannels.ON_STORE_VERIFY, uids)
+        self.flush_index()
+        with self.connection():
+            results = self.broadcast(
+                storage.StorageChannels.ON_STORE_VERIFY, uids
+            )
         success = chain.from_iterable(s for s, _ in results)
         failure = chain.from_iterable(f for _, f in results)
         return list(success), list(failure)
@@ -196,37 +554,333 @@ class PACS(component.Component):
     def c_find(self, ds: pydicom.Dataset):
         """C-FIND implementation
 
-        Translate incoming dataset to database query
+        Translate incoming dataset to database query. Compiled queries are
+        cached by the shape of the request (see :func:`find_key`), so
+        requests that differ only in values reuse the same SQL.
+
+        If result cache is enabled (`find_cache` configuration), results of
+        the whole request are cached as well, until they expire or are
+        invalidated by storage of matching datasets.
 
         :param ds: incoming dataset
         :type ds: pydicom.Dataset
         :yield: result dataset
         :rtype: pydicom.Dataset
         """
+        return self._c_find(ds, None)
+
+    def c_find_encoded(self, ds: pydicom.Dataset, is_implicit_VR: bool = True):
+        """C-FIND implementation that yields encoded responses
+
+        Same as :meth:`c_find`, but responses are written directly from
+        the result rows (see :class:`tiny_pacs.encoder.ResponseEncoder`),
+        so they can be sent as is. Only little endian transfer syntaxes are
+        supported.
+
+        :param ds: incoming dataset
+        :type ds: pydicom.Dataset
+        :param is_implicit_VR: encode with implicit VR, defaults to True
+        :type is_implicit_VR: bool, optional
+        :yield: encoded result data set
+        :rtype: bytes
+        """
+        return self._c_find(ds, is_implicit_VR)
+
+    def _c_find(self, ds: pydicom.Dataset, is_implicit_VR):
         level = ds.QueryRetrieveLevel
         self.log_info('Handling find request for level: %s', level)
-        if level == 'PATIENT':
-            yield from Patient.c_find(ds)
-        elif level == 'STUDY':
-            yield from Study.c_find(ds)
-        elif level == 'SERIES':
-            yield from Series.c_find(ds)
-        elif level == 'IMAGE':
-            yield from Instance.c_find(ds)
+        self.flush_index()
+        model = LEVEL_MODELS.get(level)
+        if model is None:
+            return
+
+        key, values = find_key(model, ds)
+        encoding = getattr(ds, 'SpecificCharacterSet', 'ISO-IR 6')
+        if self.find_cache is None:
+            rows, response_attrs = self._find_rows(level, model, key, values)
+            encode = _response_encoder(response_attrs, encoding, is_implicit_VR)
+            yield from map(encode, rows)
+            return
+
+        cache_key = (key, _freeze(values), _freeze(encoding), is_implicit_VR)
+        cached = self.find_cache.get(cache_key)
+        if cached is not None:
+            yield from cached.responses
+            return
+
+        generation = self._store_generation
+        cached = CachedFind(model, key, values, self.find_cache_max_results)
+        rows, response_attrs = self._find_rows(level, model, key, values)
+        encode = _response_encoder(response_attrs, encoding, is_implicit_VR)
+        for row in rows:
+            rsp = encode(row)
+            cached.add(row[-1], rsp)
+            yield rsp
+        with self._find_cache_lock:
+            # Results are stale if datasets were stored in the meantime
+            if cached.complete and generation == self._store_generation:
+                self.find_cache.put(cache_key, cached)
+
+    def _find_rows(self, level: str, model, key: tuple, values: list):
+        """Executes C-FIND query using compiled plan
+
+        :return: tuple of rows iterator and response attributes
+        :rtype: tuple
+        """
+        if level in self.columnar_levels:
+            plan_key = ('columnar',) + key
+            plan = self.plan_cache.get(plan_key)
+            if plan is None:
+                plan = columnar.ColumnarPlan.compile(model, key)
+                self.plan_cache.put(plan_key, plan)
+            return self.columnar.rows(plan, values), plan.encode_attrs
+
+        plan = self.plan_cache.get(key)
+        if plan is None:
+            plan = FindPlan.compile(model, key)
+            self.plan_cache.put(key, plan)
+        database = self.replica(self.find_consistency)
+        rows = plan.rows(values, database)
+        if self.find_timeout:
+            rows = _with_timeout(rows, database, self.find_timeout)
+        return rows, plan.response_attrs
+
+    def invalidate_find_cache(self, datasets: list = None, changed=None):
+        """Removes C-FIND results affected by stored datasets
+
+        Result is removed if one of its records was updated (e.g. its
+        counters or a replaced instance) or if any of the stored datasets
+        matches the request. Filters are matched against the persisted
+        records, since attributes of existing parents are not updated from
+        stored datasets. Without datasets the whole cache is cleared.
+
+        :param datasets: list of stored dataset headers, defaults to None
+        :type datasets: list, optional
+        :param changed: ids of changed records returned by :meth:`_c_store`
+        :type changed: tuple, optional
+        """
+        if self.find_cache is None:
+            return
+        with self._find_cache_lock:
+            self._store_generation += 1
+        if datasets is None:
+            self.find_cache.clear()
+            return
+        with self.connection():
+            records = _search_records(datasets, *changed)
+        changed_ids = dict(zip((Patient, Study, Series), changed))
+        changed_ids[Instance] = set(r[Instance].id for r in records)
+        removed = self.find_cache.invalidate_if(
+            lambda _, cached: cached.affected_by(changed_ids, records)
+        )
+        self.log_debug('Invalidated %d C-FIND results', removed)
 
     def c_store(self, ds: pydicom.Dataset):
         """C-STORE implementation
 
-        Store dataset attributes in a database
+        Store dataset attributes in a database (see :meth:`c_store_many`).
 
         :param ds: incoming dataset
         :type ds: pydicom.Dataset
         """
-        with self.atomic():
-            patient = Patient.c_store(ds)
-            study = Study.c_store(patient, ds)
-            series = Series.c_store(study, ds)
-            Instance.c_store(series, ds)
+        self.c_store_many([ds])
+
+    def c_store_many(self, datasets: list):
+        """Stores attributes of multiple datasets in a single transaction.
+
+        Records of every level are inserted in bulk, existing records are
+        skipped by the database (`ON CONFLICT DO NOTHING`), so concurrent
+        storage of the same study doesn't fail. Row ids of the parent records
+        (patient, study and series) are kept in the lookup cache, so only the
+        first instance of a series has to look them up. New cache entries
+        become visible only after transaction is committed.
+
+        :param datasets: list of dataset headers
+        :type datasets: list
+        """
+        new_keys = {}
+        used_keys = []
+        try:
+            changed = self.write(self._c_store, datasets, new_keys, used_keys)
+        except Exception:
+            # Entries could be stale, let the next request look them up again
+            self.lookup_cache.invalidate(*used_keys)
+            raise
+        self.lookup_cache.update(new_keys)
+        self.update_columnar(*changed)
+        self.invalidate_find_cache(datasets, changed)
+
+    def refresh_counters(self):
+        """Recalculates aggregated attributes of all patients, studies
+        and series.
+
+        Counters are maintained on storage and deletion, so this is only
+        required for records that were created bypassing PACS.
+        """
+        self.log_info('Refreshing aggregated attributes')
+        self.write(_refresh_counters)
+        if self.columnar is not None:
+            self.columnar.load()
+        self.invalidate_find_cache()
+
+    def delete_instances(self, sop_instance_uids: list):
+        """Removes instances from the database.
+
+        Series, studies and patients that are left without any instances are
+        removed as well, aggregated attributes of the remaining ones are
+        recalculated. Storage removes files of the instances, so they can
+        be stored again.
+
+        :param sop_instance_uids: list of SOP Instance UIDs
+        :type sop_instance_uids: list
+        :return: number of removed instances
+        :rtype: int
+        """
+        self.log_info('Removing %d instances', len(sop_instance_uids))
+        self.flush_index()
+        removed = set()
+        try:
+            count = self.write(_delete_instances, sop_instance_uids, removed)
+        finally:
+            self.lookup_cache.invalidate_if(
+                lambda key, row_id: (key[0], row_id) in removed
+            )
+        self.broadcast(storage.StorageChannels.ON_STORE_DELETE,
+                       list(sop_instance_uids))
+        if self.columnar is not None:
+            # Deletion is rare, removed rows are compacted by reloading
+            self.columnar.load()
+        self.invalidate_find_cache()
+        return count
+
+    def _c_store(self, datasets: list, new_keys: dict, used_keys: list):
+        patient_ids = self._lookup(
+            [Patient.cache_key(ds) for ds in datasets],
+            lambda missing: _store_patients(
+                {key: datasets[i] for key, i in missing.items()}
+            ),
+            new_keys, used_keys
+        )
+        study_ids = self._lookup(
+            [Study.cache_key(ds) for ds in datasets],
+            lambda missing: _store_records(
+                Study.study_instance_uid,
+                {key: Study.from_dataset(patient_ids[i], datasets[i])
+                 for key, i in missing.items()}
+            ),
+            new_keys, used_keys
+        )
+        series_ids = self._lookup(
+            [Series.cache_key(ds) for ds in datasets],
+            lambda missing: _store_records(
+                Series.series_instance_uid,
+                {key: Series.from_dataset(study_ids[i], datasets[i])
+                 for key, i in missing.items()}
+            ),
+            new_keys, used_keys
+        )
+        instances = {}
+        for series_id, ds in zip(series_ids, datasets):
+            instance = Instance.from_dataset(series_id, ds)
+            instances.setdefault(instance.sop_instance_uid, instance)
+        _store_instances(instances)
+        return set(patient_ids), set(study_ids), set(series_ids), list(instances)
+
+    def _lookup(self, keys: list, factory, new_keys: dict, used_keys: list):
+        """Gets row ids for cache keys
+
+        :param keys: list of cache keys
+        :type keys: list
+        :param factory: callable that accepts mapping of missing keys to
+                        their first index in `keys` and returns mapping of
+                        keys to row ids
+        :param new_keys: row ids of the records created in the transaction
+        :type new_keys: dict
+        :param used_keys: list of the keys used in the transaction
+        :type used_keys: list
+        :return: list of row ids
+        :rtype: list
+        """
+        row_ids = {}
+        missing = {}
+        for i, key in enumerate(keys):
+            if key in row_ids or key in missing:
+                continue
+            used_keys.append(key)
+            row_id = new_keys.get(key)
+            if row_id is None:
+                row_id = self.lookup_cache.get(key)
+            if row_id is None:
+                missing[key] = i
+            else:
+                row_ids[key] = row_id
+        if missing:
+            created = factory(missing)
+            new_keys.update(created)
+            row_ids.update(created)
+        return [row_ids[key] for key in keys]
+
+    def c_move_get(self, ds: pydicom.Dataset) -> services.RetrieveResults:
+        """Gets stored datasets for C-MOVE or C-GET request
+
+        Only number of instances and presentation contexts are queried
+        up front. Datasets are looked up in storage in batches of
+        `retrieve_batch_size` instances, as they are sent.
+
+        :param ds: incoming dataset
+        :type ds: pydicom.Dataset
+        :return: tuples of SOP Class UID, Transfer Syntax and either
+                 filename or dataset, retrieved lazily
+        :rtype: services.RetrieveResults
+        """
+        self.flush_index()
+        with self.connection():
+            replica = self.replica(self.retrieve_consistency)
+            count = self.c_move_get_query(ds).bind(replica).count()
+            if not count:
+                return services.RetrieveResults([], 0, set())
+            instances = self.c_move_get_query(ds, Instance.sop_instance_uid)
+            contexts = set().union(*self.broadcast(
+                storage.StorageChannels.ON_GET_CONTEXTS, instances
+            ))
+        batches = self.c_move_get_batches(ds)
+        return services.RetrieveResults(batches, count, contexts)
+
+    def c_move_get_batches(self, ds: pydicom.Dataset):
+        """Looks up stored datasets for C-MOVE or C-GET request in batches
+
+        Instances are paged by row id, so every batch is a short query on
+        its own connection.
+
+        :param ds: incoming dataset
+        :type ds: pydicom.Dataset
+        :yield: tuple of SOP Class UID, Transfer Syntax and either filename
+                or dataset
+        :rtype: tuple
+        """
+        query = self.c_move_get_query(ds, Instance.id, Instance.sop_instance_uid)\
+            .order_by(Instance.id)\
+            .limit(self.retrieve_batch_size)
+        last_id = 0
+        while True:
+            with self.connection():
+                rows = list(
+                    query.where(Instance.id > last_id)
+                    .tuples()
+                    .bind(self.replica(self.retrieve_consistency))
+                )
+                if not rows:
+                    return
+                last_id = rows[-1][0]
+                instances = [uid for _, uid in rows]
+                self.log_debug('Retrieving instances: %r', instances)
+                results = self.broadcast(
+                    storage.StorageChannels.ON_GET_FILES, instances
+                )
+                files = list(chain.from_iterable(results))
+            yield from files
+            if len(rows) < self.retrieve_batch_size:
+                return
 
     def c_move_get_instances(self, ds: pydicom.Dataset):
         """Gets instances for C-MOVE request
@@ -237,13 +891,29 @@ class PACS(component.Component):
                 SOP Instance UID
         :rtype: tuple
         """
+        self.flush_index()
+        query = self.c_move_get_query(
+            ds,
+            Study.study_instance_uid,
+            Series.series_instance_uid,
+            Instance.sop_instance_uid
+        )
+        query = query.tuples().bind(self.replica(self.retrieve_consistency))
+        yield from db.stream(query)
+
+    @staticmethod
+    def c_move_get_query(ds: pydicom.Dataset, *fields) -> peewee.ModelSelect:
+        """Query of instances for C-MOVE or C-GET request
+
+        :param ds: incoming dataset
+        :type ds: pydicom.Dataset
+        :param fields: selected fields, defaults to instance ids
+        :return: instances query
+        :rtype: peewee.ModelSelect
+        """
         level = ds.QueryRetrieveLevel
         level = QR_LEVEL[level]
-        query = Instance.select(
-                    Instance.sop_instance_uid,
-                    Series.series_instance_uid,
-                    Study.study_instance_uid
-            )\
+        query = Instance.select(*(fields or [Instance.id]))\
             .join(Series)\
             .join(Study)\
             .join(Patient)
@@ -274,16 +944,42 @@ class PACS(component.Component):
             if not isinstance(sop_instance_uids, list):
                 sop_instance_uids = [sop_instance_uids]
             query = query.where(Instance.sop_instance_uid << sop_instance_uids)
+        return query
 
-        for instance in query:
-            series = instance.series
-            study = series.study
-            yield (study.study_instance_uid,
-                   series.series_instance_uid,
-                   instance.sop_instance_uid)
 
+class SearchableModel(peewee.Model):
+    """Base model for levels with normalized search columns.
 
-class Patient(peewee.Model):
+    Search column is named after the attribute with `_search` suffix, numeric
+    date and time column - with `_num` suffix. Both are filled on save from
+    the attribute value, as well as combined date and time columns.
+    """
+
+    #: Date and time attribute pairs that are also matched as a single range
+    combined = {}
+
+    def save(self, *args, **kwargs):
+        self.update_shadow_columns()
+        return super().save(*args, **kwargs)
+
+    def update_shadow_columns(self):
+        """Fills search and numeric columns from attribute values"""
+        fields = self._meta.fields
+        for attr_name, vr in self.mapping.values():
+            value = getattr(self, attr_name)
+            if attr_name + SEARCH_SUFFIX in fields:
+                setattr(self, attr_name + SEARCH_SUFFIX, search_value(value, vr))
+            if attr_name + NUMERIC_SUFFIX in fields:
+                setattr(self, attr_name + NUMERIC_SUFFIX,
+                        _stored_value(numeric_value, value, vr))
+        for (date_tag, time_tag), attr_name in self.combined.items():
+            date = getattr(self, self.mapping[date_tag][0])
+            time = getattr(self, self.mapping[time_tag][0])
+            setattr(self, attr_name,
+                    _stored_value(date_time_value, date, time))
+
+
+class Patient(SearchableModel):
     """Patient model.
 
     Stores all C-FIND relevant patient attributes.
@@ -300,37 +996,79 @@ class Patient(peewee.Model):
         0x00104000: ('patient_comments', 'LT')
     }
 
+    #: Aggregated attributes, that are returned, but can't be matched
+    aggregates = {
+        0x00201200: ('number_of_patient_related_studies', 'IS'),
+        0x00201202: ('number_of_patient_related_series', 'IS'),
+        0x00201204: ('number_of_patient_related_instances', 'IS')
+    }
+
     #: Patinet's Name (0010, 0010) PN
-    patient_name = peewee.CharField(max_length=64*5+4, index=True, null=True)
+    patient_name = peewee.CharField(max_length=64*5+4, null=True)
+
+    #: Normalized Patient's Name used for matching
+    patient_name_search = peewee.CharField(max_length=64*5+4, index=True,
+                                           null=True)
 
     #: Patient's ID (0010, 0020) LO
     patient_id = peewee.CharField(max_length=64, unique=True)
 
+    #: Normalized Patient's ID used for matching
+    patient_id_search = peewee.CharField(max_length=64, index=True, null=True)
+
     #: Issuer of Patient's ID (0010, 0021) LO
-    issuer_of_patient_id = peewee.CharField(max_length=64, index=True,
-                                            null=True)
+    issuer_of_patient_id = peewee.CharField(max_length=64, null=True)
 
     #: Patient's Birth Date (0010, 0030) DA
-    patient_birth_date = peewee.CharField(max_length=8, index=True, null=True)
+    patient_birth_date = peewee.CharField(max_length=8, null=True)
+
+    #: Patient's Birth Date as YYYYMMDD integer used for matching
+    patient_birth_date_num = peewee.IntegerField(index=True, null=True)
 
     #: Patient's Birth Time (0010, 0032) TM
-    patient_birth_time = peewee.CharField(max_length=14, index=True, null=True)
+    patient_birth_time = peewee.CharField(max_length=14, null=True)
+
+    #: Patient's Birth Time as HHMMSSFFFFFF integer used for matching
+    patient_birth_time_num = peewee.BigIntegerField(null=True)
 
     #: Patient's Sex (0010, 0040) CS
-    patient_sex = peewee.CharField(max_length=16, index=True, null=True)
+    patient_sex = peewee.CharField(max_length=16, null=True)
 
     #: Other Patient's Names (0010, 1001) PN
     other_patient_names = peewee.TextField(default='')
 
     #: Ethnic Group (0010, 2160) SH
-    ethnic_group = peewee.CharField(max_length=16, index=True, null=True)
+    ethnic_group = peewee.CharField(max_length=16, null=True)
 
     #: Patient Comments (0010, 4000) LT
     patient_comments = peewee.TextField(default='')
 
-    # Number of Patient Related Studies (0020,1200)
-    # Number of Patient Related Series (0020,1202)
-    # Number of Patient Related Instances (0020,1204)
+    #: Number of Patient Related Studies (0020,1200) IS
+    number_of_patient_related_studies = peewee.IntegerField(default=0)
+
+    #: Number of Patient Related Series (0020,1202) IS
+    number_of_patient_related_series = peewee.IntegerField(default=0)
+
+    #: Number of Patient Related Instances (0020,1204) IS
+    number_of_patient_related_instances = peewee.IntegerField(default=0)
+
+    @classmethod
+    def cache_key(cls, ds: pydicom.Dataset) -> tuple:
+        """Patient identity used by PACS lookup cache
+
+        :param ds: incoming dataset
+        :type ds: pydicom.Dataset
+        :return: cache key
+        :rtype: tuple
+        """
+        patient_name = getattr(ds, 'PatientName', None)
+        return (
+            'patient',
+            getattr(ds, 'PatientID', None),
+            search_value(patient_name, 'PN') if patient_name else None,
+            getattr(ds, 'PatientSex', None) or None,
+            getattr(ds, 'PatientBirthDate', None) or None
+        )
 
     @classmethod
     def c_store(cls, ds: pydicom.Dataset):
@@ -350,7 +1088,9 @@ class Patient(peewee.Model):
         patient_birth_date = getattr(ds, 'PatientBirthDate', None)
         query = Patient.select().where(Patient.patient_id == patient_id)
         if patient_name:
-            query = query.where(Patient.patient_name ** str(patient_name))
+            query = query.where(
+                Patient.patient_name_search == search_value(patient_name, 'PN')
+            )
         if patient_sex:
             query = query.where(Patient.patient_sex == patient_sex)
         if patient_birth_date:
@@ -358,89 +1098,72 @@ class Patient(peewee.Model):
         try:
             patient = query.get()
         except Patient.DoesNotExist:  # pylint: disable=no-member
-            issuer_of_patient_id = getattr(ds, 'IssuerOfPatientID', None)
-            patient_birth_time = getattr(ds, 'PatientBirthTime', None)
-            other_patient_names = getattr(ds, 'OtherPatientNames', '')
-            if isinstance(other_patient_names, list):
-                other_patient_names = '\\'.join(other_patient_names)
-            ethnic_group = getattr(ds, 'EthnicGroup', None)
-            patient_comments = getattr(ds, 'PatientComments', '')
-            patient = Patient.create(
-                patient_id=patient_id,
-                patient_name=patient_name,
-                patient_sex=patient_sex,
-                patient_birth_date=patient_birth_date,
-                patient_birth_time=patient_birth_time,
-                issuer_of_patient_id=issuer_of_patient_id,
-                other_patient_names=other_patient_names,
-                ethnic_group=ethnic_group,
-                patient_comments=patient_comments
-            )
+            patient = cls.from_dataset(ds)
+            patient.save(force_insert=True)
         return patient
 
     @classmethod
-    def c_find(cls, ds: pydicom.Dataset):
-        """C-FIND request handler for Patient level
+    def from_dataset(cls, ds: pydicom.Dataset):
+        """Creates new (not saved) patient record from dataset
 
-        :param ds: C-FIND request
+        :param ds: incoming dataset
         :type ds: pydicom.Dataset
-        :yield: C-FIND result
-        :rtype: pydicom.Dataset
+        :return: patient record
+        :rtype: Patient
         """
-        joins = set()
+        other_patient_names = getattr(ds, 'OtherPatientNames', '')
+        if isinstance(other_patient_names, (list, MultiValue)):
+            other_patient_names = '\\'.join(other_patient_names)
+        return cls(
+            patient_id=getattr(ds, 'PatientID', None),
+            patient_name=getattr(ds, 'PatientName', None),
+            patient_sex=getattr(ds, 'PatientSex', None),
+            patient_birth_date=getattr(ds, 'PatientBirthDate', None),
+            patient_birth_time=getattr(ds, 'PatientBirthTime', None),
+            issuer_of_patient_id=getattr(ds, 'IssuerOfPatientID', None),
+            other_patient_names=other_patient_names,
+            ethnic_group=getattr(ds, 'EthnicGroup', None),
+            patient_comments=getattr(ds, 'PatientComments', '')
+        )
 
-        response_attrs = []
+    def matches(self, key: tuple) -> bool:
+        """Checks that patient record matches identity from cache key
 
-        select = [Patient]
-        skipped = set()
-        if 'NumberOfPatientRelatedStudies' in ds:
-            _tag = Tag(0x0020, 0x1200)
-            skipped.add(_tag)
-            select.append(
-                peewee.fn.Count(Study.id)\
-                    .alias('number_of_patient_related_studies')  # pylint: disable=no-member
-                )
-            response_attrs.append(
-                (_tag, 'number_of_patient_related_studies', 'IS', None)
-            )
-            joins.add((Patient, Study))
-        if 'NumberOfPatientRelatedSeries' in ds:
-            _tag = Tag(0x0020, 0x1202)
-            skipped.add(_tag)
-            select.append(
-                peewee.fn.Count(Series.id)\
-                    .alias('number_of_patient_related_series')  # pylint: disable=no-member
-            )
-            response_attrs.append(
-                (_tag, 'number_of_patient_related_series', 'IS', None)
-            )
-            joins.update([(Patient, Study), (Study, Series)])
-        if 'NumberOfPatientRelatedInstances' in ds:
-            _tag = Tag(0x0020, 0x1204)
-            skipped.add(_tag)
-            select.append(
-                peewee.fn.Count(Instance.id)\
-                    .alias('number_of_patient_related_instances')  # pylint: disable=no-member
-            )
-            response_attrs.append(
-                (_tag, 'number_of_patient_related_instances', 'IS', None)
-            )
-            joins.update([(Patient, Study), (Study, Series), (Series, Instance)])
+        Attributes that are missing in the key are not checked.
 
-        query = Patient.select(*select)
-        for join in joins:
-            query = query.join_from(*join)
+        :param key: patient cache key (see :meth:`cache_key`)
+        :type key: tuple
+        :return: `True` if record matches
+        :rtype: bool
+        """
+        _, patient_id, patient_name, patient_sex, patient_birth_date = key
+        return (
+            self.patient_id == patient_id and
+            patient_name in (None, self.patient_name_search) and
+            patient_sex in (None, self.patient_sex) and
+            patient_birth_date in (None, self.patient_birth_date)
+        )
+
+    @classmethod
+    def c_find(cls, ds: pydicom.Dataset, database: peewee.Database = None):
+        """C-FIND request handler for Patient level
 
-        query, _response_attrs = _build_filters(cls, query, ds)
-        response_attrs.extend(_response_attrs)
+        Query is compiled for every request, :meth:`PACS.c_find` uses
+        cached query plans instead.
 
+        :param ds: C-FIND request
+        :type ds: pydicom.Dataset
+        :param database: database to run query on, defaults to None
+        :type database: peewee.Database, optional
+        :yield: C-FIND result
+        :rtype: pydicom.Dataset
+        """
+        key, values = find_key(cls, ds)
         encoding = getattr(ds, 'SpecificCharacterSet', 'ISO-IR 6')
-        yield from (
-            _encode_response(p, response_attrs, encoding) for p in query
-        )
+        yield from FindPlan.compile(cls, key).execute(values, encoding, database)
 
 
-class Study(peewee.Model):
+class Study(SearchableModel):
     """Study model.
 
     Stores all relevant C-FIND attributes.
@@ -462,14 +1185,44 @@ class Study(peewee.Model):
         0x001021B0: ('additional_patient_history', 'LT')
     }
 
+    class Meta:
+        indexes = (
+            # Date range queries are usually limited to a single patient,
+            # index also serves lookups by patient
+            (('patient', 'study_date_num'), False),
+        )
+
+    #: Study Date and Study Time are matched as a single range
+    combined = {
+        (0x00080020, 0x00080030): 'study_date_time_num'
+    }
+
+    #: Aggregated attributes, that are returned, but can't be matched
+    aggregates = {
+        0x00080061: ('modalities_in_study', 'CS'),
+        0x00080062: ('sop_classes_in_study', 'UI'),
+        0x00201206: ('number_of_study_related_series', 'IS'),
+        0x00201208: ('number_of_study_related_instances', 'IS')
+    }
+
     #: Reference to Patient
-    patient = peewee.ForeignKeyField(Patient)
+    patient = peewee.ForeignKeyField(Patient, index=False)
 
     #: Study Date (0008, 0020) DA
-    study_date = peewee.CharField(max_length=8, index=True, null=True)
+    study_date = peewee.CharField(max_length=8, null=True)
+
+    #: Study Date as YYYYMMDD integer used for matching
+    study_date_num = peewee.IntegerField(index=True, null=True)
 
     #: Study Time (0008, 0030) TM
-    study_time = peewee.CharField(max_length=14, index=True, null=True)
+    study_time = peewee.CharField(max_length=14, null=True)
+
+    #: Study Time as HHMMSSFFFFFF integer used for matching
+    study_time_num = peewee.BigIntegerField(null=True)
+
+    #: Study Date and Time as YYYYMMDDHHMMSS integer used for combined
+    #: range matching
+    study_date_time_num = peewee.BigIntegerField(index=True, null=True)
 
     #: Accession Number (0008, 0050) SH
     accession_number = peewee.CharField(max_length=16, index=True, null=True)
@@ -481,46 +1234,68 @@ class Study(peewee.Model):
     study_instance_uid = peewee.CharField(max_length=64, unique=True)
 
     #: Study Description (0008,1030) LO
-    study_description = peewee.CharField(max_length=64, index=True, null=True)
+    study_description = peewee.CharField(max_length=64, null=True)
+
+    #: Normalized Study Description used for matching
+    study_description_search = peewee.CharField(max_length=64, index=True,
+                                                null=True)
 
     #: Referring Physician Name (0008, 0090) PN
-    referring_physician_name = peewee.CharField(max_length=5*64+4, index=True,
+    referring_physician_name = peewee.CharField(max_length=5*64+4,
                                                 null=True)
 
+    #: Normalized Referring Physician Name used for matching
+    referring_physician_name_search = peewee.CharField(
+        max_length=5*64+4, index=True, null=True
+    )
+
     #: Name Of Physicians Reading Study (0008, 1060) PN
     name_of_physicians_reading_study = peewee.TextField(default='')
 
     #: Admitting Diagnoses Description (0008, 1080) LO
     admitting_diagnoses_description = peewee.CharField(
-        max_length=64, index=True, null=True
+        max_length=64, null=True
     )
 
     #: Patient Age (0010, 1010) AS
-    patient_age = peewee.CharField(max_length=4, index=True, null=True)
+    patient_age = peewee.CharField(max_length=4, null=True)
 
     #: Patient Size (0010, 1020) DS
-    patient_size = peewee.CharField(max_length=16, index=True, null=True)
+    patient_size = peewee.CharField(max_length=16, null=True)
 
     #: Patient Weight (0010, 1030) DS
-    patient_weight = peewee.CharField(max_length=16, index=True, null=True)
+    patient_weight = peewee.CharField(max_length=16, null=True)
 
     #: Occupation (0010, 2180) SH
-    occupation = peewee.CharField(max_length=16, index=True, null=True)
+    occupation = peewee.CharField(max_length=16, null=True)
 
     #: Additional Patient History (0010, 21B0) LT
     additional_patient_history = peewee.TextField(default='')
 
-    # Modalities in Study (0008,0061)
-    # SOP Classes in Study (0008,0062)
+    #: Modalities in Study (0008,0061) CS
+    modalities_in_study = peewee.TextField(default='')
+
+    #: SOP Classes in Study (0008,0062) UI
+    sop_classes_in_study = peewee.TextField(default='')
+
     # Other Study Numbers (0020,1070)
-    # Number of Study Related Series (0020,1206)
-    # Number of Study Related Instances (0020,1208)
+
+    #: Number of Study Related Series (0020,1206) IS
+    number_of_study_related_series = peewee.IntegerField(default=0)
+
+    #: Number of Study Related Instances (0020,1208) IS
+    number_of_study_related_instances = peewee.IntegerField(default=0)
+
+    @classmethod
+    def cache_key(cls, ds: pydicom.Dataset) -> tuple:
+        """Study identity used by PACS lookup cache"""
+        return ('study', ds.StudyInstanceUID)
 
     @classmethod
-    def c_store(self, patient: Patient, ds: pydicom.Dataset):
+    def c_store(self, patient, ds: pydicom.Dataset):
         """C-STORE handler
 
-        :param patient: patient model for study
+        :param patient: patient model (or its id) for study
         :type patient: Patient
         :param ds: incoming dataset
         :type ds: pydicom.Dataset
@@ -531,135 +1306,69 @@ class Study(peewee.Model):
         try:
             return Study.get(Study.study_instance_uid == study_instance_uid)
         except Study.DoesNotExist:  # pylint: disable=no-member
-            study_date = getattr(ds, 'StudyDate', None)
-            study_time = getattr(ds, 'StudyTime', None)
-            accession_number = getattr(ds, 'AccessionNumber', None)
-            study_id = getattr(ds, 'StudyID', None)
-            study_description = getattr(ds, 'StudyDescription', None)
-            referring_physician_name = getattr(
-                ds, 'ReferringPhysicianName', None
-            )
-            name_of_physicians_reading_study = getattr(
-                ds, 'NameOfPhysiciansReadingStudy', ''
-            )
+            study = self.from_dataset(patient, ds)
+            study.save(force_insert=True)
+            return study
 
-            if isinstance(name_of_physicians_reading_study, list):
-                name_of_physicians_reading_study = '\\'.join(
-                    name_of_physicians_reading_study
-                )
+    @classmethod
+    def from_dataset(cls, patient, ds: pydicom.Dataset):
+        """Creates new (not saved) study record from dataset
 
-            admitting_diagnoses_description = getattr(
-                ds, 'AdmittingDiagnosesDescription', None
+        :param patient: patient model (or its id) for study
+        :type patient: Patient
+        :param ds: incoming dataset
+        :type ds: pydicom.Dataset
+        :return: study record
+        :rtype: Study
+        """
+        name_of_physicians_reading_study = getattr(
+            ds, 'NameOfPhysiciansReadingStudy', ''
+        )
+        if isinstance(name_of_physicians_reading_study, (list, MultiValue)):
+            name_of_physicians_reading_study = '\\'.join(
+                str(n) for n in name_of_physicians_reading_study
             )
-            patient_age = getattr(ds, 'PatientAge', None)
-            patient_size = getattr(ds, 'PatientSize', None)
-            patient_weight = getattr(ds, 'PatientWeight', None)
-            occupation = getattr(ds, 'Occupation', None)
-            additional_patient_history = getattr(
+        return cls(
+            patient=patient,
+            study_instance_uid=ds.StudyInstanceUID,
+            study_date=getattr(ds, 'StudyDate', None),
+            study_time=getattr(ds, 'StudyTime', None),
+            accession_number=getattr(ds, 'AccessionNumber', None),
+            study_id=getattr(ds, 'StudyID', None),
+            study_description=getattr(ds, 'StudyDescription', None),
+            referring_physician_name=getattr(
+                ds, 'ReferringPhysicianName', None
+            ),
+            name_of_physicians_reading_study=name_of_physicians_reading_study,
+            admitting_diagnoses_description=getattr(
+                ds, 'AdmittingDiagnosesDescription', None
+            ),
+            patient_age=getattr(ds, 'PatientAge', None),
+            patient_size=getattr(ds, 'PatientSize', None),
+            patient_weight=getattr(ds, 'PatientWeight', None),
+            occupation=getattr(ds, 'Occupation', None),
+            additional_patient_history=getattr(
                 ds, 'AdditionalPatientHistory', ''
             )
-            return Study.create(
-                patient=patient,
-                study_instance_uid=study_instance_uid,
-                study_date=study_date,
-                study_time=study_time,
-                accession_number=accession_number,
-                study_id=study_id,
-                study_description=study_description,
-                referring_physician_name=referring_physician_name,
-                name_of_physicians_reading_study=name_of_physicians_reading_study,
-                admitting_diagnoses_description=admitting_diagnoses_description,
-                patient_age=patient_age,
-                patient_size=patient_size,
-                patient_weight=patient_weight,
-                occupation=occupation,
-                additional_patient_history=additional_patient_history
-            )
+        )
 
     @classmethod
-    def c_find(cls, ds: pydicom.Dataset):
+    def c_find(cls, ds: pydicom.Dataset, database: peewee.Database = None):
         """C-FIND request handler for Study level
 
+        Query is compiled for every request, :meth:`PACS.c_find` uses
+        cached query plans instead.
+
         :param ds: C-FIND request
         :type ds: pydicom.Dataset
+        :param database: database to run query on, defaults to None
+        :type database: peewee.Database, optional
         :yield: C-FIND result
         :rtype: pydicom.Dataset
         """
-        joins = set()
-
-        response_attrs = []
-        select = [Study]
-        upper_level_filters = []
-
-        patient_attrs = [e for e in ds if e.tag in Patient.mapping]
-        skipped = set(e.tag for e in patient_attrs)
-        if patient_attrs:
-            upper_level_filters.extend(_filter_upper_level(Patient, patient_attrs))
-            for tag, attr, vr, _, attr_name in upper_level_filters:
-                select.append(attr)
-                response_attrs.append((tag, ('patient', attr_name), vr, None))
-            joins.add((Study, Patient))
-
-        if 'ModalitiesInStudy' in ds:
-            _tag = Tag(0x0008, 0x0061)
-            skipped.add(_tag)
-            # TODO: Add modalities in study filter
-            agg_fun = db.string_agg_func()
-            select.append(
-                agg_fun(Series.modality, '\\').alias('modalities_in_study')
-            )
-            func = lambda v: '\\'.join(set(v.split('\\'))) if v else v
-            response_attrs.append((_tag, 'modalities_in_study', 'CS', func))
-            joins.add((Study, Series))
-        if 'SOPClassesInStudy' in ds:
-            _tag = Tag(0x0008, 0x0062)
-            skipped.add(_tag)
-            agg_fun = db.string_agg_func()
-            select.append(
-                agg_fun(Instance.sop_class_uid, '\\').alias('sop_classes_in_study')
-            )
-            func = lambda v: '\\'.join(set(v.split('\\'))) if v else v
-            response_attrs.append((_tag, 'sop_classes_in_study', 'UI', func))
-            joins.update([(Study, Series), (Series, Instance)])
-        if 'NumberOfStudyRelatedSeries' in ds:
-            _tag = Tag(0x0020, 0x1206)
-            skipped.add(_tag)
-            select.append(
-                peewee.fn.Count(Series.id)\
-                    .alias('number_of_study_related_series')  # pylint: disable=no-member
-            )
-            response_attrs.append(
-                (_tag, 'number_of_study_related_series', 'IS', None)
-            )
-            joins.add((Study, Series))
-        if 'NumberOfStudyRelatedInstances' in ds:
-            _tag = Tag((0x0020, 0x1208))
-            skipped.add(_tag)
-            select.append(
-                peewee.fn.Count(Instance.id)\
-                    .alias('number_of_study_related_instances')  # pylint: disable=no-member
-            )
-            response_attrs.append(
-                (_tag, 'number_of_study_related_instances', 'IS', None)
-            )
-            joins.update([(Study, Series), (Series, Instance)])
-
-        query = Study.select(*select)
-
-        for join in joins:
-            query = query.join_from(*join)
-
-        query, _response_attrs = _build_filters(cls, query, ds, skipped)
-        response_attrs.extend(_response_attrs)
-        for _, attr, vr, elem, _ in upper_level_filters:
-            if not elem.value:
-                continue
-            query = _build_filter(query, attr, vr, elem)
-
+        key, values = find_key(cls, ds)
         encoding = getattr(ds, 'SpecificCharacterSet', 'ISO-IR 6')
-        if not query.count():
-            return []
-        yield from (_encode_response(s, response_attrs, encoding) for s in query)
+        yield from FindPlan.compile(cls, key).execute(values, encoding, database)
 
 
 class Series(peewee.Model):
@@ -673,25 +1382,43 @@ class Series(peewee.Model):
         0x0020000E: ('series_instance_uid', 'UI')
     }
 
+    #: Aggregated attributes, that are returned, but can't be matched
+    aggregates = {
+        0x00201209: ('number_of_series_related_instances', 'IS')
+    }
+
+    class Meta:
+        indexes = (
+            # Series of a study are usually filtered by modality,
+            # index also serves lookups by study
+            (('study', 'modality'), False),
+        )
+
     #: Reference to Study
-    study = peewee.ForeignKeyField(Study)
+    study = peewee.ForeignKeyField(Study, index=False)
 
     #: Modality (0008, 0060) CS
-    modality = peewee.CharField(max_length=16, index=True, null=True)
+    modality = peewee.CharField(max_length=16, null=True)
 
     #: Series Number (0020, 0011) IS
-    series_number = peewee.CharField(max_length=12, index=True, null=True)
+    series_number = peewee.CharField(max_length=12, null=True)
 
     #: Series Instance UID (0020, 000E) UI
     series_instance_uid = peewee.CharField(max_length=64, unique=True)
 
-    # Number of Series Related Instances (0020,1209)
+    #: Number of Series Related Instances (0020,1209) IS
+    number_of_series_related_instances = peewee.IntegerField(default=0)
 
     @classmethod
-    def c_store(cls, study: Study, ds: pydicom.Dataset):
+    def cache_key(cls, ds: pydicom.Dataset) -> tuple:
+        """Series identity used by PACS lookup cache"""
+        return ('series', ds.SeriesInstanceUID)
+
+    @classmethod
+    def c_store(cls, study, ds: pydicom.Dataset):
         """C-STORE handler
 
-        :param study: study reference
+        :param study: study reference (model or its id)
         :type study: Study
         :param ds: incoming dataset
         :type ds: pydicom.Dataset
@@ -702,83 +1429,45 @@ class Series(peewee.Model):
         try:
             return Series.get(Series.series_instance_uid == series_instance_uid)
         except Series.DoesNotExist:  # pylint: disable=no-member
-            modality = getattr(ds, 'Modality', None)
-            series_number = getattr(ds, 'SeriesNumber', None)
-            return Series.create(
-                study=study,
-                series_instance_uid=series_instance_uid,
-                modality=modality,
-                series_number=series_number
-            )
+            series = cls.from_dataset(study, ds)
+            series.save(force_insert=True)
+            return series
 
     @classmethod
-    def c_find(cls, ds: pydicom.Dataset):
-        """C-FIND handler
+    def from_dataset(cls, study, ds: pydicom.Dataset):
+        """Creates new (not saved) series record from dataset
 
-        :param ds: C-FIND request
+        :param study: study reference (model or its id)
+        :type study: Study
+        :param ds: incoming dataset
         :type ds: pydicom.Dataset
-        :yield: C-FIND results
-        :rtype: pydicom.Dataset
+        :return: series record
+        :rtype: Series
         """
-        joins = set()
-
-        response_attrs = []
-        select = [Series]
-        upper_level_filters = []
-
-        skipped = set()
-
-        patient_attrs = [e for e in ds if e.tag in Patient.mapping]
-        skipped.update(e.tag for e in patient_attrs)
-        if patient_attrs:
-            _upper_level_filters = list(_filter_upper_level(Patient, patient_attrs))
-            upper_level_filters.extend(_upper_level_filters)
-            for tag, attr, vr, _, attr_name in _upper_level_filters:
-                select.append(attr)
-                response_attrs.append(
-                    (tag, ('study', 'patient', attr_name), vr, None)
-                )
-            joins.update([(Series, Study), (Study, Patient)])
-
-        study_attrs = [e for e in ds if e.tag in Study.mapping]
-        skipped.update(e.tag for e in study_attrs)
-        if study_attrs:
-            _upper_level_filters = list(_filter_upper_level(Study, study_attrs))
-            upper_level_filters.extend(_upper_level_filters)
-            for tag, attr, vr, _, attr_name in _upper_level_filters:
-                select.append(attr)
-                response_attrs.append((tag, ('study', attr_name), vr, None))
-            joins.update([(Series, Study)])
-
-        if 'NumberOfSeriesRelatedInstances' in ds:
-            _tag = Tag((0x0020, 0x1209))
-            skipped.add(_tag)
-            select.append(
-                peewee.fn.Count(Instance.id)\
-                    .alias('number_of_study_related_series')  # pylint: disable=no-member
-            )
-            response_attrs.append(
-                (_tag, 'number_of_series_related_instances', 'IS', None)
-            )
-            joins.add((Series, Instance))
-
-        query = Series.select(*select)
+        return cls(
+            study=study,
+            series_instance_uid=ds.SeriesInstanceUID,
+            modality=getattr(ds, 'Modality', None),
+            series_number=getattr(ds, 'SeriesNumber', None)
+        )
 
-        for join in joins:
-            query = query.join_from(*join)
+    @classmethod
+    def c_find(cls, ds: pydicom.Dataset, database: peewee.Database = None):
+        """C-FIND request handler for Series level
 
-        query, _response_attrs = _build_filters(cls, query, ds, skipped)
-        response_attrs.extend(_response_attrs)
-        for _, attr, vr, elem, _ in upper_level_filters:
-            if not elem.value:
-                continue
-            query = _build_filter(query, attr, vr, elem)
+        Query is compiled for every request, :meth:`PACS.c_find` uses
+        cached query plans instead.
 
+        :param ds: C-FIND request
+        :type ds: pydicom.Dataset
+        :param database: database to run query on, defaults to None
+        :type database: peewee.Database, optional
+        :yield: C-FIND result
+        :rtype: pydicom.Dataset
+        """
+        key, values = find_key(cls, ds)
         encoding = getattr(ds, 'SpecificCharacterSet', 'ISO-IR 6')
-        if not query.count():
-            return []
-
-        yield from (_encode_response(s, response_attrs, encoding) for s in query)
+        yield from FindPlan.compile(cls, key).execute(values, encoding, database)
 
 
 class Instance(peewee.Model):
@@ -794,224 +1483,1117 @@ class Instance(peewee.Model):
         0x00400512: ('container_identifier', 'LO')
     }
 
+    #: Aggregated attributes, that are returned, but can't be matched
+    aggregates = {}
+
+    class Meta:
+        indexes = (
+            # Instances are listed in order within a series,
+            # index also serves lookups by series
+            (('series', 'instance_number'), False),
+        )
+
     #: Series reference
-    series = peewee.ForeignKeyField(Series)
+    series = peewee.ForeignKeyField(Series, index=False)
 
     #: Instance Number (0020, 0013) IS
-    instance_number = peewee.CharField(max_length=12, index=True, null=True)
+    instance_number = peewee.CharField(max_length=12, null=True)
 
     #: SOP Instance UID (0008, 0018) UI
     sop_instance_uid = peewee.CharField(max_length=64, unique=True)
 
     #: SOP Class UID (0008, 0016) UI
-    sop_class_uid = peewee.CharField(max_length=64, index=True, null=True)
+    sop_class_uid = peewee.CharField(max_length=64, null=True)
 
     #: Container Identifier (0040, 0512) LO
-    container_identifier = peewee.CharField(max_length=64, index=True, null=True)
+    container_identifier = peewee.CharField(max_length=64, null=True)
 
     # Transfer Syntax UID (0002, 0010) UI
-    transfer_syntax_uid = peewee.CharField(max_length=64, index=True, null=True)
+    transfer_syntax_uid = peewee.CharField(max_length=64, null=True)
 
     # Available Transfer Syntax UID (0008,3002)
     # Related General SOP Class UID (0008,001A)
 
     @classmethod
-    def c_store(cls, series: Series, ds: pydicom.Dataset):
+    def c_store(cls, series, ds: pydicom.Dataset):
         """C-STORE handler
 
-        :param series: series reference
+        :param series: series reference (model or its id)
         :type series: Series
         :param ds: incoming dataset
         :type ds: pydicom.Dataset
         :return: new or existing instance record, that matches incoming dataset
-        :rtype: Instance
+                 and flag that indicates if record was created
+        :rtype: tuple
         """
         sop_instance_uid = ds.SOPInstanceUID
         try:
-            return Instance.get(Instance.sop_instance_uid == sop_instance_uid)
-        except Instance.DoesNotExist:  # pylint: disable=no-member
-            instance_number = getattr(ds, 'InstanceNumber', None)
-            sop_class_uid = getattr(ds, 'SOPClassUID', None)
-            container_identifier = getattr(ds, 'ContainerIdentifier', None)
-            meta = getattr(ds, 'file_meta', None)
-            if meta:
-                transfer_syntax_uid = getattr(meta, 'TransferSyntaxUID')
-            else:
-                transfer_syntax_uid = None
-            return Instance.create(
-                series=series,
-                sop_instance_uid=sop_instance_uid,
-                instance_number=instance_number,
-                sop_class_uid=sop_class_uid,
-                container_identifier=container_identifier,
-                transfer_syntax_uid=transfer_syntax_uid
+            return (
+                Instance.get(Instance.sop_instance_uid == sop_instance_uid),
+                False
             )
+        except Instance.DoesNotExist:  # pylint: disable=no-member
+            instance = cls.from_dataset(series, ds)
+            instance.save(force_insert=True)
+            return instance, True
 
     @classmethod
-    def c_find(cls, ds: pydicom.Dataset):
-        """C-FIND handler
+    def from_dataset(cls, series, ds: pydicom.Dataset):
+        """Creates new (not saved) instance record from dataset
+
+        :param series: series reference (model or its id)
+        :type series: Series
+        :param ds: incoming dataset
+        :type ds: pydicom.Dataset
+        :return: instance record
+        :rtype: Instance
+        """
+        meta = getattr(ds, 'file_meta', None)
+        if meta:
+            transfer_syntax_uid = getattr(meta, 'TransferSyntaxUID', None)
+        else:
+            transfer_syntax_uid = None
+        return cls(
+            series=series,
+            sop_instance_uid=ds.SOPInstanceUID,
+            instance_number=getattr(ds, 'InstanceNumber', None),
+            sop_class_uid=getattr(ds, 'SOPClassUID', None),
+            container_identifier=getattr(ds, 'ContainerIdentifier', None),
+            transfer_syntax_uid=transfer_syntax_uid
+        )
+
+    @classmethod
+    def c_find(cls, ds: pydicom.Dataset, database: peewee.Database = None):
+        """C-FIND request handler for Instance level
+
+        Query is compiled for every request, :meth:`PACS.c_find` uses
+        cached query plans instead.
 
         :param ds: C-FIND request
         :type ds: pydicom.Dataset
-        :yield: C-FIND results
+        :param database: database to run query on, defaults to None
+        :type database: peewee.Database, optional
+        :yield: C-FIND result
         :rtype: pydicom.Dataset
         """
-        joins = set()
+        key, values = find_key(cls, ds)
+        encoding = getattr(ds, 'SpecificCharacterSet', 'ISO-IR 6')
+        yield from FindPlan.compile(cls, key).execute(values, encoding, database)
 
-        response_attrs = []
-        select = [Instance]
-        upper_level_filters = []
 
-        skipped = set()
+def _lock_parents(series_ids: list):
+    """Locks series and study records until the end of transaction
+
+    Aggregated attributes are read and then written back, so concurrent
+    transactions must not update the same records in between. Studies are
+    locked before series, both in the order of ids, so transactions that
+    store instances of several series can't deadlock. SQLite has a single
+    writer and doesn't support row locks, nothing is done then.
+
+    :param series_ids: ids of series that get new instances
+    :type series_ids: list
+    """
+    if not db.DB.obj.for_update:
+        return
+    studies = Study.select(Study.id)\
+        .where(Study.id << Series.select(Series.study)
+               .where(Series.id << series_ids))\
+        .order_by(Study.id)\
+        .for_update()
+    list(studies.tuples())
+    series = Series.select(Series.id)\
+        .where(Series.id << series_ids)\
+        .order_by(Series.id)\
+        .for_update()
+    list(series.tuples())
+
+
+def _count_instances(series_id: int, sop_class_uids: list):
+    """Updates aggregated attributes of parent records for new instances
+
+    Series and study records have to be locked by :func:`_lock_parents`,
+    since counters and multi-valued attributes are read before the update.
+
+    :param series_id: parent series id
+    :type series_id: int
+    :param sop_class_uids: SOP Class UIDs of the new instances
+    :type sop_class_uids: list
+    """
+    count = len(sop_class_uids)
+    study_id, patient_id, modality, series_instances, study_instances, \
+        modalities, sop_classes = Series.select(
+            Series.study, Study.patient, Series.modality,
+            Series.number_of_series_related_instances,
+            Study.number_of_study_related_instances,
+            Study.modalities_in_study, Study.sop_classes_in_study
+        )\
+        .join(Study)\
+        .where(Series.id == series_id)\
+        .tuples()\
+        .get()
+    # First instance of a series (or study) makes it visible in counters
+    new_series = int(not series_instances)
+    new_study = int(not study_instances)
+
+    Series.update(
+        number_of_series_related_instances=(
+            Series.number_of_series_related_instances + count
+        )
+    ).where(Series.id == series_id).execute()
+    study_update = {
+        Study.number_of_study_related_instances: (
+            Study.number_of_study_related_instances + count
+        ),
+        Study.number_of_study_related_series: (
+            Study.number_of_study_related_series + new_series
+        ),
+        Study.sop_classes_in_study: _add_values(sop_classes, sop_class_uids)
+    }
+    if new_series:
+        study_update[Study.modalities_in_study] = _add_values(
+            modalities, [modality]
+        )
+    Study.update(study_update).where(Study.id == study_id).execute()
+    Patient.update(
+        number_of_patient_related_instances=(
+            Patient.number_of_patient_related_instances + count
+        ),
+        number_of_patient_related_series=(
+            Patient.number_of_patient_related_series + new_series
+        ),
+        number_of_patient_related_studies=(
+            Patient.number_of_patient_related_studies + new_study
+        )
+    ).where(Patient.id == patient_id).execute()
+
 
-        patient_attrs = [e for e in ds if e.tag in Patient.mapping]
-        skipped.update(e.tag for e in patient_attrs)
-        if patient_attrs:
-            _upper_level_filters = list(
-                _filter_upper_level(Patient, patient_attrs)
+def _add_values(values: str, new_values: list) -> str:
+    """Adds values to sorted multi-valued attribute
+
+    :param values: backslash separated values
+    :type values: str
+    :param new_values: new values
+    :type new_values: list
+    :return: backslash separated values
+    :rtype: str
+    """
+    unique = set(v for v in values.split('\\') if v)
+    unique.update(v for v in new_values if v)
+    return '\\'.join(sorted(unique))
+
+
+#: Maximum number of rows in a single INSERT statement
+INSERT_BATCH_SIZE = 100
+
+#: Maximum number of values in a single IN condition
+SELECT_BATCH_SIZE = 500
+
+
+def _insert_ignore(records: list, returning=None):
+    """Inserts records in bulk, skipping the ones that already exist
+
+    :param records: list of records of the same model
+    :type records: list
+    :param returning: field returned for inserted rows (database has to
+                      support `RETURNING`), defaults to None
+    :return: values of `returning` field of inserted rows or number of
+             inserted rows, if field is not set
+    :rtype: list or int
+    """
+    inserted = [] if returning is not None else 0
+    if not records:
+        return inserted
+    model = type(records[0])
+    rows = []
+    for record in records:
+        if isinstance(record, SearchableModel):
+            record.update_shadow_columns()
+        rows.append(record.__data__)
+    for batch in peewee.chunked(rows, INSERT_BATCH_SIZE):
+        query = model.insert_many(batch).on_conflict_ignore()
+        if returning is not None:
+            inserted.extend(
+                value for value, in query.returning(returning).tuples().execute()
             )
-            upper_level_filters.extend(_upper_level_filters)
-            for tag, attr, vr, _, attr_name in _upper_level_filters:
-                select.append(attr)
-                response_attrs.append(
-                    (tag, ('series', 'study', 'patient', attr_name), vr, None)
-                )
-            joins.update(
-                [(Instance, Series), (Series, Study), (Study, Patient)]
+        else:
+            inserted += db.DB.obj.execute(query).rowcount
+    return inserted
+
+
+def _select_by(field, values: list):
+    """Selects records by the list of values of the field
+
+    :param field: unique field
+    :param values: list of field values
+    :type values: list
+    :yield: tuple of field value and record id
+    :rtype: tuple
+    """
+    model = field.model
+    for batch in peewee.chunked(values, SELECT_BATCH_SIZE):
+        yield from model.select(field, model.id)\
+            .where(field << batch)\
+            .tuples()
+
+
+def _store_patients(patients: dict) -> dict:
+    """Stores patient records
+
+    :param patients: mapping of cache keys to datasets
+    :type patients: dict
+    :raises peewee.IntegrityError: patient with the same ID, but different
+                                   demographics already exists
+    :return: mapping of cache keys to row ids
+    :rtype: dict
+    """
+    _insert_ignore([Patient.from_dataset(ds) for ds in patients.values()])
+    patient_ids = list(set(key[1] for key in patients))
+    existing = {}
+    for batch in peewee.chunked(patient_ids, SELECT_BATCH_SIZE):
+        existing.update(
+            (p.patient_id, p) for p in Patient.select(
+                Patient.id, Patient.patient_id, Patient.patient_name_search,
+                Patient.patient_sex, Patient.patient_birth_date
+            ).where(Patient.patient_id << batch)
+        )
+    row_ids = {}
+    for key in patients:
+        patient = existing.get(key[1])
+        if patient is None:
+            raise peewee.IntegrityError(f'Failed to store patient {key[1]}')
+        if not patient.matches(key):
+            raise peewee.IntegrityError(
+                f'Patient {key[1]} already exists with different attributes'
             )
+        row_ids[key] = patient.id
+    return row_ids
 
-        study_attrs = [e for e in ds if e.tag in Study.mapping]
-        skipped.update(e.tag for e in study_attrs)
-        if study_attrs:
-            _upper_level_filters = list(_filter_upper_level(Study, study_attrs))
-            upper_level_filters.extend(_upper_level_filters)
-            for tag, attr, vr, _, attr_name in _upper_level_filters:
-                select.append(attr)
-                response_attrs.append(
-                    (tag, ('series', 'study', attr_name), vr, None)
-                )
-            joins.update([(Instance, Series), (Series, Study)])
 
-        series_attrs = [e for e in ds if e.tag in Series.mapping]
-        skipped.update(e.tag for e in series_attrs)
-        if series_attrs:
-            _upper_level_filters = list(
-                _filter_upper_level(Series, series_attrs)
+def _store_records(field, records: dict) -> dict:
+    """Stores study or series records
+
+    :param field: unique field of the records (Study/Series Instance UID)
+    :param records: mapping of cache keys to new records
+    :type records: dict
+    :return: mapping of cache keys to row ids
+    :rtype: dict
+    """
+    _insert_ignore(list(records.values()))
+    uids = {getattr(r, field.name): key for key, r in records.items()}
+    row_ids = {uids[uid]: row_id for uid, row_id in _select_by(field, list(uids))}
+    if len(row_ids) != len(records):
+        raise peewee.IntegrityError(
+            f'Failed to store {len(records) - len(row_ids)} records'
+        )
+    return row_ids
+
+
+def _store_instances(instances: dict):
+    """Stores instance records
+
+    Only rows that were actually inserted are counted, instances stored by
+    a concurrent transaction are skipped by the database. Existing instances
+    were replaced in storage (duplicates are ignored by storage otherwise),
+    so their attributes are updated, series reference is kept.
+
+    :param instances: mapping of SOP Instance UIDs to new records
+    :type instances: dict
+    :raises peewee.IntegrityError: instances were stored concurrently and
+                                   database doesn't report inserted rows
+    """
+    if db.DB.obj.returning_clause:
+        inserted = set(_insert_ignore(
+            list(instances.values()), Instance.sop_instance_uid
+        ))
+        new = [r for uid, r in instances.items() if uid in inserted]
+    else:
+        existing = set(
+            uid for uid, _ in
+            _select_by(Instance.sop_instance_uid, list(instances))
+        )
+        new = [r for uid, r in instances.items() if uid not in existing]
+        inserted = _insert_ignore(new)
+        if inserted != len(new):
+            raise peewee.IntegrityError(
+                f'{len(new) - inserted} instances were stored concurrently'
             )
-            upper_level_filters.extend(_upper_level_filters)
-            for tag, attr, vr, _, attr_name in _upper_level_filters:
-                select.append(attr)
-                response_attrs.append((tag, ('series', attr_name), vr, None))
-            joins.add((Instance, Series))
+    new_uids = set(r.sop_instance_uid for r in new)
+    for uid, instance in instances.items():
+        if uid not in new_uids:
+            _update_instance(instance)
+
+    sop_classes = {}
+    for instance in new:
+        sop_classes.setdefault(instance.series_id, []).append(
+            instance.sop_class_uid
+        )
+    _lock_parents(list(sop_classes))
+    for series_id in sorted(sop_classes):
+        _count_instances(series_id, sop_classes[series_id])
 
-        query = Instance.select(*select)
 
-        for join in joins:
-            query = query.join_from(*join)
+def _update_instance(instance: Instance):
+    """Updates attributes of existing instance from a replacing record
 
-        query, _response_attrs = _build_filters(cls, query, ds, skipped)
-        response_attrs.extend(_response_attrs)
-        for _, attr, vr, elem, _ in upper_level_filters:
-            if not elem.value:
+    :param instance: new (not saved) instance record
+    :type instance: Instance
+    """
+    fields = {
+        name: value for name, value in instance.__data__.items()
+        if name not in ('id', 'series', 'sop_instance_uid')
+    }
+    Instance.update(fields)\
+        .where(Instance.sop_instance_uid == instance.sop_instance_uid)\
+        .execute()
+
+
+def _refresh_counters(series_ids=None, study_ids=None, patient_ids=None):
+    """Recalculates aggregated attributes
+
+    Aggregates are calculated for all records of the level if ids are not
+    provided.
+
+    :param series_ids: ids of series, defaults to None
+    :type series_ids: list, optional
+    :param study_ids: ids of studies, defaults to None
+    :type study_ids: list, optional
+    :param patient_ids: ids of patients, defaults to None
+    :type patient_ids: list, optional
+    """
+    count = peewee.fn.COUNT  # pylint: disable=no-member
+
+    query = Series.update(
+        number_of_series_related_instances=Instance.select(count(Instance.id))\
+            .where(Instance.series == Series.id)
+    )
+    if series_ids is not None:
+        query = query.where(Series.id << list(series_ids))
+    query.execute()
+
+    query = Study.update(
+        number_of_study_related_series=Series.select(count(Series.id))\
+            .where(Series.study == Study.id),
+        number_of_study_related_instances=Instance.select(count(Instance.id))\
+            .join(Series)\
+            .where(Series.study == Study.id),
+        modalities_in_study='',
+        sop_classes_in_study=''
+    )
+    values = Series.select(Series.study, Series.modality, Instance.sop_class_uid)\
+        .join(Instance)\
+        .distinct()
+    if study_ids is not None:
+        query = query.where(Study.id << list(study_ids))
+        values = values.where(Series.study << list(study_ids))
+    query.execute()
+
+    sets = {}
+    for study_id, modality, sop_class_uid in values.tuples():
+        modalities, sop_classes = sets.setdefault(study_id, (set(), set()))
+        modalities.add(modality)
+        sop_classes.add(sop_class_uid)
+    for study_id, (modalities, sop_classes) in sets.items():
+        Study.update(
+            modalities_in_study='\\'.join(sorted(filter(None, modalities))),
+            sop_classes_in_study='\\'.join(sorted(filter(None, sop_classes)))
+        ).where(Study.id == study_id).execute()
+
+    query = Patient.update(
+        number_of_patient_related_studies=Study.select(count(Study.id))\
+            .where(Study.patient == Patient.id),
+        number_of_patient_related_series=Series.select(count(Series.id))\
+            .join(Study)\
+            .where(Study.patient == Patient.id),
+        number_of_patient_related_instances=Instance.select(count(Instance.id))\
+            .join(Series)\
+            .join(Study)\
+            .where(Study.patient == Patient.id)
+    )
+    if patient_ids is not None:
+        query = query.where(Patient.id << list(patient_ids))
+    query.execute()
+
+
+def _delete_instances(sop_instance_uids: list, removed: set) -> int:
+    parents = list(
+        Instance.select(Series.id, Study.id, Study.patient)\
+            .join(Series)\
+            .join(Study)\
+            .where(Instance.sop_instance_uid << sop_instance_uids)\
+            .distinct()\
+            .tuples()
+    )
+    series_ids = set(p[0] for p in parents)
+    count = Instance.delete()\
+        .where(Instance.sop_instance_uid << sop_instance_uids)\
+        .execute()
+    study_ids = _delete_empty(Series, Instance, series_ids, removed)
+    patient_ids = _delete_empty(Study, Series, study_ids, removed)
+    _delete_empty(Patient, Study, patient_ids, removed)
+    _refresh_counters(
+        [p[0] for p in parents if ('series', p[0]) not in removed],
+        [p[1] for p in parents if ('study', p[1]) not in removed],
+        [p[2] for p in parents if ('patient', p[2]) not in removed]
+    )
+    return count
+
+
+def _delete_empty(model, child_model, ids: set, removed: set):
+    """Deletes records that have no child records left
+
+    :param model: peewee model
+    :type model: peewee.Model
+    :param child_model: model that references `model`
+    :type child_model: peewee.Model
+    :param ids: ids of the records to check
+    :type ids: set
+    :param removed: set of (level, id) of removed records, updated in place
+    :type removed: set
+    :return: ids of parent records of the removed ones
+    :rtype: set
+    """
+    if not ids:
+        return set()
+    fk_name = model.__name__.lower()
+    fk = getattr(child_model, fk_name)
+    children = child_model.select(child_model.id).where(fk == model.id)
+    parent_fields = [f for f in model._meta.refs]
+    empty = list(
+        model.select(model.id, *parent_fields)\
+            .where((model.id << list(ids)) & ~peewee.fn.EXISTS(children))
+    )
+    if not empty:
+        return set()
+    model.delete().where(model.id << [r.id for r in empty]).execute()
+    removed.update((fk_name, r.id) for r in empty)
+    parent_ids = set()
+    for field in parent_fields:
+        parent_ids.update(getattr(r, field.name + '_id') for r in empty)
+    return parent_ids
+
+
+class _Slot:
+    """Placeholder for a filter value in compiled query"""
+
+    def __init__(self, index: int):
+        self.index = index
+
+
+class FindPlan:
+    """Compiled C-FIND query.
+
+    Plan holds SQL with placeholders for filter values and layout of the
+    response dataset, so it can be executed for any request with the same
+    key.
+
+    :ivar model: C-FIND level model
+    :ivar sql: SQL query
+    :ivar params: query parameters, filter values are represented by slots
+    :ivar response_attrs: list of response attributes (tag, column index,
+                          VR and conversion function)
+    """
+
+    def __init__(self, model, sql: str, params: list, response_attrs: list):
+        self.model = model
+        self.sql = sql
+        self.params = params
+        self.response_attrs = response_attrs
+
+    @classmethod
+    def compile(cls, model, key: tuple):
+        """Compiles query for request key
+
+        :param model: C-FIND level model
+        :type model: peewee.Model
+        :param key: request key produced by :func:`find_key`
+        :type key: tuple
+        :return: compiled query
+        :rtype: FindPlan
+        """
+        attrs = _level_attrs(model)
+        query = model.select()
+        response_attrs = []
+        used_models = set()
+        slot = 0
+        for entry in key[1:]:
+            kind, tag = entry[:2]
+            if kind == 'echo':
+                # Attribute not supported
+                response_attrs.append((tag, None, entry[2], None))
                 continue
-            query = _build_filter(query, attr, vr, elem)
 
-        encoding = getattr(ds, 'SpecificCharacterSet', 'ISO-IR 6')
-        if not query.count():
-            return []
+            attr_model, attr_name, vr, _ = attrs[tag]
+            used_models.add(attr_model)
+            column = getattr(attr_model, attr_name)
+            response_attrs.append((tag, column, vr, None))
+            if kind == 'filter':
+                _, _, shape, filter_name = entry
+                count = _shape_size(shape)
+                values = [
+                    peewee.Value(_Slot(i), converter=False)
+                    for i in range(slot, slot + count)
+                ]
+                slot += count
+                filter_column = getattr(attr_model, filter_name)
+                query = _apply_filter(query, filter_column, shape, values)
+
+        # Join upper levels up to the topmost requested one
+        levels = list(LEVEL_MODELS.values())
+        index = levels.index(model)
+        topmost = min((levels.index(m) for m in used_models), default=index)
+        for i in range(index, topmost, -1):
+            query = query.join_from(levels[i], levels[i - 1])
+
+        query, response_attrs = _select_rows(model, query, response_attrs)
+        sql, params = query.sql()
+        return cls(model, sql, params, response_attrs)
+
+    def bind(self, values: list) -> list:
+        """Creates query parameters for request values
+
+        :param values: filter values produced by :func:`find_key`
+        :type values: list
+        :return: query parameters
+        :rtype: list
+        """
+        return [
+            values[p.index] if isinstance(p, _Slot) else p for p in self.params
+        ]
+
+    def execute(self, values: list, encoding: str,
+                database: peewee.Database = None):
+        """Executes query and encodes results
+
+        :param values: filter values produced by :func:`find_key`
+        :type values: list
+        :param encoding: response encoding
+        :type encoding: str
+        :param database: database to run query on (e.g. read-only replica),
+                         defaults to database bound to the model
+        :type database: peewee.Database, optional
+        :yield: C-FIND response dataset
+        :rtype: pydicom.Dataset
+        """
+        for row in self.rows(values, database):
+            yield _encode_response(row, self.response_attrs, encoding)
+
+    def rows(self, values: list, database: peewee.Database = None):
+        """Executes query
+
+        :param values: filter values produced by :func:`find_key`
+        :type values: list
+        :param database: database to run query on, defaults to None
+        :type database: peewee.Database, optional
+        :return: iterator over rows, record id is the last column
+        """
+        query = self.model.raw(self.sql, *self.bind(values)).tuples()
+        if database is not None:
+            query = query.bind(database)
+        return db.stream(query)
+
+
+class CachedFind:
+    """Results of a C-FIND request kept in the result cache
+
+    Filters are kept along with the results, so the entry can be matched
+    against newly stored datasets.
+
+    :ivar model: C-FIND level model
+    :ivar filters: list of filters (model, filter column name, shape and
+                   values)
+    :ivar ids: ids of the found records
+    :ivar responses: list of response datasets (or encoded data sets),
+                     `None` if there were too many results to cache
+    """
+
+    def __init__(self, model, key: tuple, values: list, max_results: int):
+        self.model = model
+        self.max_results = max_results
+        self.filters = []
+        self.ids = set()
+        self.responses = []
+        attrs = _level_attrs(model)
+        values = iter(values)
+        for entry in key[1:]:
+            if entry[0] != 'filter':
+                continue
+            _, tag, shape, filter_name = entry
+            filter_values = [next(values) for _ in range(_shape_size(shape))]
+            self.filters.append(
+                (attrs[tag][0], filter_name, shape, filter_values)
+            )
 
-        yield from (_encode_response(s, response_attrs, encoding) for s in query)
+    @property
+    def complete(self) -> bool:
+        """All results were collected"""
+        return self.responses is not None
 
+    def add(self, record_id: int, rsp):
+        """Adds response to the entry
+
+        :param record_id: id of the found record
+        :type record_id: int
+        :param rsp: response dataset or encoded data set
+        """
+        if self.responses is None:
+            return
+        if len(self.responses) >= self.max_results:
+            self.responses = None
+            self.ids = set()
+            return
+        self.ids.add(record_id)
+        self.responses.append(rsp)
+
+    def affected_by(self, changed_ids: dict, records: list) -> bool:
+        """Checks if results are affected by stored datasets
+
+        :param changed_ids: mapping of model to ids of changed records
+        :type changed_ids: dict
+        :param records: records of stored datasets returned by
+                        :func:`_search_records`
+        :type records: list
+        :return: `True` if results could have changed
+        :rtype: bool
+        """
+        if self.ids & changed_ids.get(self.model, set()):
+            return True
+        return any(
+            all(
+                columnar.match_value(
+                    getattr(record[model], filter_name), shape, values
+                )
+                for model, filter_name, shape, values in self.filters
+            )
+            for record in records
+        )
+
+
+def _search_records(datasets: list, patient_ids, study_ids, series_ids,
+                    sop_instance_uids) -> list:
+    """Gets persisted records of every level for stored datasets
+
+    :param datasets: stored dataset headers
+    :type datasets: list
+    :param patient_ids: ids of the stored patients
+    :param study_ids: ids of the stored studies
+    :param series_ids: ids of the stored series
+    :param sop_instance_uids: SOP Instance UIDs of the stored instances
+    :return: mappings of model to record with filled search columns
+    :rtype: list
+    """
+    patients = {r.id: r for r in _select_persisted(Patient.id, patient_ids)}
+    studies = {
+        r.study_instance_uid: r
+        for r in _select_persisted(Study.id, study_ids)
+    }
+    series = {
+        r.series_instance_uid: r
+        for r in _select_persisted(Series.id, series_ids)
+    }
+    instances = {
+        r.sop_instance_uid: r
+        for r in _select_persisted(Instance.sop_instance_uid,
+                                   sop_instance_uids)
+    }
+    records = []
+    for ds in datasets:
+        study = studies.get(ds.StudyInstanceUID)
+        if study is None:
+            # Should not happen, dataset is the best guess then
+            study = Study.from_dataset(None, ds)
+            study.update_shadow_columns()
+        patient = patients.get(study.patient_id)
+        if patient is None:
+            patient = Patient.from_dataset(ds)
+            patient.update_shadow_columns()
+        series_record = series.get(ds.SeriesInstanceUID)
+        if series_record is None:
+            series_record = Series.from_dataset(None, ds)
+        instance = instances.get(ds.SOPInstanceUID)
+        if instance is None:
+            instance = Instance.from_dataset(None, ds)
+        records.append({
+            Patient: patient,
+            Study: study,
+            Series: series_record,
+            Instance: instance
+        })
+    return records
+
+
+def _select_persisted(field, values) -> list:
+    """Loads records by the values of the field in batches"""
+    records = []
+    for batch in peewee.chunked(list(values), SELECT_BATCH_SIZE):
+        records.extend(field.model.select().where(field << batch))
+    return records
+
+
+def _freeze(value):
+    """Converts lists of request values to hashable tuples"""
+    if isinstance(value, (list, tuple, MultiValue)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+#: Number of filter values for fixed filter shapes
+_SHAPE_PARAMS = {
+    'eq': 1,
+    'like': 1,
+    'prefix': 2,
+    'prefix_like': 3
+}
 
-def _build_filters(model, query, ds: pydicom.Dataset, skipped=None):
-    """Build filters for provided model
 
-    :param model: PACS level model
+def _shape_size(shape: tuple) -> int:
+    """Number of filter values for filter shape"""
+    kind = shape[0]
+    if kind == 'in':
+        return shape[1]
+    elif kind == 'range':
+        # Open-ended ranges have only one bound
+        return shape[1] + shape[2]
+    return _SHAPE_PARAMS[kind]
+
+
+def find_key(model, ds: pydicom.Dataset):
+    """Creates plan cache key and filter values for C-FIND request
+
+    Key consists of the level and, for every requested attribute, its tag
+    and the shape of the filter (e.g. exact match, wildcard or range), but
+    not the values themselves.
+
+    :param model: C-FIND level model
     :type model: peewee.Model
-    :param query: C-FIND SQL query
-    :type query: peewee.Query
     :param ds: C-FIND request
     :type ds: pydicom.Dataset
-    :param skipped: skipped attributes, defaults to None
-    :type skipped: list, optional
-    :return: query and response attributes
+    :return: tuple of key and list of filter values
     :rtype: tuple
     """
-    if skipped is None:
-        skipped = set()
-    response_attrs = []
+    attrs = _level_attrs(model)
+    combined = _combined_filters(model, ds)
+    key = [model.__name__]
+    values = []
     for elem in ds:
-        if elem.tag in EXCLUDED_ATTRS or elem.tag in skipped:
-            continue
-
+        tag = elem.tag
         try:
-            attr_name, vr = model.mapping[elem.tag]
+            attr_model, attr_name, vr, aggregate = attrs[tag]
         except KeyError:
-            response_attrs.append((elem.tag, None, elem.VR, None))
+            if tag not in EXCLUDED_ATTRS:
+                key.append(('echo', tag, elem.VR))
             continue
 
-        response_attrs.append((elem.tag, attr_name, vr, None))
-        if elem.is_empty:
+        if tag in combined:
+            date_time = combined[tag]
+            if date_time is None:
+                # Matched together with the date
+                key.append(('column', tag))
+            else:
+                filter_name, date, time = date_time
+                shape, _values = _date_time_filter_params(date, time)
+                key.append(('filter', tag, shape, filter_name))
+                values.extend(_values)
             continue
 
-        attr = getattr(model, attr_name)
-        query = _build_filter(query, attr, vr, elem)
-    return query, response_attrs
+        if aggregate or elem.is_empty:
+            key.append(('column', tag))
+            continue
+        filter_name = attr_name
+        for suffix in (SEARCH_SUFFIX, NUMERIC_SUFFIX):
+            if hasattr(attr_model, attr_name + suffix):
+                filter_name = attr_name + suffix
+        shape, _values = _filter_params(
+            vr, elem.value, filter_name != attr_name
+        )
+        key.append(('filter', tag, shape, filter_name))
+        values.extend(_values)
+    return tuple(key), values
 
 
-def _build_filter(query, attr, vr, elem):
-    """Build filter for specific attribute
+def _combined_filters(model, ds: pydicom.Dataset) -> dict:
+    """Finds date and time attributes that are matched as a single range
 
-    :param query: current SQL query
-    :type query: peewee.Query
-    :param attr: C-FIND request attribute
-    :type attr: [type]
-    :param vr: element VR
+    Date and time are combined only if both of them are ranges.
+
+    :param model: C-FIND level model
+    :type model: peewee.Model
+    :param ds: C-FIND request
+    :type ds: pydicom.Dataset
+    :return: mapping of date tag to combined column name, date and time
+             values, time tag is mapped to `None`
+    :rtype: dict
+    """
+    combined = {}
+    for level_model in LEVEL_MODELS.values():
+        for (date_tag, time_tag), attr_name in getattr(
+                level_model, 'combined', {}).items():
+            date = ds.get(date_tag)
+            time = ds.get(time_tag)
+            if (date is None or time is None or date.is_empty or
+                    time.is_empty):
+                continue
+            if '-' in str(date.value) and '-' in str(time.value):
+                combined[date_tag] = (attr_name, date.value, time.value)
+                combined[time_tag] = None
+        if level_model is model:
+            break
+    return combined
+
+
+def _level_attrs(model) -> dict:
+    """Attributes available on C-FIND level
+
+    :param model: C-FIND level model
+    :type model: peewee.Model
+    :return: mapping of tag to model, attribute name, VR and aggregate flag
+    :rtype: dict
+    """
+    attrs = _LEVEL_ATTRS.get(model)
+    if attrs is None:
+        attrs = {}
+        for level_model in LEVEL_MODELS.values():
+            for tag, (attr_name, vr) in level_model.mapping.items():
+                attrs[tag] = (level_model, attr_name, vr, False)
+            if level_model is model:
+                break
+        for tag, (attr_name, vr) in model.aggregates.items():
+            attrs[tag] = (model, attr_name, vr, True)
+        _LEVEL_ATTRS[model] = attrs
+    return attrs
+
+
+_LEVEL_ATTRS = {}
+
+
+def _filter_params(vr: str, value, normalized: bool):
+    """Determines filter shape and values for requested attribute value
+
+    :param vr: attribute VR
     :type vr: str
-    :param elem: DICOM element
-    :type elem: [type]
+    :param value: requested value
+    :param normalized: attribute is matched against normalized search or
+                       numeric column
+    :type normalized: bool
     :raises ValueError: raises ValueError for unsupported VR
-    :return: query with added filter
-    :rtype: peewee.Query
+    :return: filter shape and list of filter values
+    :rtype: tuple
     """
     if vr in TEXT_VR:
+        if isinstance(value, (list, MultiValue)):
+            if normalized:
+                value = [search_value(v, vr) for v in value]
+            return ('in', len(value)), list(value)
         if vr == 'PN':
-            value = str(elem.value)
+            value = str(value)
+        if not normalized:
+            return ('like',), [value.replace('?', '_').replace('*', '%')]
+
+        value = search_value(value, vr)
+        wildcard = min(
+            (i for i in (value.find('*'), value.find('?')) if i >= 0),
+            default=-1
+        )
+        if wildcard < 0:
+            return ('eq',), [value]
+        pattern = value.replace('?', '_').replace('*', '%')
+        prefix = value[:wildcard]
+        if not prefix:
+            return ('like',), [pattern]
+        # Literal prefix is matched as a range, so index can be used
+        upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        if value == prefix + '*':
+            return ('prefix',), [prefix, upper_bound]
+        return ('prefix_like',), [prefix, upper_bound, pattern]
+    elif vr in ('DA', 'TM', 'DT'):
+        if '-' in value:
+            start, end = value.split('-')
         else:
-            value = elem.value
-        return _text_filter(query, attr, value)
-    elif vr == 'DA':
-        return _date_filter(query, attr, elem.value)
+            start = end = value
+        if normalized:
+            start = numeric_value(start, vr) if start else None
+            end = numeric_value(end, vr, upper=True) if end else None
+        return _range_params(start or None, end or None)
+    raise ValueError(f'Unsupported VR: {vr}')
+
+
+def _date_time_filter_params(date: str, time: str):
+    """Determines filter shape and values for combined date and time range
+
+    :param date: requested date range
+    :type date: str
+    :param time: requested time range
+    :type time: str
+    :return: filter shape and list of filter values
+    :rtype: tuple
+    """
+    start_date, end_date = date.split('-')
+    start_time, end_time = time.split('-')
+    start = date_time_value(start_date, start_time) if start_date else None
+    end = date_time_value(end_date, end_time, upper=True) if end_date else None
+    return _range_params(start, end)
+
+
+def _range_params(start, end):
+    """Creates range filter shape, missing bound makes range open-ended"""
+    shape = ('range', int(start is not None), int(end is not None))
+    return shape, [v for v in (start, end) if v is not None]
+
+
+def _apply_filter(query, attr, shape: tuple, values: list):
+    """Adds filter to query
+
+    :param query: current SQL query
+    :type query: peewee.Query
+    :param attr: filtered column
+    :param shape: filter shape
+    :type shape: tuple
+    :param values: filter values
+    :type values: list
+    :return: query with added filter
+    :rtype: peewee.Query
+    """
+    kind = shape[0]
+    if kind == 'in':
+        return query.where(attr << values)
+    elif kind == 'eq':
+        return query.where(attr == values[0])
+    elif kind == 'like':
+        return query.where(attr ** values[0])
+    elif kind == 'prefix':
+        return query.where(_prefix_range(attr, values[0], values[1]))
+    elif kind == 'prefix_like':
+        return query.where(
+            _prefix_range(attr, values[0], values[1]) & (attr ** values[2])
+        )
+    elif kind == 'range':
+        values = iter(values)
+        if shape[1]:
+            query = query.where(attr >= next(values))
+        if shape[2]:
+            query = query.where(attr <= next(values))
+        return query
+    raise ValueError(f'Unsupported filter: {kind}')
+
+
+def _prefix_range(attr, prefix, upper_bound):
+    """Range of values that start with the prefix
+
+    Upper bound is the prefix with the last character incremented, so values
+    have to be compared character by character. PostgreSQL compares strings
+    using collation of the database, pattern operators are used instead
+    (comparison is the same as with `COLLATE "C"`), they are served by
+    `varchar_pattern_ops` indexes (see :meth:`PACS.create_pattern_indexes`).
+    """
+    if isinstance(db.DB.obj, peewee.PostgresqlDatabase):
+        return (peewee.Expression(attr, '~>=~', prefix) &
+                peewee.Expression(attr, '~<~', upper_bound))
+    return (attr >= prefix) & (attr < upper_bound)
+
+
+def numeric_value(value: str, vr: str, upper: bool = False) -> int:
+    """Converts DA or TM value to integer
+
+    Dates are converted to YYYYMMDD, times to HHMMSSFFFFFF. Components that
+    are missing in a shorter value (YYYY or YYYYMM dates, HH or HHMM times)
+    are filled with minimal values, or with maximal values for the upper
+    bound of a range, so `10` matches any time from `10:00:00` to
+    `10:59:59.999999` and `2020` any date of that year.
+
+    :param value: attribute value
+    :type value: str
+    :param vr: attribute VR (DA or TM)
+    :type vr: str
+    :param upper: value is upper bound of a range, defaults to False
+    :type upper: bool, optional
+    :raises ValueError: raises ValueError for malformed value
+    :return: numeric value
+    :rtype: int
+    """
+    # Separators are allowed by the older versions of the standard
+    if vr == 'DA':
+        value = value.strip().replace('.', '')
+        if len(value) not in (4, 6, 8) or not value.isdigit():
+            raise ValueError(f'Invalid date: {value}')
+        value += ('1231' if upper else '0101')[len(value) - 4:]
+        return int(value)
     elif vr == 'TM':
-        return _time_filter(query, attr, elem.value)
-    elif vr == 'DT':
-        return _date_time_filter(query, attr, elem.value)
+        value = value.strip().replace(':', '')
+        main, _, fraction = value.partition('.')
+        if (len(main) not in (2, 4, 6) or not main.isdigit() or
+                (fraction and not fraction.isdigit())):
+            raise ValueError(f'Invalid time: {value}')
+        main += ('5959' if upper else '0000')[len(main) - 2:]
+        fraction = fraction[:6].ljust(6, '9' if upper else '0')
+        return int(main + fraction)
     raise ValueError(f'Unsupported VR: {vr}')
 
 
-def _filter_upper_level(model, elements: list):
-    """Build filter for upper C-FIND level
+def date_time_value(date: str, time: str, upper: bool = False) -> int:
+    """Converts DA and TM values to YYYYMMDDHHMMSS integer
 
-    :param model: peewee model
+    :param date: date value
+    :type date: str
+    :param time: time value, if empty start (or end) of the day is used
+    :type time: str
+    :param upper: value is upper bound of a range, defaults to False
+    :type upper: bool, optional
+    :raises ValueError: raises ValueError for malformed value
+    :return: numeric value
+    :rtype: int
+    """
+    if time:
+        seconds = numeric_value(time, 'TM', upper) // 1000000
+    else:
+        seconds = 235959 if upper else 0
+    return numeric_value(date, 'DA', upper) * 1000000 + seconds
+
+
+def _stored_value(func, *args):
+    """Converts stored value, malformed and missing values are kept empty"""
+    if not all(args[:1]):
+        return None
+    try:
+        return func(*args)
+    except ValueError:
+        return None
+
+
+def _select_rows(model, query, response_attrs: list):
+    """Selects only response columns as flat rows
+
+    Columns of the upper levels are read from the joined tables, so encoding
+    a response never loads related records. Record id is selected as the
+    last column.
+
+    :param model: C-FIND level model
     :type model: peewee.Model
-    :param elements: upper level elements
-    :type elements: list
-    :yield: tuple of tag, attribute, VR, element and attribute name
+    :param query: C-FIND SQL query
+    :type query: peewee.Query
+    :param response_attrs: list of response attributes (tag, column, VR and
+                           conversion function)
+    :type response_attrs: list
+    :return: tuples query and response attributes with column indexes
     :rtype: tuple
     """
-    for elem in elements:
-        attr_name, vr = model.mapping[elem.tag]
-        attr = getattr(model, attr_name)
-        yield elem.tag, attr, vr, elem, attr_name
+    columns = []
+    indexed_attrs = []
+    for tag, column, vr, func in response_attrs:
+        if column is None:
+            indexed_attrs.append((tag, None, vr, func))
+        else:
+            indexed_attrs.append((tag, len(columns), vr, func))
+            columns.append(column)
+    columns.append(model.id)
+    return query.select(*columns).tuples(), indexed_attrs
 
 
-def _encode_response(instance, response_attrs: list, encoding: str):
+def _encode_response(row: tuple, response_attrs: list, encoding: str):
     """Creates a C-FIND response dataset
 
-    :param instance: database model instance
-    :type instance: peewee.Model
-    :param response_attrs: list of response attributes (tag, attribute name in
-                           the database model and VR)
+    :param row: database row
+    :type row: tuple
+    :param response_attrs: list of response attributes (tag, column index in
+                           the row, VR and conversion function)
     :type response_attrs: list
     :param encoding: response encoding
     :type encoding: str
@@ -1020,52 +2602,107 @@ def _encode_response(instance, response_attrs: list, encoding: str):
     """
     rsp = pydicom.Dataset()
     rsp.SpecificCharacterSet = encoding
-    for tag, attr_name, vr, func in response_attrs:
-        if attr_name is None:
+    for tag, index, vr, func in response_attrs:
+        if index is None:
             # Attribute not supported
             rsp.add_new(tag, vr, None)
         else:
-            if not isinstance(attr_name, tuple):
-                attr = getattr(instance, attr_name)
-            else:
-                attr = instance
-                for field in attr_name:
-                    attr = getattr(attr, field)
+            attr = row[index]
             if func:
-                    attr = func(attr)
+                attr = func(attr)
             rsp.add_new(tag, vr, attr)
     return rsp
 
-def _text_filter(query: peewee.Query, attr, value: str):
-    if isinstance(value, list):
-        return query.where(attr << value)
-    value = value.replace('?', '_')
-    value = value.replace('*', '%')
-    return query.where(attr ** value)
+
+def _with_timeout(rows, database: peewee.Database, timeout: float):
+    """Iterates over query rows with time limit (see
+    :func:`tiny_pacs.db.query_timeout`). Only fetching of rows is timed,
+    clock is paused while rows are handled by the caller."""
+    with db.query_timeout(database, timeout) as deadline:
+        for row in rows:
+            with deadline.paused():
+                yield row
 
 
-def _date_filter(query: peewee.Query, attr, value: str):
-    if '-' in value:
-        start, end = value.split('-')
-        # TODO: Add normalization for shorter value
-        return query.where((attr >= start) & (attr <= end))
+def _response_encoder(response_attrs: list, encoding: str, is_implicit_VR):
+    """Creates function that encodes result rows
 
-    return query.where(attr == value)
+    :param response_attrs: list of response attributes (tag, column index in
+                           the row, VR and conversion function)
+    :type response_attrs: list
+    :param encoding: response encoding
+    :type encoding: str
+    :param is_implicit_VR: VR encoding of the response bytes, `None` for
+                           response datasets
+    :return: callable that accepts a row and returns either
+             :class:`pydicom.Dataset` or encoded data set
+    """
+    if is_implicit_VR is None:
+        return lambda row: _encode_response(row, response_attrs, encoding)
+    return encoder.ResponseEncoder(
+        response_attrs, encoding, is_implicit_VR
+    ).encode
+
+
+def search_value(value, vr: str):
+    """Normalizes text value for matching against search columns
+
+    Values are upper-cased. Person names additionally have components
+    stripped of padding and trailing empty components removed, so
+    `Smith^John^^` and `SMITH^JOHN` are the same. Wildcards are preserved.
 
+    :param value: attribute value
+    :param vr: attribute VR
+    :type vr: str
+    :return: normalized value
+    :rtype: str
+    """
+    if value is None:
+        return None
+    value = str(value).strip().upper()
+    if vr == 'PN':
+        groups = (
+            '^'.join(c.strip() for c in group.split('^')).rstrip('^')
+            for group in value.split('=')
+        )
+        value = '='.join(groups).rstrip('=')
+    return value
 
-def _time_filter(query: peewee.Query, attr, value: str):
-    if '-' in value:
-        start, end = value.split('-')
-        # TODO: Add normalization for shorter value
-        return query.where((attr >= start) & (attr <= end))
 
-    return query.where(attr == value)
+#: C-FIND level models ordered from the top level
+LEVEL_MODELS = {
+    'PATIENT': Patient,
+    'STUDY': Study,
+    'SERIES': Series,
+    'IMAGE': Instance
+}
 
 
-def _date_time_filter(query: peewee.Query, attr, value: str):
-    if '-' in value:
-        start, end = value.split('-')
-        # TODO: Add normalization for shorter value
-        return query.where((attr >= start) & (attr <= end))
+def _migrate_columns(migrator):
+    """Adds search, numeric and aggregated columns and fills them in"""
+    for model in (Patient, Study, Series, Instance):
+        added = db.add_missing_columns(migrator, model)
+        if not added or not issubclass(model, SearchableModel):
+            continue
+        ids = [row_id for row_id, in model.select(model.id).tuples()]
+        for batch in peewee.chunked(ids, SELECT_BATCH_SIZE):
+            for record in model.select().where(model.id << batch):
+                # Shadow columns are updated on save
+                record.save()
+    _refresh_counters()
+
+
+def _migrate_indexes(migrator):
+    """Replaces single column indexes with composite ones"""
+    for model in (Patient, Study, Series, Instance):
+        db.sync_indexes(
+            migrator, model,
+            lambda name: name.endswith(SEARCH_INDEX_SUFFIXES)
+        )
+
 
-    return query.where(attr == value)
+#: Schema migrations, see :class:`tiny_pacs.db.Migration`
+MIGRATIONS = [
+    db.Migration(1, 'Search, numeric and aggregated columns', _migrate_columns),
+    db.Migration(2, 'Composite indexes', _migrate_indexes)
+]
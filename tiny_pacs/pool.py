@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""Pool of established outbound associations.
+
+Negotiating association takes several round-trips, which dominates the time
+of sending small objects. Pool keeps associations open after use and hands
+them out again to the same destination, as long as they have all
+presentation contexts that are needed.
+"""
+import contextlib
+import logging
+import threading
+import time
+
+from pynetdicom2 import asceprovider
+from pynetdicom2 import sopclass
+from pynetdicom2 import uids
+
+from pydicom import uid
+
+
+class PooledAssociation:
+    """Idle association kept by the pool"""
+
+    def __init__(self, assoc: asceprovider.AssociationRequester,
+                 echo_pc_id: int):
+        self.assoc = assoc
+        self.echo_pc_id = echo_pc_id
+        self.idle_since = time.monotonic()
+
+    def supports(self, client_ae, sop_classes, transfer_syntaxes=None) -> bool:
+        """Checks that association has contexts for all SOP Classes
+
+        Transfer syntax of the accepted context must be one of the proposed
+        by client AE (or one of the requested ones).
+        """
+        proposed = {}
+        for ctx in client_ae.context_def_list.values():
+            proposed.setdefault(ctx.sop_class, set()).update(ctx.supported_ts)
+        for sop_class in sop_classes:
+            try:
+                _, ts = self.assoc.sop_classes_as_scu[sop_class]
+            except KeyError:
+                return False
+            if ts not in (transfer_syntaxes or proposed.get(sop_class, ())):
+                return False
+        return True
+
+
+class AssociationPool:
+    """Outbound associations kept per destination
+
+    Destination is identified by its AE title, address and port. Idle
+    association is reused if it has accepted contexts for every SOP Class
+    that is requested, with one of the transfer syntaxes proposed by the
+    client. Otherwise new association is negotiated, replacing idle
+    association if destination limit is reached.
+
+    :ivar max_per_destination: maximum number of associations (active and
+                               idle) with a single destination
+    :ivar idle_timeout: idle associations are released after this number
+                        of seconds
+    :ivar echo_after: idle associations are verified with C-ECHO before use,
+                      if they were idle for longer than this number of
+                      seconds
+    """
+
+    def __init__(self, max_per_destination: int = 4,
+                 idle_timeout: float = 30.0, echo_after: float = 5.0):
+        self.max_per_destination = max_per_destination
+        self.idle_timeout = idle_timeout
+        self.echo_after = echo_after
+        self.log = logging.getLogger('AssociationPool')
+        self._idle = {}
+        self._active = {}
+        self._cond = threading.Condition()
+        self._reaper = None
+        self._closed = False
+        self._stats = {
+            'created': 0, 'reused': 0, 'renegotiated': 0, 'expired': 0,
+            'failed_checks': 0
+        }
+
+    @contextlib.contextmanager
+    def association(self, client_ae, remote_ae: dict, sop_classes=None,
+                    transfer_syntaxes=None):
+        """Gets association with destination
+
+        Association is returned to the pool when block is left. It is aborted
+        if exception is raised, since it can't be known if it's still
+        usable.
+
+        :param client_ae: application entity, that provides presentation
+                          contexts and SCU services
+        :type client_ae: pynetdicom2.applicationentity.ClientAE
+        :param remote_ae: destination (``aet``, ``address`` and ``port``)
+        :type remote_ae: dict
+        :param sop_classes: SOP Class UIDs that will be used, defaults to all
+                            SOP Classes of the client AE
+        :param transfer_syntaxes: acceptable transfer syntaxes, defaults to
+                                  the ones proposed by client AE
+        :return: established association
+        :rtype: pynetdicom2.asceprovider.AssociationRequester
+        """
+        if sop_classes is None:
+            sop_classes = [ctx.sop_class
+                           for ctx in client_ae.context_def_list.values()]
+        key = (remote_ae['aet'], remote_ae['address'], remote_ae['port'])
+        pooled = self._acquire(key, client_ae, remote_ae, sop_classes,
+                               transfer_syntaxes)
+        # Services of the current client are used
+        pooled.assoc.ae = client_ae
+        try:
+            yield pooled.assoc
+        except BaseException:
+            self._discard(key, pooled, abort=True)
+            raise
+        else:
+            self._release(key, pooled)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(
+                self._stats,
+                active=sum(self._active.values()),
+                idle=sum(len(idle) for idle in self._idle.values())
+            )
+
+    def close(self):
+        """Releases all idle associations
+
+        Associations that are still in use are released once they are
+        returned.
+        """
+        with self._cond:
+            self._closed = True
+            idle = [p for pooled in self._idle.values() for p in pooled]
+            self._idle.clear()
+            self._cond.notify_all()
+        for pooled in idle:
+            self._close(pooled)
+
+    def _acquire(self, key, client_ae, remote_ae, sop_classes,
+                 transfer_syntaxes):
+        while True:
+            replaced = None
+            with self._cond:
+                self._expire()
+                idle = self._idle.setdefault(key, [])
+                pooled = next(
+                    (p for p in reversed(idle)
+                     if p.supports(client_ae, sop_classes,
+                                   transfer_syntaxes)),
+                    None
+                )
+                if pooled is None:
+                    count = self._active.get(key, 0) + len(idle)
+                    if count >= self.max_per_destination:
+                        if not idle:
+                            self._cond.wait()
+                            continue
+                        # Contexts are missing, negotiate a new one instead
+                        replaced = idle.pop(0)
+                        self._stats['renegotiated'] += 1
+                else:
+                    idle.remove(pooled)
+                self._active[key] = self._active.get(key, 0) + 1
+
+            if replaced is not None:
+                self._close(replaced)
+            if pooled is None:
+                return self._connect(key, client_ae, remote_ae)
+            if self._is_alive(pooled):
+                with self._cond:
+                    self._stats['reused'] += 1
+                return pooled
+            self._discard(key, pooled, abort=True)
+
+    def _connect(self, key, client_ae, remote_ae) -> PooledAssociation:
+        assoc = None
+        try:
+            assoc = asceprovider.AssociationRequester(client_ae,
+                                                      remote_ae=remote_ae)
+            # Verification is always proposed for health checks
+            echo_pc_id = max(assoc.context_def_list, default=-1) + 2
+            assoc.context_def_list[echo_pc_id] = asceprovider.PContextDef(
+                echo_pc_id, uid.UID(uids.VERIFICATION_SOP_CLASS),
+                [uid.ImplicitVRLittleEndian]
+            )
+            assoc.request()
+        except BaseException:
+            if assoc is not None:
+                assoc.kill()
+            with self._cond:
+                self._active[key] -= 1
+                self._cond.notify_all()
+            raise
+        self.log.debug('New association with %s', key[0])
+        with self._cond:
+            self._stats['created'] += 1
+        return PooledAssociation(assoc, echo_pc_id)
+
+    def _is_alive(self, pooled: PooledAssociation) -> bool:
+        assoc = pooled.assoc
+        if (not assoc.association_established or assoc.dul.is_killed or
+                not assoc.dul.is_alive()):
+            return False
+        if not assoc.dul.to_service_user.empty():
+            # Nothing is expected on idle association, except release or
+            # abort from the other side
+            return False
+        if time.monotonic() - pooled.idle_since < self.echo_after:
+            return True
+        if pooled.echo_pc_id not in assoc.accepted_contexts:
+            return True
+        try:
+            status = sopclass.verification_scu(
+                assoc, assoc.accepted_contexts[pooled.echo_pc_id], 1
+            )
+        except Exception as e:
+            self.log.info(f'Pooled association failed C-ECHO: {e}')
+            status = None
+        if status is None or not status.is_success:
+            with self._cond:
+                self._stats['failed_checks'] += 1
+            return False
+        return True
+
+    def _release(self, key, pooled: PooledAssociation):
+        with self._cond:
+            self._active[key] -= 1
+            if pooled.assoc.association_established and not self._closed:
+                pooled.idle_since = time.monotonic()
+                self._idle.setdefault(key, []).append(pooled)
+                pooled = None
+                self._start_reaper()
+            self._cond.notify_all()
+        if pooled is not None:
+            self._close(pooled)
+
+    def _discard(self, key, pooled: PooledAssociation, abort=False):
+        with self._cond:
+            self._active[key] -= 1
+            self._cond.notify_all()
+        self._close(pooled, abort)
+
+    def _start_reaper(self):
+        if self._reaper is None:
+            self._reaper = threading.Thread(
+                target=self._reap, name='AssociationPoolReaper', daemon=True
+            )
+            self._reaper.start()
+
+    def _reap(self):
+        # Runs while there are idle associations, so they are released even
+        # if destination is never used again
+        with self._cond:
+            while not self._closed:
+                self._expire()
+                oldest = min((p.idle_since for idle in self._idle.values()
+                              for p in idle), default=None)
+                if oldest is None:
+                    break
+                timeout = oldest + self.idle_timeout - time.monotonic()
+                self._cond.wait(max(timeout, 0.01))
+            self._reaper = None
+
+    def _expire(self):
+        now = time.monotonic()
+        for key, idle in self._idle.items():
+            expired = [p for p in idle
+                       if now - p.idle_since >= self.idle_timeout]
+            for pooled in expired:
+                idle.remove(pooled)
+                self._stats['expired'] += 1
+                # Release waits for the response, do it in background
+                threading.Thread(target=self._close, args=(pooled,),
+                                 daemon=True).start()
+
+    def _close(self, pooled: PooledAssociation, abort=False):
+        assoc = pooled.assoc
+        try:
+            if abort or not assoc.association_established:
+                if assoc.association_established:
+                    assoc.abort()
+                else:
+                    assoc.kill()
+            else:
+                assoc.release()
+        except Exception as e:
+            self.log.info(f'Failed to close pooled association: {e}')
+            assoc.kill()
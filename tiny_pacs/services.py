@@ -1,17 +1,516 @@
 # -*- coding: utf-8 -*-
 import functools
-from itertools import count
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+from itertools import chain, count
 
+import pydicom
 from pydicom import uid
+from pydicom.errors import InvalidDicomError
 
 from pynetdicom2 import asceprovider
 from pynetdicom2 import applicationentity
 from pynetdicom2 import dimsemessages
 from pynetdicom2 import exceptions
+from pynetdicom2 import pdu
 from pynetdicom2 import sopclass
 from pynetdicom2 import statuses
 from pynetdicom2 import dsutils
 
+from . import ingest
+
+
+#: (0xFE00) Matching terminated due to Cancel request (C-FIND)
+C_FIND_CANCEL = statuses.Status(0xFE00, dimsemessages.CFindRSPMessage)
+
+#: P-DATA-TF PDU header followed by a single PDV item header
+PDATA_HEADER = struct.Struct('>BBLLBB')
+
+#: PDU length used for fragments if peer has no limit (maximum length is 0)
+UNLIMITED_PDU_LENGTH = 65536
+
+
+class DataSetFragment:
+    """P-DATA-TF PDU with a single data set fragment.
+
+    Fragment is a view of the stored file, data is copied only once, when
+    PDU is encoded to be written into the socket.
+    """
+
+    pdu_type = 0x04
+
+    def __init__(self, pc_id: int, data: memoryview, is_last: bool):
+        self.pc_id = pc_id
+        self.data = data
+        self.is_last = is_last
+
+    def encode(self) -> bytes:
+        length = len(self.data)
+        header = PDATA_HEADER.pack(self.pdu_type, 0, length + 6, length + 2,
+                                   self.pc_id, 2 if self.is_last else 0)
+        return b''.join((header, self.data))
+
+
+class MappedCStoreRQMessage(dimsemessages.CStoreRQMessage):
+    """C-STORE request with a data set from memory mapped file"""
+
+    def encode(self, pc_id, max_pdu_length):
+        if not max_pdu_length:
+            max_pdu_length = UNLIMITED_PDU_LENGTH
+        encoded_command_set = dsutils.encode(self.command_set, True, True)
+        for item, bit in dimsemessages.fragment(encoded_command_set,
+                                                max_pdu_length, 1, 3):
+            value_item = pdu.PresentationDataValueItem(
+                pc_id, struct.pack('b', bit) + item
+            )
+            yield pdu.PDataTfPDU([value_item])
+
+        size = max_pdu_length - 6
+        length = len(self.data_set)
+        for start in range(0, length, size):
+            yield DataSetFragment(pc_id, self.data_set[start:start + size],
+                                  start + size >= length)
+
+
+class MappedFile:
+    """Stored DICOM file mapped into memory.
+
+    :ivar meta: file meta information
+    :ivar data_set: view of the encoded data set (without preamble and file
+                    meta information)
+    """
+
+    def __init__(self, file_name: str):
+        with open(file_name, 'rb') as fp:
+            # Empty file can't be mapped
+            if not os.fstat(fp.fileno()).st_size:
+                raise InvalidDicomError(f'File {file_name} is empty')
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.meta = ingest.read_file_meta(self._map)
+        except Exception:
+            self._map.close()
+            raise
+        self.data_set = memoryview(self._map)[self._map.tell():]
+
+    @property
+    def sop_class_uid(self) -> str:
+        """SOP Class UID, taken from the data set if file meta information
+        doesn't have it"""
+        try:
+            return self.meta.MediaStorageSOPClassUID
+        except AttributeError:
+            return self._header().SOPClassUID
+
+    @property
+    def sop_instance_uid(self) -> str:
+        """SOP Instance UID, taken from the data set if file meta information
+        doesn't have it"""
+        try:
+            return self.meta.MediaStorageSOPInstanceUID
+        except AttributeError:
+            return self._header().SOPInstanceUID
+
+    def _header(self) -> pydicom.Dataset:
+        position = self._map.tell()
+        try:
+            self._map.seek(0)
+            return pydicom.dcmread(self._map, stop_before_pixels=True)
+        finally:
+            self._map.seek(position)
+
+    def close(self):
+        self.data_set.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # Fragments that were not sent yet still reference the file,
+            # it is unmapped once they are gone
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def storage_scu(asce: asceprovider.Association, ctx: asceprovider.PContextDef,
+                dataset, msg_id: int) -> statuses.Status:
+    """Storage SCU that sends stored files without reading them.
+
+    File is memory mapped and data set is sent as fragments of negotiated
+    PDU size that reference the mapping, so large objects are never copied
+    as a whole. Datasets that are not files are sent by the default
+    implementation.
+
+    :param asce: active association
+    :type asce: asceprovider.Association
+    :param ctx: presentation context
+    :type ctx: asceprovider.PContextDef
+    :param dataset: file name or dataset
+    :param msg_id: message identifier
+    :type msg_id: int
+    :return: C-STORE status
+    :rtype: statuses.Status
+    """
+    if not isinstance(dataset, str):
+        return sopclass.storage_scu(asce, ctx, dataset, msg_id)
+
+    with MappedFile(dataset) as mapped:
+        c_store = MappedCStoreRQMessage()
+        c_store.message_id = msg_id
+        c_store.priority = dimsemessages.PRIORITY_MEDIUM
+        c_store.move_originator_aet = asce.ae.local_ae['aet']
+        c_store.move_originator_message_id = msg_id
+        c_store.sop_class_uid = mapped.sop_class_uid
+        c_store.affected_sop_instance_uid = mapped.sop_instance_uid
+        c_store.data_set = mapped.data_set
+        asce.send(c_store, ctx.id)
+
+        # wait for c-store response
+        response, _ = asce.receive()
+    return statuses.Status(response.status, dimsemessages.CStoreRSPMessage)
+
+
+@sopclass.sop_classes(sopclass.FIND_SOP_CLASSES)
+def qr_find_scp(asce: asceprovider.AssociationAcceptor,
+                ctx: asceprovider.PContextDef,
+                msg: dimsemessages.CFindRQMessage):
+    """Query/Retrieve C-FIND service implementation.
+
+    Unlike the default implementation, responses could be already encoded
+    data sets (`bytes`), which are sent as is. Matching stops on the first
+    non-pending status, which is sent as the final response, or once
+    C-CANCEL request is received.
+
+    :param asce: active association
+    :type asce: asceprovider.AssociationAcceptor
+    :param ctx: presentation context
+    :type ctx: asceprovider.PContextDef
+    :param msg: incoming message
+    :type msg: dimsemessages.CFindRQMessage
+    """
+    ds = dsutils.decode(msg.data_set, ctx.supported_ts.is_implicit_VR,
+                        ctx.supported_ts.is_little_endian)
+
+    # make response
+    rsp = dimsemessages.CFindRSPMessage()
+    rsp.message_id_being_responded_to = msg.message_id
+    rsp.sop_class_uid = msg.sop_class_uid
+
+    gen = asce.ae.on_receive_find(ctx, ds, asce.remote_ae.strip())
+    final_status = statuses.SUCCESS
+    try:
+        for data_set, status in gen:
+            if _cancel_requested(asce, msg.message_id):
+                final_status = C_FIND_CANCEL
+                break
+            if not status.is_pending:
+                final_status = status
+                break
+            rsp.status = int(status)
+            if isinstance(data_set, bytes):
+                rsp.data_set = data_set
+            else:
+                rsp.data_set = dsutils.encode(
+                    data_set, ctx.supported_ts.is_implicit_VR,
+                    ctx.supported_ts.is_little_endian
+                )
+            asce.send(rsp, ctx.id)
+    finally:
+        # Stops matching and releases database cursor
+        gen.close()
+
+    rsp = dimsemessages.CFindRSPMessage()
+    rsp.message_id_being_responded_to = msg.message_id
+    rsp.sop_class_uid = msg.sop_class_uid
+    rsp.status = int(final_status)
+    asce.send(rsp, ctx.id)
+
+
+def _cancel_requested(asce: asceprovider.AssociationAcceptor,
+                      message_id: int) -> bool:
+    """Checks if C-CANCEL request was received, without blocking
+
+    Only C-CANCEL is taken from the incoming queue, any other request is
+    left for the association loop. Release or abort stops matching, they
+    are raised by the association.
+
+    :param asce: active association
+    :type asce: asceprovider.AssociationAcceptor
+    :param message_id: ID of the operation
+    :type message_id: int
+    :return: `True` if operation should be cancelled
+    :rtype: bool
+    """
+    incoming = asce.dul.to_service_user
+    with incoming.mutex:
+        if not incoming.queue:
+            return False
+        primitive = incoming.queue[0]
+    if primitive.pdu_type != pdu.PDataTfPDU.pdu_type:
+        asce.get_dul_message()
+        return True
+    cancel = _cancel_message(primitive)
+    if cancel is None:
+        # Next request, it's handled once this operation is done
+        return False
+    incoming.get_nowait()
+    return cancel.message_id_being_responded_to == message_id
+
+
+def _cancel_message(p_data: pdu.PDataTfPDU):
+    """C-CANCEL request, if P-DATA holds one
+
+    :param p_data: incoming P-DATA
+    :type p_data: pdu.PDataTfPDU
+    :return: C-CANCEL request or `None`
+    :rtype: dimsemessages.CCancelRQMessage
+    """
+    if len(p_data.data_value_items) != 1:
+        return None
+    data = p_data.data_value_items[0].data_value
+    if data[0] != 3:
+        # Not a complete command set
+        return None
+    command_set = dsutils.decode(data[1:], True, True)
+    command_field = command_set.get((0x0000, 0x0100))
+    if (command_field is None or
+            command_field.value != dimsemessages.CCancelRQMessage.command_field):
+        return None
+    return dimsemessages.CCancelRQMessage(command_set)
+
+
+class ParallelSender:
+    """Sends C-STORE sub-operations over several associations.
+
+    Each association is served by its own thread, that takes next dataset
+    as soon as previous one is stored. Datasets are taken from the shared
+    iterator lazily. Destination that refuses additional associations
+    is served by the ones that were established.
+
+    :ivar associations: maximum number of associations
+    """
+
+    def __init__(self, connect, associations: int = 1):
+        """Sender initialization
+
+        :param connect: function that returns context manager, that
+                        establishes association with destination
+        :param associations: maximum number of associations, defaults to 1
+        :type associations: int, optional
+        """
+        self.connect = connect
+        self.associations = max(associations, 1)
+        self.log = logging.getLogger('ParallelSender')
+
+    def send(self, datasets, count: int):
+        """Sends datasets and yields sub-operation results as they complete
+
+        :param datasets: iterable of SOP Class UID and dataset pairs
+        :param count: number of datasets
+        :type count: int
+        :raises exceptions.NetDICOMError: if no association could be
+                                          established
+        :return: generator of SOP Class UID, dataset and status (or
+                 exception if sub-operation failed)
+        """
+        items = iter(datasets)
+        lock = threading.Lock()
+        results = queue.Queue()
+        workers = min(self.associations, count)
+        threads = [
+            threading.Thread(target=self._worker, args=(items, lock, results),
+                             daemon=True)
+            for _ in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        errors = []
+        established = 0
+        while workers:
+            result = results.get()
+            if result is _WORKER_DONE:
+                workers -= 1
+            elif isinstance(result, _Unavailable):
+                workers -= 1
+                errors.append(result.error)
+            elif result is _WORKER_STARTED:
+                established += 1
+            else:
+                yield result
+        for thread in threads:
+            thread.join()
+        if not established:
+            raise errors[0]
+        if errors:
+            self.log.warning('Destination accepted %d of %d associations: %s',
+                             established, len(threads), errors[0])
+        # Items left by the workers with aborted associations
+        for sop_class, data_set in items:
+            yield sop_class, data_set, exceptions.NetDICOMError(
+                'Association with destination was lost'
+            )
+
+    def _worker(self, items, lock: threading.Lock, results: queue.Queue):
+        try:
+            with self.connect() as assoc:
+                results.put(_WORKER_STARTED)
+                for msg_id in count(1):
+                    with lock:
+                        item = next(items, None)
+                    if item is None:
+                        break
+                    sop_class, data_set = item
+                    try:
+                        service = assoc.get_scu(sop_class)
+                        results.put((sop_class, data_set,
+                                     service(data_set, msg_id)))
+                    except Exception as e:
+                        results.put((sop_class, data_set, e))
+                        if not assoc.association_established:
+                            raise
+        except Exception as e:
+            self.log.exception(f'Association with destination failed: {e}')
+            results.put(_Unavailable(e))
+        else:
+            results.put(_WORKER_DONE)
+
+
+class _Unavailable:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+_WORKER_STARTED = object()
+_WORKER_DONE = object()
+
+
+class RetrieveResults:
+    """Datasets of C-MOVE/C-GET request, that are retrieved lazily
+
+    Number of datasets and presentation contexts, that are needed to send
+    them, are known up front, so sub-operations can start before all
+    datasets are found.
+
+    :ivar count: number of datasets
+    """
+
+    def __init__(self, datasets, count: int, contexts: set = None):
+        """Results initialization
+
+        :param datasets: iterable of tuples: SOP Class UID, Transfer Syntax
+                         and either filename or dataset
+        :param count: number of datasets
+        :type count: int
+        :param contexts: set of tuples: SOP Class UID and Transfer Syntax,
+                         defaults to the ones collected from datasets (which
+                         must be a list in that case)
+        :type contexts: set, optional
+        """
+        self.datasets = datasets
+        self.count = count
+        self._contexts = contexts
+
+    @property
+    def contexts(self) -> set:
+        """Set of tuples: SOP Class UID and Transfer Syntax"""
+        if self._contexts is None:
+            self._contexts = {(sop_class, ts)
+                              for sop_class, ts, _ in self.datasets}
+        return self._contexts
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.datasets)
+
+    @classmethod
+    def from_list(cls, datasets) -> 'RetrieveResults':
+        """Results from already retrieved datasets
+
+        :param datasets: iterable of tuples: SOP Class UID, Transfer Syntax
+                         and either filename or dataset
+        :rtype: RetrieveResults
+        """
+        datasets = list(datasets)
+        return cls(datasets, len(datasets))
+
+    @classmethod
+    def combine(cls, results: list) -> 'RetrieveResults':
+        """Combines results of several event handlers
+
+        Results are retrieved lazily only if every handler returned
+        :class:`RetrieveResults` with known presentation contexts.
+
+        :param results: list of :class:`RetrieveResults` or iterables of
+                        datasets
+        :type results: list
+        :rtype: RetrieveResults
+        """
+        if len(results) == 1 and isinstance(results[0], RetrieveResults):
+            return results[0]
+        if all(isinstance(r, RetrieveResults) and r._contexts is not None
+               for r in results):
+            return cls(
+                chain.from_iterable(results),
+                sum(len(r) for r in results),
+                set().union(*(r.contexts for r in results))
+            )
+        return cls.from_list(chain.from_iterable(results))
+
+
+class SubOperations:
+    """Counters of C-MOVE/C-GET sub-operations
+
+    Total number of sub-operations is an estimate, datasets can be removed
+    or added while they are sent.
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self.completed = 0
+        self.failed = 0
+        self.warning = 0
+
+    @property
+    def remaining(self) -> int:
+        return max(
+            self.total - self.completed - self.failed - self.warning, 0
+        )
+
+    def update(self, status):
+        """Counts finished sub-operation
+
+        :param status: C-STORE status or exception raised by the sub-operation
+        """
+        if isinstance(status, Exception) or status.is_failure:
+            self.failed += 1
+        elif status.is_warning:
+            self.warning += 1
+        else:
+            self.completed += 1
+
+    def finish(self):
+        """Counts sub-operations, that were expected but never performed
+
+        Dataset could have been removed after sub-operations were counted.
+        """
+        self.failed += self.remaining
+
+    def set_ops(self, rsp):
+        rsp.num_of_remaining_sub_ops = self.remaining
+        rsp.num_of_completed_sub_ops = self.completed
+        rsp.num_of_failed_sub_ops = self.failed
+        rsp.num_of_warning_sub_ops = self.warning
+
 
 @sopclass.sop_classes(sopclass.MOVE_SOP_CLASSES)
 def qr_move_scp(asce: asceprovider.AssociationAcceptor,
@@ -19,6 +518,10 @@ def qr_move_scp(asce: asceprovider.AssociationAcceptor,
                 msg: dimsemessages.CMoveRQMessage):
     """Query/Retrieve C-MOVE service implementation.
 
+    Sub-operations are sent over ``move_associations`` parallel
+    associations of the application entity, that are taken from its
+    association pool.
+
     :param asce: active association
     :type asce: asceprovider.AssociationAcceptor
     :param ctx: presentation context
@@ -35,8 +538,8 @@ def qr_move_scp(asce: asceprovider.AssociationAcceptor,
     rsp.sop_class_uid = msg.sop_class_uid
     remote_ae, gen = asce.ae.on_receive_move(ctx, ds, msg.move_destination)
 
-    if not isinstance(gen, list):
-        gen = list(gen)
+    if not isinstance(gen, RetrieveResults):
+        gen = RetrieveResults.from_list(gen)
 
     nop = len(gen)
     if not nop:
@@ -46,7 +549,7 @@ def qr_move_scp(asce: asceprovider.AssociationAcceptor,
         asce.send(rsp, ctx.id)
         return
 
-    contexts = {(sop_class, ts) for sop_class, ts, _ in gen}
+    contexts = gen.contexts
     datasets = ((sop_class, d) for sop_class, _, d in gen)
 
     aet = asce.ae.local_ae['aet']
@@ -54,37 +557,31 @@ def qr_move_scp(asce: asceprovider.AssociationAcceptor,
     client = applicationentity.ClientAE(aet)
     for context, pc_id in zip(contexts, count(0, 2)):
         sop_class, ts = context
-        client.supported_scu[sop_class] = sopclass.storage_scu
+        client.supported_scu[sop_class] = storage_scu
         pc_def = asceprovider.PContextDef(pc_id, uid.UID(sop_class), [ts])
         client.context_def_list[pc_id] = pc_def
 
-    with client.request_association(remote_ae) as assoc:
-        failed = 0
-        warning = 0
-        completed = 0
-        success = 0
-        rsp.status = int(statuses.C_MOVE_PENDING)
-        for sop_class, data_set in datasets:
-            # request an association with destination send C-STORE
-            service = assoc.get_scu(sop_class)
-            status = service(data_set, completed)
-            if status.is_failure:
-                failed += 1
-            elif status.is_warning:
-                warning += 1
-            else:
-                success +=1
-            rsp.num_of_remaining_sub_ops = nop - completed
-            rsp.num_of_completed_sub_ops = success
-            rsp.num_of_failed_sub_ops = failed
-            rsp.num_of_warning_sub_ops = warning
-            completed += 1
-
-            # send response
-            asce.send(rsp, ctx.id)
-        _set_ops(rsp, completed, failed, warning, success)
-        rsp.status = int(statuses.SUCCESS)
+    if asce.ae.association_pool is not None:
+        connect = functools.partial(asce.ae.association_pool.association,
+                                    client, remote_ae)
+    else:
+        connect = functools.partial(client.request_association, remote_ae)
+    sender = ParallelSender(connect, asce.ae.move_associations)
+    sub_ops = SubOperations(nop)
+    rsp.status = int(statuses.C_MOVE_PENDING)
+    for _, _, status in sender.send(datasets, nop):
+        sub_ops.update(status)
+        sub_ops.set_ops(rsp)
+
+        # send response
         asce.send(rsp, ctx.id)
+    sub_ops.finish()
+    sub_ops.set_ops(rsp)
+    if sub_ops.failed or sub_ops.warning:
+        rsp.status = int(statuses.C_MOVE_WARNING)
+    else:
+        rsp.status = int(statuses.SUCCESS)
+    asce.send(rsp, ctx.id)
 
 
 @sopclass.sop_classes(sopclass.GET_SOP_CLASSES)
@@ -108,8 +605,8 @@ def qr_get_scp(asce: asceprovider.AssociationAcceptor,
     rsp.sop_class_uid = msg.sop_class_uid
     gen = asce.ae.on_receive_get(ctx, ds)
 
-    if not isinstance(gen, list):
-        gen = list(gen)
+    if not isinstance(gen, RetrieveResults):
+        gen = RetrieveResults.from_list(gen)
 
     nop = len(gen)
     if not nop:
@@ -119,14 +616,9 @@ def qr_get_scp(asce: asceprovider.AssociationAcceptor,
         asce.send(rsp, ctx.id)
         return
 
-    datasets = ((sop_class, ts, d) for sop_class, ts, d in gen)
-
-    failed = 0
-    warning = 0
-    completed = 0
-    success = 0
+    sub_ops = SubOperations(nop)
     rsp.status = int(statuses.C_GET_PENDING)
-    for sop_class, ts, data_set in datasets:
+    for msg_id, (sop_class, ts, data_set) in enumerate(gen):
         for _, context in asce.accepted_contexts.items():
             if context.sop_class == sop_class and context.supported_ts == ts:
                 pc_id = context.id
@@ -137,27 +629,21 @@ def qr_get_scp(asce: asceprovider.AssociationAcceptor,
                   'is not supported {}'.format(sop_class, ts)
             raise exceptions.NetDICOMError(msg)
         service = functools.partial(
-            sopclass.storage_scu, asce,
+            storage_scu, asce,
             asceprovider.PContextDef(pc_id, sop_class, ts)
         )
-        status = service(data_set, completed)
-        if status.is_failure:
-            failed += 1
-        elif status.is_warning:
-            warning += 1
-        else:
-            success +=1
-        rsp.num_of_remaining_sub_ops = nop - completed
-        rsp.num_of_completed_sub_ops = success
-        rsp.num_of_failed_sub_ops = failed
-        rsp.num_of_warning_sub_ops = warning
-        completed += 1
+        sub_ops.update(service(data_set, msg_id))
+        sub_ops.set_ops(rsp)
 
         # send response
         asce.send(rsp, ctx.id)
 
-    _set_ops(rsp, completed, failed, warning, success)
-    rsp.status = int(statuses.SUCCESS)
+    sub_ops.finish()
+    sub_ops.set_ops(rsp)
+    if sub_ops.failed or sub_ops.warning:
+        rsp.status = int(statuses.C_GET_WARNING)
+    else:
+        rsp.status = int(statuses.SUCCESS)
     asce.send(rsp, ctx.id)
 
 
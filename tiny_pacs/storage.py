@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 import datetime
+import collections
 import enum
+import hashlib
 import io
 import os
 import shutil
 import tempfile
+import threading
+import uuid
 
 import peewee
 
@@ -12,18 +16,33 @@ import pydicom
 from pynetdicom2 import applicationentity
 
 from . import ae
+from . import cache
 from . import component
 from . import db
 from . import event_bus
+from . import ingest
 
 
 class StorageChannels(enum.Enum):
+    ON_STORE_RECEIVED = 'on-store-received'
     ON_STORE_DONE = 'on-store-done'
     ON_STORE_FAILURE = 'on-store-failure'
+    ON_STORE_QUARANTINE = 'on-store-quarantine'
+    ON_STORE_DELETE = 'on-store-delete'
     ON_GET_FILES = 'on-store-get-files'
+    ON_GET_CONTEXTS = 'on-store-get-contexts'
+    ON_GET_UNINDEXED = 'on-store-get-unindexed'
     ON_STORE_VERIFY = 'on-store-verify'
 
 
+#: Folder (relative to storage directory) for datasets that were received,
+#: but could not be indexed
+QUARANTINE_FOLDER = 'quarantine'
+
+#: Maximum number of values in a single IN condition
+SELECT_BATCH_SIZE = 500
+
+
 class StorageFiles(peewee.Model):
     sop_instance_uid = peewee.CharField(max_length=64, unique=True)
     sop_class_uid = peewee.CharField(max_length=64, index=True)
@@ -33,36 +52,229 @@ class StorageFiles(peewee.Model):
     is_stored = peewee.BooleanField(index=True, default=False)
 
 
+class StorageFileVersions(peewee.Model):
+    """Previous versions of re-sent instances (see
+    :attr:`DuplicatePolicy.VERSION`)"""
+    sop_instance_uid = peewee.CharField(max_length=64, index=True)
+    sop_class_uid = peewee.CharField(max_length=64)
+    transfer_syntax = peewee.CharField(max_length=64)
+    file_name = peewee.TextField()
+    added = peewee.DateTimeField()
+    replaced = peewee.DateTimeField(default=datetime.datetime.utcnow)
+
+
+class DuplicatePolicy(enum.Enum):
+    """Handling of instances that are already stored."""
+
+    #: Dataset is acknowledged, but it is neither written nor indexed
+    IGNORE = 'ignore'
+
+    #: Stored file is replaced
+    OVERWRITE = 'overwrite'
+
+    #: Stored file is kept as a previous version
+    VERSION = 'version'
+
+
+class StorageLayout(enum.Enum):
+    """Directory layout of :class:`FileStorage`."""
+
+    #: Files are grouped into a single folder per day (``YYYYMMDD``)
+    DATE = 'date'
+
+    #: Files are spread over nested folders named after SOP Instance UID
+    #: hash (``ab/cd``), so folder size stays bounded
+    HASHED = 'hashed'
+
+
 class StorageBase(component.Component):
     def __init__(self, bus: event_bus.EventBus, config: dict):
         super().__init__(bus, config)
-
-        self.subscribe(ae.AEChannels.ON_GET_FILE, self.on_get_file)
+        self.retrieve_consistency = db.Consistency(
+            config.get('retrieve_consistency', db.Consistency.READ_YOUR_WRITES)
+        )
+        #: Handling of re-sent instances
+        self.duplicates = DuplicatePolicy(
+            config.get('duplicates', DuplicatePolicy.IGNORE)
+        )
+        #: SOP Instance UIDs of all stored files, positive answers are
+        #: confirmed by the database
+        self.known_instances = cache.BloomFilter(
+            config.get('known_instances_capacity', 1000000),
+            config.get('known_instances_error_rate', 0.001)
+        )
+        # Replaced file records, kept until new file is stored. Keyed by
+        # SOP Instance UID and the new file name, since the same instance
+        # can be received concurrently
+        self._replaced = {}
+        self._replaced_lock = threading.Lock()
+
+        self.subscribe(event_bus.DefaultChannels.ON_START,
+                       self.load_known_instances, self.priority + 10)
+        self.subscribe(ae.AEChannels.ON_GET_FILE, self.get_file)
+        self.subscribe(StorageChannels.ON_STORE_RECEIVED, self.on_store_received)
         self.subscribe(StorageChannels.ON_STORE_DONE, self.on_store_done)
         self.subscribe(StorageChannels.ON_STORE_FAILURE, self.on_store_failure)
+        self.subscribe(StorageChannels.ON_STORE_QUARANTINE,
+                       self.on_store_quarantine)
+        self.subscribe(StorageChannels.ON_STORE_DELETE, self.on_store_delete)
         self.subscribe(StorageChannels.ON_GET_FILES, self.on_store_get_files)
+        self.subscribe(StorageChannels.ON_GET_CONTEXTS, self.on_get_contexts)
+        self.subscribe(StorageChannels.ON_GET_UNINDEXED, self.on_get_unindexed)
         self.subscribe(StorageChannels.ON_STORE_VERIFY, self.verify)
         self.subscribe(db.DBChannels.TABLES, self.tables)
 
     @staticmethod
     def tables():
-        return [StorageFiles]
+        return [StorageFiles, StorageFileVersions]
 
     def atomic(self):
         return self.send_one(db.DBChannels.ATOMIC)
 
+    def write(self, func, *args, **kwargs):
+        return self.send_one(db.DBChannels.WRITE, func, *args, **kwargs)
+
+    def replica(self, consistency: db.Consistency):
+        return self.send_one(db.DBChannels.REPLICA, consistency)
+
+    def connection(self):
+        return self.send_one(db.DBChannels.CONNECTION)
+
+    def load_known_instances(self):
+        """Loads SOP Instance UIDs of stored files into existence filter"""
+        self.known_instances.clear()
+        query = StorageFiles.select(StorageFiles.sop_instance_uid).tuples()
+        with self.connection():
+            self.known_instances.update(uid for uid, in db.stream(query))
+        self.log_info('Loaded %d known instances', len(self.known_instances))
+
+    def is_known(self, sop_instance_uid: str) -> bool:
+        """Checks if instance is already stored (or is being stored).
+
+        Database is queried only if existence filter can't rule instance
+        out, so new instances are checked without any queries.
+
+        :param sop_instance_uid: SOP Instance UID
+        :type sop_instance_uid: str
+        :return: `True` if file record for the instance exists
+        :rtype: bool
+        """
+        if sop_instance_uid not in self.known_instances:
+            return False
+        query = StorageFiles.select()\
+            .where(StorageFiles.sop_instance_uid == sop_instance_uid)
+        return query.bind(self.replica(db.Consistency.READ_YOUR_WRITES))\
+            .exists()
+
+    def get_file(self, context, command_set: pydicom.Dataset):
+        """Gets file for incoming dataset.
+
+        Duplicates are discarded without writing them, if configured to be
+        ignored. Otherwise storage is selected by :meth:`on_get_file`.
+
+        :param context: presentation context
+        :type context: pynetdicom2.asceprovider.PContextDef
+        :param command_set: C-STORE command set
+        :type command_set: pydicom.Dataset
+        :return: tuple of file-like object and its start position
+        :rtype: tuple
+        """
+        sop_instance_uid = command_set.AffectedSOPInstanceUID
+        if (self.duplicates == DuplicatePolicy.IGNORE and
+                self.is_known(sop_instance_uid)):
+            self.log_info('Ignoring duplicate instance %s', sop_instance_uid)
+            return ingest.DiscardedDataset(sop_instance_uid), 0
+        return self.on_get_file(context, command_set)
+
     def on_get_file(self, context, command_set: pydicom.Dataset):
         raise NotImplementedError()
 
-    def on_store_done(self, ds: pydicom.Dataset):
+    def on_store_received(self, ingest_ctx: ingest.IngestContext):
+        """Dataset is received, but it is not indexed yet.
+
+        Called before C-STORE response is sent. Storage should make sure
+        that dataset outlives the request. Default implementation does nothing.
+        """
+        pass
+
+    def on_get_unindexed(self):
+        """Datasets that were received, but were never indexed.
+
+        Used to recover write-behind indexing queue after restart.
+        Default implementation returns nothing.
+
+        :return: list of ingest contexts
+        :rtype: list
+        """
+        return []
+
+    def on_store_done(self, ingest_ctx: ingest.IngestContext):
         raise NotImplementedError()
 
-    def on_store_failure(self, ds: pydicom.Dataset):
+    def on_store_failure(self, ingest_ctx: ingest.IngestContext):
         raise NotImplementedError()
 
+    def on_store_quarantine(self, ingest_ctx: ingest.IngestContext):
+        """Dataset was acknowledged, but it could not be indexed.
+
+        Unlike :meth:`on_store_failure` received data must be kept, so it can
+        be inspected and stored again. Default implementation only removes
+        the file record.
+        """
+        file_name = self.remove_file(ingest_ctx.sop_instance_uid,
+                                     self.received_file_name(ingest_ctx))
+        self.log_error('Dataset %s could not be indexed, kept as %s',
+                       ingest_ctx.sop_instance_uid, file_name)
+
     def on_store_get_files(self, sop_instance_uids: list):
         raise NotImplementedError()
 
+    def on_store_delete(self, sop_instance_uids: list):
+        """Instances were removed from the archive.
+
+        File records (and versions) are removed, so re-sent instances are
+        not treated as duplicates, files are discarded.
+
+        :param sop_instance_uids: list of SOP Instance UIDs
+        :type sop_instance_uids: list
+        """
+        file_names = self.write(_delete_files, sop_instance_uids)
+        self.log_info('Removed %d stored files', len(file_names))
+        for file_name in file_names:
+            self.discard_file(file_name)
+
+    def received_file_name(self, ingest_ctx: ingest.IngestContext) -> str:
+        """File name of the received dataset, as passed to :meth:`new_file`
+
+        Default implementation returns `None`, so the current file of the
+        instance is used.
+
+        :param ingest_ctx: received dataset
+        :type ingest_ctx: ingest.IngestContext
+        :return: file name
+        :rtype: str
+        """
+        return None
+
+    def on_get_contexts(self, sop_instance_uids) -> set:
+        """Presentation contexts, that are needed to send stored files
+
+        :param sop_instance_uids: list of SOP Instance UIDs or a query, that
+                                  selects them
+        :return: set of tuples: SOP Class UID and Transfer Syntax
+        :rtype: set
+        """
+        query = StorageFiles.select(
+                StorageFiles.sop_class_uid, StorageFiles.transfer_syntax
+            )\
+            .where(
+                (StorageFiles.sop_instance_uid << sop_instance_uids) &
+                (StorageFiles.is_stored == True)
+            )\
+            .distinct()\
+            .tuples()
+        return set(query.bind(self.replica(self.retrieve_consistency)))
+
     def new_file(self, sop_instance_uid: str, sop_class_uid: str,
                  transfer_syntax: str, file_name: str):
         self.log_info(
@@ -78,33 +290,127 @@ class StorageBase(component.Component):
                 'file_name': file_name
             }
         )
-        with self.atomic():
-            return StorageFiles.create(
-                sop_instance_uid=sop_instance_uid,
-                sop_class_uid=sop_class_uid,
-                transfer_syntax=transfer_syntax,
-                file_name=file_name
-            )
-
-    def file_stored(self, sop_instance_uid: str):
-        with self.atomic():
-            stored_file = StorageFiles.get(StorageFiles.sop_instance_uid == sop_instance_uid)
-            stored_file.is_stored = True
-            stored_file.save()
+        file_record, replaced = self.write(
+            _new_file, sop_instance_uid, sop_class_uid, transfer_syntax,
+            file_name, sop_instance_uid in self.known_instances
+        )
+        self.known_instances.add(sop_instance_uid)
+        if replaced is not None:
+            self.log_info('Replacing stored file %s', replaced.file_name)
+            with self._replaced_lock:
+                self._replaced[(sop_instance_uid, file_name)] = replaced
+        return file_record
+
+    def file_stored(self, sop_instance_uid: str, file_name: str = None):
+        """Marks received file as stored
+
+        :param sop_instance_uid: SOP Instance UID
+        :type sop_instance_uid: str
+        :param file_name: file name passed to :meth:`new_file`, defaults to
+                          None (current file of the instance)
+        :type file_name: str, optional
+        """
+        self.write(_file_stored, sop_instance_uid, file_name)
         self.log_info('Successfully stored file in DB, SOP Instance UID: %s', sop_instance_uid)
-
-    def remove_file(self, sop_instance_uid: str):
-        with self.atomic():
-            stored_file = StorageFiles.get(StorageFiles.sop_instance_uid == sop_instance_uid)
-            file_name = stored_file.file_name
-            stored_file.delete_instance()
-        self.log_info('Removed stored file from DB, SOP Instance UID: %s', sop_instance_uid)
+        with self._replaced_lock:
+            # File could be already replaced by a concurrent re-send,
+            # record is restored if that one fails
+            for record in self._replaced.values():
+                if record.sop_instance_uid == sop_instance_uid and \
+                        record.file_name == file_name:
+                    record.is_stored = True
+        replaced = self._pop_replaced(sop_instance_uid, file_name)
+        if replaced is not None:
+            self.release_replaced(replaced)
+
+    def release_replaced(self, replaced: StorageFiles):
+        """Discards or keeps as a version file, that was replaced
+
+        :param replaced: replaced file record
+        :type replaced: StorageFiles
+        """
+        if self.duplicates == DuplicatePolicy.VERSION:
+            self.write(_add_version, replaced)
+        else:
+            self.discard_file(replaced.file_name)
+
+    def remove_file(self, sop_instance_uid: str, file_name: str = None) -> str:
+        """Removes record of received file, that could not be stored
+
+        If received file replaced stored one, previous record is restored.
+
+        :param sop_instance_uid: SOP Instance UID
+        :type sop_instance_uid: str
+        :param file_name: file name passed to :meth:`new_file`, defaults to
+                          None (current file of the instance)
+        :type file_name: str, optional
+        :return: name of the removed file
+        :rtype: str
+        """
+        replaced = self._pop_replaced(sop_instance_uid, file_name)
+        if replaced is None:
+            file_name = self.write(_remove_file, sop_instance_uid, file_name)
+            self.log_info('Removed stored file from DB, SOP Instance UID: %s', sop_instance_uid)
+        else:
+            file_name, restored = self.write(_restore_file, replaced, file_name)
+            if restored:
+                # Previous file is still valid
+                self.log_info('Restored replaced file, SOP Instance UID: %s', sop_instance_uid)
+                return file_name
+        self._hand_over(sop_instance_uid, file_name, replaced)
         return file_name
 
+    def _pop_replaced(self, sop_instance_uid: str, file_name: str):
+        with self._replaced_lock:
+            if file_name is not None:
+                return self._replaced.pop((sop_instance_uid, file_name), None)
+            for key in self._replaced:
+                if key[0] == sop_instance_uid:
+                    return self._replaced.pop(key)
+        return None
+
+    def _hand_over(self, sop_instance_uid: str, file_name: str,
+                   replaced: StorageFiles):
+        """Passes previous record of the removed file to the file that
+        replaced it concurrently (if any)
+
+        :param sop_instance_uid: SOP Instance UID
+        :type sop_instance_uid: str
+        :param file_name: removed file name
+        :type file_name: str
+        :param replaced: record replaced by removed file, `None` if it was new
+        :type replaced: StorageFiles
+        """
+        if file_name is None:
+            return
+        with self._replaced_lock:
+            for key, record in self._replaced.items():
+                if key[0] == sop_instance_uid and \
+                        record.file_name == file_name:
+                    if replaced is None:
+                        del self._replaced[key]
+                    else:
+                        self._replaced[key] = replaced
+                    return
+        if replaced is not None:
+            # Newer file is already stored
+            self.release_replaced(replaced)
+
+    def discard_file(self, file_name: str):
+        """Removes file that was replaced by a re-sent instance.
+
+        Default implementation does nothing.
+
+        :param file_name: file name from the file record
+        :type file_name: str
+        """
+        pass
+
     def verify(self, instances: list):
         self.log_debug('Verifying instances: %r', instances)
         sop_instance_uids = [i for _, i in instances]
-        query = self.find_files(sop_instance_uids)
+        # Commitment must see everything that was stored before the request
+        query = self.find_files(sop_instance_uids, db.Consistency.READ_YOUR_WRITES)
         stored_instances = frozenset((r.sop_class_uid, r.sop_instance_uid) for r in query)
         instances = frozenset(instances)
         success = instances & stored_instances
@@ -113,13 +419,14 @@ class StorageBase(component.Component):
         self.log_debug('Verification, missing from storage: %r', failure)
         return success, failure
 
-    def find_files(self, sop_instance_uids: list):
+    def find_files(self, sop_instance_uids: list,
+                   consistency: db.Consistency = db.Consistency.EVENTUAL):
         query = StorageFiles.select()\
             .where(
                 (StorageFiles.sop_instance_uid << sop_instance_uids) &
                 (StorageFiles.is_stored == True)
             )
-        return query
+        return query.bind(self.replica(consistency))
 
     def remove_nothrow(self, file_name):
         try:
@@ -131,24 +438,29 @@ class StorageBase(component.Component):
 class FileStorage(StorageBase):
     def __init__(self, bus: event_bus.EventBus, config: dict):
         super().__init__(bus, config)
+        self.fsync = config.get('fsync', False)
         storage_dir = config.get('storage_dir', None)
         if storage_dir is None:
             # TODO Gracefully remove temporary directory on shutdown
             storage_dir = tempfile.mkdtemp()
             self.subscribe(event_bus.DefaultChannels.ON_EXIT, self.cleanup)
         self.storage_dir = storage_dir
+        self.layout = StorageLayout(config.get('layout', StorageLayout.DATE))
+        #: Number of nested folders for hashed layout, 256 folders each
+        self.fanout_levels = config.get('fanout_levels', 2)
+        # Folders that are known to exist
+        self._folders = set()
+        if config.get('migrate_layout', False):
+            self.subscribe(event_bus.DefaultChannels.ON_START,
+                           self.migrate_layout, self.priority + 10)
 
     def on_get_file(self, context, command_set: pydicom.Dataset):
         sop_instance_uid = command_set.AffectedSOPInstanceUID
         sop_class_uid = command_set.AffectedSOPClassUID
         ts = context.supported_ts
-        full_name = self.get_file_name(sop_instance_uid)
-        folder, file_name = os.path.split(full_name)
-        folder = os.path.basename(folder)
-        file_name = os.path.join(folder, file_name)
+        ds, file_name = self.create_file(sop_instance_uid)
         self.log_info('Storing incoming dataset in %s', file_name)
 
-        ds = open(full_name, 'wb')
         start = ds.tell()
         try:
             applicationentity.write_meta(ds, command_set, ts)
@@ -159,34 +471,210 @@ class FileStorage(StorageBase):
             self.new_file(sop_instance_uid, sop_class_uid, ts, file_name)
             return ds, start
 
-    def on_store_done(self, ds: pydicom.Dataset):
-        self.file_stored(ds.SOPInstanceUID)
+    def on_store_received(self, ingest_ctx: ingest.IngestContext):
+        if self.fsync:
+            ingest_ctx.fp.flush()
+            os.fsync(ingest_ctx.fp.fileno())
+
+    def on_store_done(self, ingest_ctx: ingest.IngestContext):
+        self.file_stored(ingest_ctx.sop_instance_uid,
+                         self.received_file_name(ingest_ctx))
 
-    def on_store_failure(self, ds: pydicom.Dataset):
-        file_name = self.remove_file(ds.SOPInstanceUID)
+    def on_store_failure(self, ingest_ctx: ingest.IngestContext):
+        file_name = self.remove_file(ingest_ctx.sop_instance_uid,
+                                     self.received_file_name(ingest_ctx))
         file_name = os.path.join(self.storage_dir, file_name)
         self.remove_nothrow(file_name)
 
+    def on_store_quarantine(self, ingest_ctx: ingest.IngestContext):
+        """Moves file that could not be indexed into quarantine folder"""
+        file_name = self.remove_file(ingest_ctx.sop_instance_uid,
+                                     self.received_file_name(ingest_ctx))
+        target = os.path.join(self.storage_dir, QUARANTINE_FOLDER, file_name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(os.path.join(self.storage_dir, file_name), target)
+        self.log_error('Dataset %s could not be indexed, moved to %s',
+                       ingest_ctx.sop_instance_uid, target)
+
+    def received_file_name(self, ingest_ctx: ingest.IngestContext) -> str:
+        return os.path.relpath(ingest_ctx.fp.name, self.storage_dir)
+
+    def discard_file(self, file_name: str):
+        self.remove_nothrow(os.path.join(self.storage_dir, file_name))
+
+    def on_get_unindexed(self):
+        query = StorageFiles.select()\
+            .where(StorageFiles.is_stored == False)
+        for file_record in list(query):
+            file_name = os.path.join(self.storage_dir, file_record.file_name)
+            try:
+                with open(file_name, 'rb') as fp:
+                    ingest_ctx = ingest.IngestContext(None, fp)
+                    ingest_ctx.header
+            except Exception as e:
+                # Most likely dataset was not received completely
+                self.log_warning(f'Removing incomplete file {file_name}: {e}')
+                self.remove_file(file_record.sop_instance_uid,
+                                 file_record.file_name)
+                self.remove_nothrow(file_name)
+            else:
+                self.log_info('Found unindexed file %s', file_name)
+                yield ingest_ctx
+
     def on_store_get_files(self, sop_instance_uids: list):
         self.log_debug('Getting files %r', sop_instance_uids)
-        for file_record in self.find_files(sop_instance_uids):
+        for file_record in self.find_files(sop_instance_uids, self.retrieve_consistency):
             file_name = os.path.join(self.storage_dir, file_record.file_name)
             yield file_record.sop_class_uid, file_record.transfer_syntax, file_name
 
-    def get_folder_path(self):
-        now = datetime.datetime.utcnow()
-        return os.path.join(self.storage_dir, now.strftime('%Y%m%d'))
-
-    def get_file_name(self, sop_instance_uid: str):
-        folder = self.get_folder_path()
-        file_name = f'{sop_instance_uid}.dcm'
-        full_name = os.path.join(folder, file_name)
-        i = 0
-        while os.path.exists(full_name):
-            i += 1
-            file_name = f'{sop_instance_uid}_{i}.dcm'
-            full_name = os.path.join(folder, file_name)
-        return full_name
+    def get_folder(self, sop_instance_uid: str,
+                   added: datetime.datetime = None) -> str:
+        """Folder of the file relative to storage directory
+
+        :param sop_instance_uid: SOP Instance UID
+        :type sop_instance_uid: str
+        :param added: time when file was added, defaults to current time
+        :type added: datetime.datetime, optional
+        :return: relative folder path
+        :rtype: str
+        """
+        if self.layout == StorageLayout.HASHED:
+            digest = hashlib.blake2b(
+                sop_instance_uid.encode(), digest_size=8
+            ).hexdigest()
+            return os.path.join(
+                *(digest[i * 2:i * 2 + 2] for i in range(self.fanout_levels))
+            ) if self.fanout_levels else ''
+        added = added or datetime.datetime.utcnow()
+        return added.strftime('%Y%m%d')
+
+    def get_file_name(self, sop_instance_uid: str) -> str:
+        """New file name relative to storage directory
+
+        Name is taken from SOP Instance UID. Instance that may already be
+        stored gets a unique suffix, so names never collide and existing
+        files are not probed.
+
+        :param sop_instance_uid: SOP Instance UID
+        :type sop_instance_uid: str
+        :return: relative file name
+        :rtype: str
+        """
+        if sop_instance_uid in self.known_instances:
+            file_name = f'{sop_instance_uid}_{uuid.uuid4().hex}.dcm'
+        else:
+            file_name = f'{sop_instance_uid}.dcm'
+        return os.path.join(self.get_folder(sop_instance_uid), file_name)
+
+    def create_file(self, sop_instance_uid: str):
+        """Creates new file for incoming dataset
+
+        File is created exclusively, the same instance that is received
+        concurrently over another association gets a unique name.
+
+        :param sop_instance_uid: SOP Instance UID
+        :type sop_instance_uid: str
+        :return: tuple of open file and file name relative to storage
+                 directory
+        :rtype: tuple
+        """
+        file_name = self.get_file_name(sop_instance_uid)
+        self.make_folder(os.path.dirname(file_name))
+        try:
+            fp = open(os.path.join(self.storage_dir, file_name), 'x+b')
+        except FileExistsError:
+            file_name = os.path.join(
+                os.path.dirname(file_name),
+                f'{sop_instance_uid}_{uuid.uuid4().hex}.dcm'
+            )
+            fp = open(os.path.join(self.storage_dir, file_name), 'x+b')
+        return fp, file_name
+
+    def make_folder(self, folder: str):
+        if folder in self._folders:
+            return
+        os.makedirs(os.path.join(self.storage_dir, folder), exist_ok=True)
+        self._folders.add(folder)
+
+    def migrate_layout(self):
+        """Moves stored files to folders of configured layout.
+
+        Files are renamed within storage directory, each record is updated
+        right after its file is moved. Files that are already in a folder of
+        configured layout are kept, so interrupted migration is resumed on
+        the next run. Date folder of moved files is taken from the time
+        record was added.
+        """
+        self.log_info('Migrating storage to %s layout', self.layout.value)
+        moved = 0
+        old_folders = set()
+        with self.connection():
+            for model in (StorageFiles, StorageFileVersions):
+                records = model.select(
+                    model.id, model.sop_instance_uid, model.file_name,
+                    model.added
+                ).tuples()
+                for record_id, sop_instance_uid, file_name, added in \
+                        list(records):
+                    if self._in_layout(sop_instance_uid, file_name):
+                        continue
+                    new_name = os.path.join(
+                        self.get_folder(sop_instance_uid, added),
+                        os.path.basename(file_name)
+                    )
+                    if self._move_file(file_name, new_name):
+                        self.write(_rename_file, model, record_id, new_name)
+                        old_folders.add(os.path.dirname(file_name))
+                        moved += 1
+        for folder in sorted(old_folders, reverse=True):
+            self._remove_empty_folders(folder)
+        self.log_info('Migrated %d files', moved)
+
+    def _in_layout(self, sop_instance_uid: str, file_name: str) -> bool:
+        """Checks if stored file is in a folder of configured layout
+
+        :param sop_instance_uid: SOP Instance UID
+        :type sop_instance_uid: str
+        :param file_name: file name relative to storage directory
+        :type file_name: str
+        :return: `True` if file doesn't have to be moved
+        :rtype: bool
+        """
+        folder = os.path.dirname(file_name)
+        if self.layout == StorageLayout.HASHED:
+            return folder == self.get_folder(sop_instance_uid)
+        # File may be stored on a different day than its record was added
+        # (e.g. replaced file), any date folder is fine
+        if len(folder) != 8 or not folder.isdigit():
+            return False
+        try:
+            datetime.datetime.strptime(folder, '%Y%m%d')
+        except ValueError:
+            return False
+        return True
+
+    def _move_file(self, file_name: str, new_name: str) -> bool:
+        src = os.path.join(self.storage_dir, file_name)
+        dst = os.path.join(self.storage_dir, new_name)
+        if os.path.exists(dst) and not os.path.exists(src):
+            # File was moved, but record was not updated
+            return True
+        self.make_folder(os.path.dirname(new_name))
+        try:
+            os.rename(src, dst)
+        except OSError as e:
+            self.log_warning(f'Failed to move {file_name} to {new_name}: {e}')
+            return False
+        return True
+
+    def _remove_empty_folders(self, folder: str):
+        while folder:
+            try:
+                os.rmdir(os.path.join(self.storage_dir, folder))
+            except OSError:
+                return
+            self._folders.discard(folder)
+            folder = os.path.dirname(folder)
 
     def cleanup(self):
         try:
@@ -198,10 +686,31 @@ class FileStorage(StorageBase):
 
 
 class InMemoryStorage(StorageBase):
+    """Keeps encoded datasets in memory.
+
+    Memory use can be bounded by ``max_bytes``. Least recently used datasets
+    are spilled to ``spill_dir`` (temporary directory by default) and are
+    loaded back when they are requested.
+    """
+
     def __init__(self, bus: event_bus.EventBus, config: dict):
         super().__init__(bus, config)
+        if self.duplicates == DuplicatePolicy.VERSION:
+            # Datasets are kept by SOP Instance UID
+            self.log_warning('Versions are not supported, overwriting')
+            self.duplicates = DuplicatePolicy.OVERWRITE
+        #: Memory budget for stored datasets in bytes, unbounded if `None`
+        self.max_bytes = config.get('max_bytes')
+        self.spill_dir = config.get('spill_dir')
+        self._spill_dir_created = False
         self._temp_files = {}
-        self._stored_files = {}
+        self._received_files = {}
+        #: Encoded datasets that were received, but could not be indexed
+        self.quarantined = {}
+        self._stored_files = collections.OrderedDict()
+        self._stored_bytes = 0
+        self._spilled_files = {}
+        self._lock = threading.RLock()
 
     def on_get_file(self, context, command_set: pydicom.Dataset):
         sop_instance_uid = command_set.AffectedSOPInstanceUID
@@ -215,27 +724,133 @@ class InMemoryStorage(StorageBase):
         self.log_info('Storing dataset in memory: %s', sop_instance_uid)
         return fp, start
 
-    def on_store_done(self, ds: pydicom.Dataset):
-        sop_instance_uid = ds.SOPInstanceUID
-        self.file_stored(ds.SOPInstanceUID)
-        fp, start = self._temp_files[sop_instance_uid]
-        fp.seek(start)
-        self._stored_files[sop_instance_uid] = pydicom.dcmread(fp)
-        del self._temp_files[sop_instance_uid]
-
-    def on_store_failure(self, ds: pydicom.Dataset):
-        file_name = self.remove_file(ds.SOPInstanceUID)
+    def on_store_received(self, ingest_ctx: ingest.IngestContext):
+        # Incoming buffer is closed as soon as C-STORE is handled.
+        # Keep encoded dataset, it is decoded only when requested
+        sop_instance_uid = ingest_ctx.sop_instance_uid
         try:
-            del self._temp_files[file_name]
+            fp, start = self._temp_files.pop(sop_instance_uid)
         except KeyError:
-            pass
+            return
+        with fp.getbuffer() as buffer:
+            self._received_files[sop_instance_uid] = buffer[start:].tobytes()
+
+    def on_store_done(self, ingest_ctx: ingest.IngestContext):
+        sop_instance_uid = ingest_ctx.sop_instance_uid
+        self.file_stored(sop_instance_uid)
+        self.on_store_received(ingest_ctx)
+        try:
+            data = self._received_files.pop(sop_instance_uid)
+        except KeyError:
+            self.log_warning('No dataset received for %s', sop_instance_uid)
+        else:
+            with self._lock:
+                self._keep(sop_instance_uid, data)
+
+    def on_store_failure(self, ingest_ctx: ingest.IngestContext):
+        file_name = self.remove_file(ingest_ctx.sop_instance_uid)
+        self._temp_files.pop(file_name, None)
+        self._received_files.pop(file_name, None)
+
+    def on_store_quarantine(self, ingest_ctx: ingest.IngestContext):
+        sop_instance_uid = ingest_ctx.sop_instance_uid
+        self.remove_file(sop_instance_uid)
+        self.on_store_received(ingest_ctx)
+        data = self._received_files.pop(sop_instance_uid, None)
+        if data is not None:
+            self.quarantined[sop_instance_uid] = data
+        self.log_error('Dataset %s could not be indexed, kept in quarantine',
+                       sop_instance_uid)
+
+    def discard_file(self, file_name: str):
+        with self._lock:
+            self._discard(file_name)
 
     def on_store_get_files(self, sop_instance_uids: list):
         self.log_debug('Getting files %r', sop_instance_uids)
-        for file_record in self.find_files(sop_instance_uids):
-            ds = self._stored_files[file_record.sop_instance_uid]
+        for file_record in self.find_files(sop_instance_uids, self.retrieve_consistency):
+            data = self.get_data(file_record.sop_instance_uid)
+            ds = pydicom.dcmread(io.BytesIO(data))
             yield file_record.sop_class_uid, file_record.transfer_syntax, ds
 
+    def get_data(self, sop_instance_uid: str) -> bytes:
+        """Encoded dataset (including file meta information)
+
+        Spilled dataset is loaded back into memory.
+
+        :param sop_instance_uid: SOP Instance UID
+        :type sop_instance_uid: str
+        :return: encoded dataset
+        :rtype: bytes
+        """
+        with self._lock:
+            try:
+                self._stored_files.move_to_end(sop_instance_uid)
+                return self._stored_files[sop_instance_uid]
+            except KeyError:
+                pass
+            file_name = self._spilled_files.pop(sop_instance_uid)
+            with open(file_name, 'rb') as fp:
+                data = fp.read()
+            self.remove_nothrow(file_name)
+            self.log_debug('Loaded spilled dataset %s', sop_instance_uid)
+            self._keep(sop_instance_uid, data)
+            return data
+
+    def memory_stats(self) -> dict:
+        """Memory usage statistics
+
+        :return: number of datasets and bytes kept in memory and number of
+                 spilled datasets
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'in_memory': len(self._stored_files),
+                'bytes': self._stored_bytes,
+                'max_bytes': self.max_bytes,
+                'spilled': len(self._spilled_files)
+            }
+
+    def _keep(self, sop_instance_uid: str, data: bytes):
+        self._discard(sop_instance_uid)
+        self._stored_files[sop_instance_uid] = data
+        self._stored_bytes += len(data)
+        if self.max_bytes is None:
+            return
+        # Most recent dataset is kept even if it exceeds the budget alone
+        while self._stored_bytes > self.max_bytes and \
+                len(self._stored_files) > 1:
+            self._spill(*self._stored_files.popitem(last=False))
+
+    def _discard(self, sop_instance_uid: str):
+        data = self._stored_files.pop(sop_instance_uid, None)
+        if data is not None:
+            self._stored_bytes -= len(data)
+        file_name = self._spilled_files.pop(sop_instance_uid, None)
+        if file_name is not None:
+            self.remove_nothrow(file_name)
+
+    def _spill(self, sop_instance_uid: str, data: bytes):
+        self._stored_bytes -= len(data)
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp()
+            self._spill_dir_created = True
+        fd, file_name = tempfile.mkstemp(suffix='.dcm', dir=self.spill_dir)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        self._spilled_files[sop_instance_uid] = file_name
+        self.log_debug('Spilled dataset %s to %s', sop_instance_uid, file_name)
+
+    def on_exit(self):
+        super().on_exit()
+        with self._lock:
+            for file_name in self._spilled_files.values():
+                self.remove_nothrow(file_name)
+            self._spilled_files.clear()
+            if self._spill_dir_created:
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
+
 
 class TempFileStorage(StorageBase):
     def __init__(self, bus: event_bus.EventBus, config: dict):
@@ -254,21 +869,142 @@ class TempFileStorage(StorageBase):
         self.log_info('Storing incoming dataset in %s', fp.name)
         return fp, start
 
-    def on_store_done(self, ds: pydicom.Dataset):
-        self.file_stored(ds.SOPInstanceUID)
+    def on_store_done(self, ingest_ctx: ingest.IngestContext):
+        self.file_stored(ingest_ctx.sop_instance_uid,
+                         self.received_file_name(ingest_ctx))
 
-    def on_store_failure(self, ds: pydicom.Dataset):
-        file_name = self.remove_file(ds.SOPInstanceUID)
+    def on_store_failure(self, ingest_ctx: ingest.IngestContext):
+        file_name = self.remove_file(ingest_ctx.sop_instance_uid,
+                                     self.received_file_name(ingest_ctx))
         self.remove_nothrow(file_name)
         self._temp_files.remove(file_name)
 
+    def on_store_quarantine(self, ingest_ctx: ingest.IngestContext):
+        # File is kept after exit, so it can be stored again
+        file_name = self.remove_file(ingest_ctx.sop_instance_uid,
+                                     self.received_file_name(ingest_ctx))
+        self._temp_files.discard(file_name)
+        self.log_error('Dataset %s could not be indexed, kept as %s',
+                       ingest_ctx.sop_instance_uid, file_name)
+
     def on_store_get_files(self, sop_instance_uids: list):
         self.log_debug('Getting files %r', sop_instance_uids)
-        for file_record in self.find_files(sop_instance_uids):
+        for file_record in self.find_files(sop_instance_uids, self.retrieve_consistency):
             file_name = file_record.file_name
             yield file_record.sop_class_uid, file_record.transfer_syntax, file_name
 
+    def received_file_name(self, ingest_ctx: ingest.IngestContext) -> str:
+        return ingest_ctx.fp.name
+
+    def discard_file(self, file_name: str):
+        self.remove_nothrow(file_name)
+        self._temp_files.discard(file_name)
+
     def on_exit(self):
         super().on_exit()
         for file_name in self._temp_files:
             self.remove_nothrow(file_name)
+
+
+def _new_file(sop_instance_uid: str, sop_class_uid: str,
+              transfer_syntax: str, file_name: str, maybe_known: bool):
+    """Creates file record or replaces existing one
+
+    :return: tuple of file record and replaced record (`None` if instance
+             is new)
+    :rtype: tuple
+    """
+    fields = {
+        'sop_class_uid': sop_class_uid,
+        'transfer_syntax': transfer_syntax,
+        'file_name': file_name
+    }
+    if maybe_known:
+        file_record = StorageFiles.get_or_none(
+            StorageFiles.sop_instance_uid == sop_instance_uid
+        )
+        if file_record is not None:
+            replaced = StorageFiles(**file_record.__data__)
+            for name, value in fields.items():
+                setattr(file_record, name, value)
+            file_record.added = datetime.datetime.utcnow()
+            file_record.is_stored = False
+            file_record.save()
+            return file_record, replaced
+    file_record = StorageFiles.create(
+        sop_instance_uid=sop_instance_uid, **fields
+    )
+    return file_record, None
+
+
+def _restore_file(replaced: StorageFiles, file_name: str = None) -> tuple:
+    """Restores replaced record, unless instance was replaced again
+
+    :return: name of the replacing file and `True` if record was restored
+    :rtype: tuple
+    """
+    if file_name is None:
+        file_name = StorageFiles.get(
+            StorageFiles.sop_instance_uid == replaced.sop_instance_uid
+        ).file_name
+    elif not _current_file(replaced.sop_instance_uid, file_name).exists():
+        return file_name, False
+    replaced.save()
+    return file_name, True
+
+
+def _add_version(replaced: StorageFiles):
+    StorageFileVersions.create(
+        sop_instance_uid=replaced.sop_instance_uid,
+        sop_class_uid=replaced.sop_class_uid,
+        transfer_syntax=replaced.transfer_syntax,
+        file_name=replaced.file_name,
+        added=replaced.added
+    )
+
+
+def _rename_file(model, record_id: int, file_name: str):
+    model.update(file_name=file_name).where(model.id == record_id).execute()
+
+
+def _current_file(sop_instance_uid: str, file_name: str = None):
+    """Selects file record of the instance
+
+    Record could be already replaced by the same instance received later,
+    so file name is checked too, if it is set.
+    """
+    condition = StorageFiles.sop_instance_uid == sop_instance_uid
+    if file_name is not None:
+        condition &= StorageFiles.file_name == file_name
+    return StorageFiles.select().where(condition)
+
+
+def _delete_files(sop_instance_uids: list) -> list:
+    """Deletes file records and versions of the instances
+
+    :return: names of the deleted files
+    :rtype: list
+    """
+    file_names = []
+    for model in (StorageFiles, StorageFileVersions):
+        for batch in peewee.chunked(sop_instance_uids, SELECT_BATCH_SIZE):
+            condition = model.sop_instance_uid << batch
+            file_names.extend(
+                name for name, in
+                model.select(model.file_name).where(condition).tuples()
+            )
+            model.delete().where(condition).execute()
+    return file_names
+
+
+def _file_stored(sop_instance_uid: str, file_name: str = None):
+    for stored_file in _current_file(sop_instance_uid, file_name):
+        stored_file.is_stored = True
+        stored_file.save()
+
+
+def _remove_file(sop_instance_uid: str, file_name: str = None) -> str:
+    for stored_file in _current_file(sop_instance_uid, file_name):
+        file_name = stored_file.file_name
+        stored_file.delete_instance()
+    return file_name